@@ -129,6 +129,8 @@ def create_app():
     cli_param.init()
 
     ub.init_db(cli_param.settings_path)
+    if cli_param.shared_search_ids:
+        ub.searched_ids.use_database(cli_param.settings_path)
     # pylint: disable=no-member
     encrypt_key, error = config_sql.get_encryption_key(os.path.dirname(cli_param.settings_path))
 
@@ -154,6 +156,7 @@ def create_app():
     lm.anonymous_user = ub.Anonymous
     lm.session_protection = 'strong' if config.config_session == 1 else "basic"
 
+    db.CalibreDB.set_pool_limits(cli_param.db_pool_size, cli_param.db_pool_overflow, cli_param.db_pool_timeout)
     db.CalibreDB.update_config(config, config.config_calibre_dir, cli_param.settings_path)
 
     updater_thread.init_updater(config, web_server)
@@ -29,9 +29,11 @@ from collections import OrderedDict
 import flask
 from flask_babel import gettext as _
 
-from . import db, calibre_db, converter, uploader, constants, dep_check
+from . import db, ub, calibre_db, converter, uploader, constants, dep_check, kobo_sync_status
+from .category_index import get_category_index
+from .epub_layout import get_epub_layout_cache
 from .render_template import render_title_template
-from .usermanagement import user_login_required
+from .usermanagement import user_login_required, credential_cache
 
 
 about = flask.Blueprint('about', __name__)
@@ -74,6 +76,41 @@ def collect_stats():
     return _VERSIONS
 
 
+def collect_runtime_stats():
+    pool = db.CalibreDB.get_pool_stats()
+    _RUNTIME = OrderedDict()
+    _RUNTIME['Calibre DB connections created'] = pool['connections_created']
+    _RUNTIME['Calibre DB connection checkouts'] = pool['checkouts']
+    _RUNTIME['Calibre DB connection reuse'] = "{:.1%}".format(pool['reuse_ratio'])
+    _RUNTIME['Calibre DB connections in use'] = pool['checked_out']
+    _RUNTIME['Calibre DB connection pool exhausted'] = pool['pool_exhausted']
+    _RUNTIME['Calibre DB engine reloads'] = pool['engines_disposed']
+    _RUNTIME['Calibre DB external changes detected'] = pool['library_changes']
+    search_ids_stats = ub.searched_ids.get_stats()
+    _RUNTIME['Stored search results{}'.format(' (shared)' if search_ids_stats['shared'] else '')] = \
+        search_ids_stats['entries']
+    _RUNTIME['Stored search results size'] = "{:.1f} KiB".format(search_ids_stats['bytes'] / 1024.0)
+    _RUNTIME['Stored search results evicted'] = search_ids_stats['evictions']
+    credential_stats = credential_cache.get_stats()
+    _RUNTIME['OPDS verified credentials cached'] = credential_stats['entries']
+    _RUNTIME['OPDS credential cache hits'] = credential_stats['hits']
+    _RUNTIME['OPDS credential cache misses'] = credential_stats['misses']
+    category_stats = get_category_index().get_stats()
+    _RUNTIME['Category index restriction profiles'] = category_stats['profiles']
+    _RUNTIME['Category index lookups'] = category_stats['lookups']
+    _RUNTIME['Category index random samples'] = category_stats['samples']
+    _RUNTIME['Category index profile builds'] = category_stats['profile_builds']
+    _RUNTIME['Category index incrementally updated books'] = category_stats['books_updated']
+    _RUNTIME['Category index external library changes'] = category_stats['library_changes']
+    layout_stats = get_epub_layout_cache(ub.app_DB_path).get_stats()
+    _RUNTIME['EPUB layout cache entries'] = layout_stats['entries']
+    _RUNTIME['EPUB layout cache hits'] = layout_stats['hits']
+    _RUNTIME['EPUB layout cache misses'] = layout_stats['misses']
+    for phase, (count, average) in kobo_sync_status.get_sync_timings().items():
+        _RUNTIME['Kobo sync {} (avg. of {})'.format(phase, count)] = "{:.1f} ms".format(average * 1000)
+    return _RUNTIME
+
+
 @about.route("/stats")
 @user_login_required
 def stats():
@@ -82,4 +119,4 @@ def stats():
     categories = calibre_db.session.query(db.Tags).count()
     series = calibre_db.session.query(db.Series).count()
     return render_title_template('stats.html', bookcounter=counter, authorcounter=authors, versions=collect_stats(),
-                                 categorycounter=categories, seriecounter=series, title=_("Statistics"), page="stat")
+                                 runtime=collect_runtime_stats(), categorycounter=categories, seriecounter=series, title=_("Statistics"), page="stat")
@@ -569,7 +569,8 @@ def update_view_configuration():
     to_save = request.form.to_dict()
 
     _config_string(to_save, "config_calibre_web_title")
-    _config_string(to_save, "config_columns_to_ignore")
+    # both change the custom columns in the metadata search index
+    rebuild_search_index = _config_string(to_save, "config_columns_to_ignore")
     if _config_string(to_save, "config_title_regex"):
         calibre_db.create_functions(config)
 
@@ -577,7 +578,9 @@ def update_view_configuration():
         flash(_("Invalid Read Column"), category="error")
         log.debug("Invalid Read column")
         return view_configuration()
-    _config_int(to_save, "config_read_column")
+    rebuild_search_index |= _config_int(to_save, "config_read_column")
+    if rebuild_search_index:
+        helper.rebuild_metadata_fts_index()
 
     if not check_valid_restricted_column(to_save.get("config_restricted_column", "0")):
         flash(_("Invalid Restricted Column"), category="error")
@@ -1749,6 +1752,7 @@ def _db_configuration_update_helper():
         if db_change:
             log.info("Calibre Database changed, all Calibre-Web info related to old Database gets deleted")
             ub.session.query(ub.Downloads).delete()
+            ub.session.query(ub.DownloadCount).delete()
             ub.session.query(ub.ArchivedBook).delete()
             ub.session.query(ub.ReadBook).delete()
             ub.session.query(ub.BookShelf).delete()
@@ -1757,6 +1761,7 @@ def _db_configuration_update_helper():
             ub.session.query(ub.KoboStatistics).delete()
             ub.session.query(ub.KoboSyncedBooks).delete()
             helper.delete_thumbnail_cache()
+            helper.rebuild_metadata_fts_index()
             ub.session_commit()
             # deleted visibilities based on custom column and tags
             config.config_restricted_column = 0
@@ -2006,6 +2011,8 @@ def _delete_user(content):
             for kobo_entry in kobo_entries:
                 ub.session.delete(kobo_entry)
             ub.session_commit()
+            calibre_db.invalidate_filter_cache(content.id)
+            ub.rebuild_download_counts()
             log.info("User {} deleted".format(content.name))
             return _("User '%(nick)s' deleted", nick=content.name)
         else:
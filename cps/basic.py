@@ -75,9 +75,9 @@ def show_book(book_id):
     entries = calibre_db.get_book_read_archived(book_id, config.config_read_column, allow_show_archived=True)
     if entries:
         entry = entries[0]
-        for lang_index in range(0, len(entry.languages)):
-            entry.languages[lang_index].language_name = isoLanguages.get_language_name(get_locale(), entry.languages[
-                lang_index].lang_code)
+        locale = get_locale()
+        for lang in entry.languages:
+            lang.language_name = isoLanguages.get_language_name(locale, lang.lang_code)
         entry.ordered_authors = calibre_db.order_authors([entry])
 
         return render_title_template('basic_detail.html',
@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import threading
+from collections import Counter, OrderedDict, namedtuple
+
+from sqlalchemy import text
+
+from . import logger
+
+log = logger.create()
+
+CATEGORY_AUTHOR = 'author'
+CATEGORY_SERIES = 'series'
+CATEGORY_TAG = 'category'
+CATEGORY_PUBLISHER = 'publisher'
+CATEGORY_LANGUAGE = 'language'
+CATEGORY_RATING = 'ratings'
+CATEGORY_FORMAT = 'formats'
+
+# restriction profiles kept in memory, the least recently used one is dropped first
+PROFILE_CACHE_SIZE = 64
+# with more changed books the visible books of a profile are queried again instead of checking the changed ones
+PENDING_REBUILD_LIMIT = 500
+# ids per IN clause, sqlite allows at most 999 variables
+_CHUNK_SIZE = 500
+
+CategoryItem = namedtuple('CategoryItem', ['id', 'name', 'sort', 'rating', 'format'])
+# same layout as the (entity, count) rows the list templates were written for
+CategoryEntry = namedtuple('CategoryEntry', ['item', 'count', 'name', 'format'])
+CategoryCounts = namedtuple('CategoryCounts', ['entries', 'none_count', 'char_list'])
+
+# per category: query for (book, key), its book column, query for the items, its key column
+_CATEGORIES = {
+    CATEGORY_AUTHOR: ("SELECT book, author FROM books_authors_link WHERE {}", "book",
+                      "SELECT id, replace(name, '|', ','), sort, NULL, NULL FROM authors WHERE {}", "id"),
+    CATEGORY_SERIES: ("SELECT book, series FROM books_series_link WHERE {}", "book",
+                      "SELECT id, name, sort, NULL, NULL FROM series WHERE {}", "id"),
+    CATEGORY_TAG: ("SELECT book, tag FROM books_tags_link WHERE {}", "book",
+                   "SELECT id, name, NULL, NULL, NULL FROM tags WHERE {}", "id"),
+    CATEGORY_PUBLISHER: ("SELECT book, publisher FROM books_publishers_link WHERE {}", "book",
+                         "SELECT id, name, sort, NULL, NULL FROM publishers WHERE {}", "id"),
+    CATEGORY_LANGUAGE: ("SELECT book, lang_code FROM books_languages_link WHERE {}", "book",
+                        "SELECT id, lang_code, NULL, NULL, NULL FROM languages WHERE {}", "id"),
+    CATEGORY_RATING: ("SELECT l.book, l.rating FROM books_ratings_link l JOIN ratings r ON r.id = l.rating "
+                      "WHERE r.rating > 0 AND {}", "l.book",
+                      "SELECT id, rating, NULL, rating, NULL FROM ratings WHERE {}", "id"),
+    # formats have no table of their own, the key is the format
+    CATEGORY_FORMAT: ("SELECT book, format FROM data WHERE {}", "book", None, None),
+}
+# the first letter index of these categories follows the sort name
+_SORTED_BY_SORT = (CATEGORY_AUTHOR, CATEGORY_SERIES)
+
+
+def category_entry(item_id, name, count, sort=None):
+    """Builds a list page entry from the columns of a grouped query"""
+    return CategoryEntry(CategoryItem(item_id, name, sort, None, None), count, None, None)
+
+
+def _chunks(values):
+    values = list(values)
+    for start in range(0, len(values), _CHUNK_SIZE):
+        yield values[start:start + _CHUNK_SIZE]
+
+
+def _in_clause(column, ids):
+    return "{} IN ({})".format(column, ",".join(str(int(i)) for i in ids))
+
+
+class _Profile:
+    __slots__ = ('visible', 'ids', 'counters', 'results', 'pending')
+
+    def __init__(self, visible):
+        self.visible = visible
+        # visible ids as sequence for sampling, built on first use
+        self.ids = None
+        # category -> [Counter(key -> number of visible books), number of visible books without key]
+        self.counters = dict()
+        self.results = dict()
+        self.pending = set()
+
+
+class CategoryIndex:
+    """Book counts and first letters of all categories per restriction profile. The book to category links are
+    loaded once per library, the counts of a profile are derived from the ids of the books visible to it and kept
+    up to date with the books reported as changed, so list pages don't need to group the whole library. Changes
+    done outside of Calibre-Web are found by the library state and the last_modified watermark of the books. The
+    ids of the visible books also serve random samples. Whole library queries run without holding the lock, their
+    results are only used if the index wasn't changed in the meantime"""
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._links = dict()
+        self._items = dict()
+        self._profiles = OrderedDict()
+        self._changed = set()
+        # library state, ids of all books and newest last_modified when the library was last checked
+        self._library_state = None
+        self._book_ids = None
+        self._watermark = None
+        # increased whenever loaded links, items or profiles are changed
+        self._generation = 0
+        self.stats = {'lookups': 0, 'samples': 0, 'profile_builds': 0, 'books_updated': 0, 'library_changes': 0}
+
+    def clear(self):
+        with self._lock:
+            self._links.clear()
+            self._items.clear()
+            self._profiles.clear()
+            self._changed.clear()
+            self._library_state = None
+            self._book_ids = None
+            self._watermark = None
+            self._generation += 1
+
+    def books_changed(self, book_ids, library_state=None):
+        """Marks added, edited or deleted books, they are merged on the next lookup. library_state is the state
+        after the commit of these changes, it needs no check for changes done outside of Calibre-Web then"""
+        with self._lock:
+            self._changed.update(int(book_id) for book_id in book_ids)
+            if library_state is not None and self._library_state is not None:
+                # external changes done before are still newer than the watermark and found on the next check
+                self._library_state = library_state
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['profiles'] = len(self._profiles)
+            stats['links'] = sum(len(links) for links in self._links.values())
+        return stats
+
+    def lookup(self, session, category, profile_key, visible_books, library_state=None, excluded=()):
+        """Returns the CategoryCounts of a category for a restriction profile. visible_books(book_ids) has to return
+        the ids of the books visible to the profile, limited to book_ids unless it is None. The books in excluded,
+        e.g. the ones archived by the current user, are not counted. If library_state differs from the last one, the
+        books changed since then are merged first"""
+        self._prefetch(session, library_state, profile_key, visible_books, category)
+        with self._lock:
+            self.stats['lookups'] += 1
+            self._check_library(session, library_state)
+            self._merge_changes(session)
+            links = self._load(session, category)
+            profile = self._get_profile(profile_key, visible_books)
+            counters = profile.counters.get(category)
+            if counters is None:
+                counters = self._count(links, profile.visible)
+                profile.counters[category] = counters
+            excluded = [book_id for book_id in excluded if book_id in profile.visible]
+            if excluded:
+                return self._result(category, counters, self._count(links, excluded))
+            result = profile.results.get(category)
+            if result is None:
+                result = self._result(category, counters)
+                profile.results[category] = result
+            return result
+
+    def sample(self, session, profile_key, visible_books, count, library_state=None, excluded=()):
+        """Returns up to count random ids of the books visible to a restriction profile and not in excluded, in
+        random order"""
+        self._prefetch(session, library_state, profile_key, visible_books)
+        with self._lock:
+            self.stats['samples'] += 1
+            self._check_library(session, library_state)
+            self._merge_changes(session)
+            profile = self._get_profile(profile_key, visible_books)
+            if profile.ids is None:
+                profile.ids = tuple(profile.visible)
+            ids = profile.ids
+            excluded = set(book_id for book_id in excluded if book_id in profile.visible)
+        count = int(count)
+        if not excluded:
+            return random.sample(ids, min(count, len(ids)))
+        # the sample is drawn large enough to be complete without the excluded books
+        sample = random.sample(ids, min(count + len(excluded), len(ids)))
+        return [book_id for book_id in sample if book_id not in excluded][:count]
+
+    def _prefetch(self, session, library_state, profile_key, visible_books, category=None):
+        # runs the whole library queries a lookup needs without the lock, lookups of other pages aren't blocked by
+        # them. If the index changed in between, the lookup runs them again under the lock
+        with self._lock:
+            generation = self._generation
+            scan_library = library_state is not None and library_state != self._library_state
+            book_ids, watermark, loaded = self._book_ids, self._watermark, list(self._links)
+            load_links = category is not None and category not in self._links
+            build_profile = profile_key not in self._profiles
+        if not (scan_library or load_links or build_profile):
+            return
+        scan = self._scan_library(session, book_ids, watermark, loaded) if scan_library else None
+        links = self._read_links(session, category) if load_links else None
+        visible = set(visible_books(None)) if build_profile else None
+        with self._lock:
+            if generation != self._generation:
+                return
+            if scan is not None and library_state != self._library_state:
+                self._apply_scan(library_state, scan)
+            if links is not None and category not in self._links:
+                self._store_links(category, *links)
+            if visible is not None and profile_key not in self._profiles:
+                self._add_profile(profile_key, visible)
+
+    def _add_profile(self, profile_key, visible):
+        profile = _Profile(visible)
+        self.stats['profile_builds'] += 1
+        self._profiles[profile_key] = profile
+        while len(self._profiles) > PROFILE_CACHE_SIZE:
+            self._profiles.popitem(last=False)
+        return profile
+
+    def _get_profile(self, profile_key, visible_books):
+        profile = self._profiles.get(profile_key)
+        if profile is None:
+            profile = self._add_profile(profile_key, set(visible_books(None)))
+        else:
+            self._profiles.move_to_end(profile_key)
+            if profile.pending:
+                self._update_visibility(profile, visible_books)
+        return profile
+
+    def _load(self, session, category):
+        links = self._links.get(category)
+        if links is None:
+            links = self._store_links(category, *self._read_links(session, category))
+        return links
+
+    @staticmethod
+    def _read_links(session, category):
+        link_sql, __, item_sql, __ = _CATEGORIES[category]
+        links = dict()
+        for book_id, key in session.execute(text(link_sql.format("1"))):
+            links[book_id] = links.get(book_id, ()) + (key,)
+        if item_sql:
+            items = list(session.execute(text(item_sql.format("1"))))
+        else:
+            items = [(key, key, None, None, key) for keys in links.values() for key in keys]
+        return links, items
+
+    def _store_links(self, category, links, items):
+        self._links[category] = links
+        self._items[category] = dict()
+        self._store_items(category, items)
+        return links
+
+    def _store_items(self, category, rows):
+        items = self._items[category]
+        for row in rows:
+            items[row[0]] = CategoryItem(*row)
+
+    def _check_library(self, session, library_state):
+        # finds books added, edited or deleted by calibre or calibredb since the last check
+        if library_state is None or library_state == self._library_state:
+            return
+        self._apply_scan(library_state, self._scan_library(session, self._book_ids, self._watermark,
+                                                           list(self._links)))
+
+    @staticmethod
+    def _scan_library(session, book_ids, watermark, categories):
+        # ids of all books, newest last_modified, books changed compared to book_ids and watermark and the items
+        # of the loaded categories, renamed items don't change the books referencing them
+        all_ids = set(row[0] for row in session.execute(text("SELECT id FROM books")))
+        new_watermark = session.execute(text("SELECT MAX(last_modified) FROM books")).scalar()
+        changed = None
+        items = dict()
+        if book_ids is not None:
+            changed = all_ids.symmetric_difference(book_ids)
+            if watermark is not None:
+                changed.update(row[0] for row in session.execute(
+                    text("SELECT id FROM books WHERE last_modified > :watermark"), {"watermark": watermark}))
+            for category in categories:
+                item_sql = _CATEGORIES[category][2]
+                if item_sql:
+                    items[category] = list(session.execute(text(item_sql.format("1"))))
+        return all_ids, new_watermark, changed, items
+
+    def _apply_scan(self, library_state, scan):
+        book_ids, watermark, changed, items = scan
+        if changed is not None:
+            if changed:
+                self.stats['library_changes'] += 1
+                self._changed.update(changed)
+            for category, rows in items.items():
+                if category in self._items:
+                    self._items[category] = dict()
+                    self._store_items(category, rows)
+            for profile in self._profiles.values():
+                profile.results.clear()
+            self._generation += 1
+        self._library_state = library_state
+        self._book_ids = book_ids
+        self._watermark = watermark
+
+    def _merge_changes(self, session):
+        if not self._changed:
+            return
+        changed = self._changed
+        self._changed = set()
+        self._generation += 1
+        self.stats['books_updated'] += len(changed)
+        for category, links in self._links.items():
+            link_sql, book_column, item_sql, key_column = _CATEGORIES[category]
+            new_links = dict((book_id, ()) for book_id in changed)
+            for chunk in _chunks(changed):
+                for book_id, key in session.execute(text(link_sql.format(_in_clause(book_column, chunk)))):
+                    new_links[book_id] += (key,)
+            # renamed items are referenced by the changed books
+            keys = set(key for keys in new_links.values() for key in keys)
+            if item_sql:
+                for chunk in _chunks(keys):
+                    self._store_items(category, session.execute(text(item_sql.format(_in_clause(key_column,
+                                                                                                  chunk)))))
+            else:
+                self._store_items(category, ((key, key, None, None, key) for key in keys))
+            for profile in self._profiles.values():
+                counters = profile.counters.get(category)
+                if counters is None:
+                    continue
+                for book_id, keys in new_links.items():
+                    if book_id in profile.visible:
+                        self._remove(counters, links.get(book_id, ()))
+                        self._add(counters, keys)
+                profile.results.pop(category, None)
+            for book_id, keys in new_links.items():
+                if keys:
+                    links[book_id] = keys
+                else:
+                    links.pop(book_id, None)
+        # edits can change the visibility of a book, it is checked with the filters of the profile on its next lookup
+        for profile in self._profiles.values():
+            profile.pending.update(changed)
+
+    def _update_visibility(self, profile, visible_books):
+        pending = profile.pending
+        profile.pending = set()
+        if len(pending) > PENDING_REBUILD_LIMIT:
+            visible = set(visible_books(None))
+            added = visible - profile.visible
+            removed = profile.visible - visible
+        else:
+            visible = set()
+            for chunk in _chunks(pending):
+                visible.update(visible_books(chunk))
+            added = visible - profile.visible
+            removed = (pending & profile.visible) - visible
+        if not added and not removed:
+            return
+        profile.ids = None
+        for category, counters in profile.counters.items():
+            links = self._links[category]
+            for book_id in removed:
+                self._remove(counters, links.get(book_id, ()))
+            for book_id in added:
+                self._add(counters, links.get(book_id, ()))
+            profile.results.pop(category, None)
+        profile.visible.difference_update(removed)
+        profile.visible.update(added)
+
+    @staticmethod
+    def _add(counters, keys):
+        if keys:
+            counters[0].update(keys)
+        else:
+            counters[1] += 1
+
+    @staticmethod
+    def _remove(counters, keys):
+        if keys:
+            counter = counters[0]
+            for key in keys:
+                counter[key] -= 1
+                if counter[key] <= 0:
+                    del counter[key]
+        else:
+            counters[1] -= 1
+
+    @staticmethod
+    def _count(links, visible):
+        counter = Counter()
+        none_count = 0
+        for book_id in visible:
+            keys = links.get(book_id)
+            if keys:
+                counter.update(keys)
+            else:
+                none_count += 1
+        return [counter, none_count]
+
+    def _result(self, category, counters, excluded_counters=None):
+        items = self._items[category]
+        entries = list()
+        char_list = set()
+        excluded_counter, excluded_none = excluded_counters or (Counter(), 0)
+        for key, count in counters[0].items():
+            count -= excluded_counter[key]
+            item = items.get(key)
+            if item is None or count <= 0:
+                continue
+            entries.append(CategoryEntry(item, count, item.rating // 2 if item.rating else None, item.format))
+            letter_source = item.sort if category in _SORTED_BY_SORT else item.name
+            if letter_source and isinstance(letter_source, str):
+                char_list.add(letter_source[0].upper())
+        return CategoryCounts(entries, counters[1] - excluded_none, sorted(char_list))
+
+
+_instance = None
+_instance_lock = threading.Lock()
+
+
+def get_category_index():
+    global _instance
+    with _instance_lock:
+        if _instance is None:
+            _instance = CategoryIndex()
+        return _instance
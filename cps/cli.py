@@ -40,17 +40,38 @@ class CliParameter(object):
         self.ip_address = None
         self.allow_localhost = None
         self.reconnect_enable = None
+        self.shared_search_ids = None
         self.memory_backend = None
         self.dry_run = None
         self.certfilepath = None
         self.keyfilepath = None
         self.gd_path = None
+        self.gdrive_stub = None
+        self.gdrive_download_ranges = 4
+        self.gdrive_cache_size = 1024
+        self.db_pool_size = 10
+        self.db_pool_overflow = -1
+        self.db_pool_timeout = 30
         self.settings_path = None
         self.logpath = None
 
     def init(self):
         self.arg_parser()
 
+    @staticmethod
+    def _env_int(name, default, minimum):
+        value = os.environ.get(name, None)
+        if value is None:
+            return default
+        try:
+            value = int(value)
+        except ValueError:
+            value = minimum - 1
+        if value < minimum:
+            print("{} has to be a number of at least {}. Exiting...".format(name, minimum))
+            sys.exit(1)
+        return value
+
     def arg_parser(self):
         parser = argparse.ArgumentParser(description='Calibre Web is a web app providing '
                                                      'a interface for browsing, reading and downloading eBooks\n',
@@ -121,6 +142,18 @@ class CliParameter(object):
         self.dry_run = args.d or None
         # enable reconnect endpoint for docker database reconnect
         self.reconnect_enable = args.r or os.environ.get("CALIBRE_RECONNECT", None)
+        # share stored search results between processes serving the same settings database
+        self.shared_search_ids = os.environ.get("CALIBRE_SHARED_SEARCH_IDS", None)
+        # serve the Google Drive library from an in-memory copy of this directory, for offline testing
+        self.gdrive_stub = os.environ.get("CALIBRE_GDRIVE_STUB", None)
+        # parallel Range requests per Google Drive download and size of the local download cache in MiB (0 disables)
+        self.gdrive_download_ranges = self._env_int("CALIBRE_GDRIVE_DOWNLOAD_RANGES", self.gdrive_download_ranges, 1)
+        self.gdrive_cache_size = self._env_int("CALIBRE_GDRIVE_CACHE_SIZE", self.gdrive_cache_size, 0)
+        # calibre database connections kept open, additional ones opened on demand (-1: no limit) and seconds a
+        # request waits for a connection once the limit is reached
+        self.db_pool_size = self._env_int("CALIBRE_DB_POOL_SIZE", self.db_pool_size, 1)
+        self.db_pool_overflow = self._env_int("CALIBRE_DB_POOL_OVERFLOW", self.db_pool_overflow, -1)
+        self.db_pool_timeout = self._env_int("CALIBRE_DB_POOL_TIMEOUT", self.db_pool_timeout, 1)
         # load covers from localhost
         self.allow_localhost = args.l or os.environ.get("CALIBRE_LOCALHOST", None)
         # handle and check ip address argument
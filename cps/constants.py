@@ -183,6 +183,7 @@ NIGHTLY_VERSION[1] = '$Format:%cI$'
 
 # CACHE
 CACHE_TYPE_THUMBNAILS    = 'thumbnails'
+CACHE_TYPE_GDRIVE        = 'gdrive'
 
 # Thumbnail Types
 THUMBNAIL_TYPE_COVER     = 1
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# seconds a verified username/password pair is accepted without hashing the password again
+CREDENTIAL_CACHE_TTL = 60
+# verified pairs kept, the least recently used one is dropped first
+CREDENTIAL_CACHE_SIZE = 1024
+
+
+def user_fingerprint(user):
+    # a changed password hash, role or name of the user makes cached verifications invalid
+    return hashlib.sha256("{}\0{}\0{}\0{}".format(user.id, user.name, user.password, user.role)
+                          .encode("utf-8")).digest()
+
+
+class CredentialCache:
+    """Recently verified Basic auth credentials. Entries are keyed by an HMAC of username and password with a key
+    which only lives in this process, the password is never stored. A hit is only valid as long as the password
+    hash, role and name of the user are unchanged, so edited or deleted users can't log in from the cache"""
+    def __init__(self, ttl=CREDENTIAL_CACHE_TTL, max_entries=CREDENTIAL_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._key = os.urandom(32)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def _digest(self, username, password):
+        message = "{}\0{}".format(username.lower(), password).encode("utf-8")
+        return hmac.new(self._key, message, hashlib.sha256).digest()
+
+    def check(self, username, password, user):
+        """True if the credentials were verified for this unchanged user within the ttl"""
+        digest = self._digest(username, password)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                fingerprint, expires = entry
+                if expires > time.monotonic() and hmac.compare_digest(fingerprint, user_fingerprint(user)):
+                    self._entries.move_to_end(digest)
+                    self.stats['hits'] += 1
+                    return True
+                del self._entries[digest]
+            self.stats['misses'] += 1
+            return False
+
+    def add(self, username, password, user):
+        digest = self._digest(username, password)
+        with self._lock:
+            self._entries[digest] = (user_fingerprint(user), time.monotonic() + self.ttl)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self._entries)
+        return stats
@@ -20,6 +20,9 @@
 import os
 import re
 import json
+import threading
+import hashlib
+from collections import namedtuple
 from datetime import datetime, timezone
 from urllib.parse import quote
 import unidecode
@@ -27,9 +30,9 @@ import unidecode
 from uuid import uuid4
 
 from sqlite3 import OperationalError as sqliteOperationalError
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy import Table, Column, ForeignKey, CheckConstraint
-from sqlalchemy import String, Integer, Boolean, TIMESTAMP, Float
+from sqlalchemy import String, Integer, Boolean, TIMESTAMP, Float, DateTime, type_coerce
 from sqlalchemy.orm import relationship, sessionmaker, scoped_session, selectinload
 from sqlalchemy.orm.collections import InstrumentedList
 from sqlalchemy.ext.declarative import DeclarativeMeta
@@ -39,8 +42,9 @@ try:
     from sqlalchemy.orm import declarative_base
 except ImportError:
     from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.pool import StaticPool
-from sqlalchemy.sql.expression import and_, true, false, text, func, or_
+from sqlalchemy.pool import StaticPool, QueuePool
+from sqlalchemy.sql.expression import and_, true, false, text, func, or_, select, column, table
+from sqlalchemy.sql import operators
 from sqlalchemy.ext.associationproxy import association_proxy
 from .cw_login import current_user
 from flask_babel import gettext as _
@@ -48,12 +52,25 @@ from flask_babel import get_locale
 from flask import flash, g, Flask
 
 from . import logger, ub, isoLanguages
+from .category_index import get_category_index, CATEGORY_LANGUAGE
 from .epub_fts import get_epub_fts_index
-from .pagination import Pagination
+from .metadata_fts import get_metadata_fts_index
+from .pagination import Pagination, encode_cursor, decode_cursor
 from .string_helper import strip_whitespaces
 
 log = logger.create()
 
+# connections kept open, further ones are opened on demand up to the overflow (-1: no limit) and waited for up to
+# the timeout once the limit is reached. Streamed Kobo syncs keep their connection until the response is sent
+POOL_SIZE = 10
+POOL_MAX_OVERFLOW = -1
+POOL_TIMEOUT = 30
+
+# sort columns which are never NULL, pages sorted only by them can continue after the last row instead of an offset
+KEYSET_COLUMNS = {('books', 'id'), ('books', 'timestamp'), ('books', 'last_modified'), ('books', 'pubdate'),
+                  ('books', 'sort'), ('books', 'author_sort'), ('books', 'title'), ('books', 'series_index'),
+                  ('download_count', 'count')}
+
 cc_exceptions = ['composite', 'series']
 cc_classes = {}
 
@@ -89,6 +106,9 @@ books_publishers_link = Table('books_publishers_link', Base.metadata,
                               Column('publisher', Integer, ForeignKey('publishers.id'), primary_key=True)
                               )
 
+# temporary table of the selected books in the books table, created per connection by checkbox_sorted_page
+checkbox_order = table('checkbox_order', column('book', Integer), column('position', Integer))
+
 
 class Library_Id(Base):
     __tablename__ = 'library_id'
@@ -544,6 +564,22 @@ class CalibreDB:
     config = None
     config_calibre_dir = None
     app_db_path = None
+    # process wide engine for the attached calibre and app_settings databases
+    engine = None
+    engine_key = None
+    session_factory = None
+    engine_lock = threading.RLock()
+    pool_size = POOL_SIZE
+    pool_max_overflow = POOL_MAX_OVERFLOW
+    pool_timeout = POOL_TIMEOUT
+    pool_stats = {'connections_created': 0, 'checkouts': 0, 'engines_disposed': 0, 'library_changes': 0,
+                  'pool_exhausted': 0}
+    pool_stats_lock = threading.Lock()
+    # last seen state of metadata.db, used to detect external changes
+    library_state = None
+    # per user visibility filters built by common_filters
+    filter_cache = dict()
+    filter_cache_lock = threading.Lock()
 
     def __init__(self, _app: Flask=None):  # , expire_on_commit=True, init=False):
         """ Initialize a new CalibreDB session
@@ -665,6 +701,18 @@ class CalibreDB:
             g.lib_sql = self.connect()
         return g.lib_sql
 
+    @classmethod
+    def set_pool_limits(cls, pool_size, max_overflow, timeout):
+        cls.pool_size = pool_size
+        cls.pool_max_overflow = max_overflow
+        cls.pool_timeout = timeout
+
+    @classmethod
+    def _count_pool_stat(cls, name):
+        # the pool events are fired by the threads of all requests
+        with cls.pool_stats_lock:
+            cls.pool_stats[name] += 1
+
     @classmethod
     def update_config(cls, config, config_calibre_dir, app_db_path):
         cls.config = config
@@ -675,6 +723,68 @@ class CalibreDB:
     def connect(self):
         return self.setup_db(self.config_calibre_dir, self.app_db_path)
 
+    @staticmethod
+    def _db_signature(dbpath, app_db_path):
+        # A replaced (inode) or externally modified (mtime) metadata.db invalidates the pooled engine
+        stat_result = os.stat(dbpath)
+        return dbpath, app_db_path, stat_result.st_dev, stat_result.st_ino, stat_result.st_mtime_ns
+
+    @classmethod
+    def _create_engine(cls, dbpath, app_db_path):
+        metadata_fts = get_metadata_fts_index(app_db_path)
+        metadata_fts.ensure_schema()
+        engine = create_engine('sqlite://',
+                               echo=False,
+                               isolation_level="SERIALIZABLE",
+                               connect_args={'check_same_thread': False},
+                               poolclass=QueuePool,
+                               pool_size=cls.pool_size,
+                               max_overflow=cls.pool_max_overflow,
+                               pool_timeout=cls.pool_timeout,
+                               pool_pre_ping=False)
+
+        @event.listens_for(engine, "connect")
+        def _on_connect(dbapi_connection, __):
+            cursor = dbapi_connection.cursor()
+            try:
+                cursor.execute('PRAGMA cache_size = 10000;')
+                cursor.execute("attach database ? as calibre;", (dbpath,))
+                cursor.execute("attach database ? as app_settings;", (app_db_path,))
+                cursor.execute("attach database ? as metadata_fts;", (metadata_fts.db_path,))
+            finally:
+                cursor.close()
+            cls._count_pool_stat('connections_created')
+
+        @event.listens_for(engine, "checkout")
+        def _on_checkout(*__):
+            cls._count_pool_stat('checkouts')
+            if 0 <= cls.pool_max_overflow and engine.pool.checkedout() >= cls.pool_size + cls.pool_max_overflow:
+                cls._count_pool_stat('pool_exhausted')
+                log.warning("All {} calibre database connections are in use, further requests wait up to {} "
+                            "seconds".format(cls.pool_size + cls.pool_max_overflow, cls.pool_timeout))
+
+        return engine
+
+    @classmethod
+    def dispose_engine(cls):
+        with cls.engine_lock:
+            engine = cls.engine
+            cls.engine = None
+            cls.engine_key = None
+            cls.session_factory = None
+        if engine is not None:
+            engine.dispose()
+            cls._count_pool_stat('engines_disposed')
+
+    @classmethod
+    def get_pool_stats(cls):
+        with cls.pool_stats_lock:
+            stats = dict(cls.pool_stats)
+        checkouts = stats['checkouts']
+        stats['reuse_ratio'] = (1.0 - float(stats['connections_created']) / checkouts) if checkouts else 0.0
+        stats['checked_out'] = cls.engine.pool.checkedout() if cls.engine is not None else 0
+        return stats
+
     @classmethod
     def setup_db(cls, config_calibre_dir, app_db_path):
 
@@ -688,17 +798,24 @@ class CalibreDB:
             return None
 
         try:
-            engine = create_engine('sqlite://',
-                                       echo=False,
-                                       isolation_level="SERIALIZABLE",
-                                       connect_args={'check_same_thread': False},
-                                       poolclass=StaticPool)
-            with engine.begin() as connection:
-                connection.execute(text('PRAGMA cache_size = 10000;'))
-                connection.execute(text("attach database '{}' as calibre;".format(dbpath)))
-                connection.execute(text("attach database '{}' as app_settings;".format(app_db_path)))
-
-            conn = engine.connect()
+            engine_key = cls._db_signature(dbpath, app_db_path)
+            with cls.engine_lock:
+                if cls.engine is None or cls.engine_key != engine_key:
+                    old_engine = cls.engine
+                    engine = cls._create_engine(dbpath, app_db_path)
+                    # open first connection to verify the databases can be attached
+                    engine.connect().close()
+                    cls.engine = engine
+                    cls.engine_key = engine_key
+                    cls.session_factory = sessionmaker(autocommit=False,
+                                                       autoflush=False,
+                                                       bind=engine, future=True)
+                    if old_engine is not None:
+                        # checked out connections stay valid until their sessions are closed
+                        old_engine.dispose()
+                        cls._count_pool_stat('engines_disposed')
+                engine = cls.engine
+                session_factory = cls.session_factory
             # conn.text_factory = lambda b: b.decode(errors = 'ignore') possible fix for #1302
         except Exception as ex:
             cls.config.invalidate(ex)
@@ -708,15 +825,14 @@ class CalibreDB:
 
         if not cc_classes:
             try:
-                cc = conn.execute(text("SELECT id, datatype FROM custom_columns"))
-                cls.setup_db_cc_classes(cc)
+                with engine.connect() as conn:
+                    cc = conn.execute(text("SELECT id, datatype FROM custom_columns"))
+                    cls.setup_db_cc_classes(cc)
             except OperationalError as e:
                 log.error_or_exception(e)
                 return None
 
-        return scoped_session(sessionmaker(autocommit=False,
-                                           autoflush=False,
-                                           bind=engine, future=True))
+        return scoped_session(session_factory)
 
 
     def get_book(self, book_id):
@@ -764,14 +880,81 @@ class CalibreDB:
             self.session.rollback()
             log.error("Database error: {}".format(e))
 
+    @classmethod
+    def invalidate_filter_cache(cls, user_id=None):
+        with cls.filter_cache_lock:
+            if user_id is None:
+                cls.filter_cache.clear()
+            else:
+                cls.filter_cache.pop(int(user_id), None)
+
+    # Restrictions of the current user which determine the visible books, equal for users sharing them
+    def visibility_fingerprint(self):
+        return (current_user.filter_language(), current_user.denied_tags, current_user.allowed_tags,
+                current_user.allowed_column_value, current_user.denied_column_value,
+                self.config.config_restricted_column)
+
+    def _restriction_profile(self, allow_show_archived=False, return_all_languages=False):
+        # key of the books visible to the current user in the category index, the query listing them and the books
+        # archived by the user, which are left out per request so archive toggles don't build new profiles
+        archived_book_ids = ()
+        if not allow_show_archived:
+            archived_book_ids = [row[0] for row in ub.session.query(ub.ArchivedBook.book_id)
+                                 .filter(ub.ArchivedBook.user_id == int(current_user.id))
+                                 .filter(ub.ArchivedBook.is_archived == True)]
+        profile_key = (self.visibility_fingerprint(), return_all_languages)
+
+        def visible_books(book_ids):
+            query = self.session.query(Books.id).filter(self.common_filters(
+                allow_show_archived=True, return_all_languages=return_all_languages))
+            if book_ids is not None:
+                query = query.filter(Books.id.in_(book_ids))
+            return [row[0] for row in query]
+
+        return profile_key, visible_books, archived_book_ids
+
+    def category_counts(self, category, return_all_languages=False):
+        """Book counts, count of books without entry and first letters of a category for the books visible to the
+        current user, answered from the category index"""
+        profile_key, visible_books, archived_book_ids = self._restriction_profile(
+            return_all_languages=return_all_languages)
+        return get_category_index().lookup(self.session, category, profile_key, visible_books,
+                                           self.current_library_state(), archived_book_ids)
+
+    def random_books(self, count, config_read_column=0, allow_show_archived=False):
+        """Random visible books with archive and read state, sampled from the ids cached in the category index
+        instead of sorting all books randomly"""
+        profile_key, visible_books, archived_book_ids = self._restriction_profile(
+            allow_show_archived=allow_show_archived)
+        book_ids = get_category_index().sample(self.session, profile_key, visible_books, count,
+                                               self.current_library_state(), archived_book_ids)
+        if not book_ids:
+            return list()
+        entries = (self.generate_linked_query(config_read_column, Books)
+                   .filter(Books.id.in_(book_ids))
+                   .filter(self.common_filters(allow_show_archived))
+                   .all())
+        position = dict((book_id, index) for index, book_id in enumerate(book_ids))
+        entries.sort(key=lambda entry: position[entry.Books.id])
+        return self.order_authors(entries, True, True)
+
     # Language and content filters for displaying in the UI
     def common_filters(self, allow_show_archived=False, return_all_languages=False):
+        user_id = int(current_user.id)
+        # edited restrictions change the fingerprint, so stale entries are never returned
+        fingerprint = self.visibility_fingerprint()
+        key = (allow_show_archived, return_all_languages)
+        with self.filter_cache_lock:
+            cached = self.filter_cache.get(user_id)
+            if cached and cached[0] == fingerprint and key in cached[1]:
+                return cached[1][key]
+
+        cacheable = True
         if not allow_show_archived:
-            archived_books = (ub.session.query(ub.ArchivedBook)
-                              .filter(ub.ArchivedBook.user_id==int(current_user.id))
-                              .filter(ub.ArchivedBook.is_archived==True)
-                              .all())
-            archived_book_ids = [archived_book.book_id for archived_book in archived_books]
+            # evaluated by sqlite on every query, archive toggles need no cache invalidation
+            archived_book_ids = (select(ub.ArchivedBook.book_id)
+                                 .where(ub.ArchivedBook.user_id == user_id)
+                                 .where(ub.ArchivedBook.is_archived == True))
             archived_filter = Books.id.notin_(archived_book_ids)
         else:
             archived_filter = true()
@@ -795,6 +978,7 @@ class CalibreDB:
                     getattr(Books, 'custom_column_' + str(self.config.config_restricted_column)). \
                     any(cc_classes[self.config.config_restricted_column].value.in_(neg_cc_list))
             except (KeyError, AttributeError, IndexError):
+                cacheable = False
                 pos_content_cc_filter = false()
                 neg_content_cc_filter = true()
                 log.error("Custom Column No.{} does not exist in calibre database".format(
@@ -806,8 +990,16 @@ class CalibreDB:
         else:
             pos_content_cc_filter = true()
             neg_content_cc_filter = false()
-        return and_(lang_filter, pos_content_tags_filter, ~neg_content_tags_filter,
-                    pos_content_cc_filter, ~neg_content_cc_filter, archived_filter)
+        visibility_filter = and_(lang_filter, pos_content_tags_filter, ~neg_content_tags_filter,
+                                 pos_content_cc_filter, ~neg_content_cc_filter, archived_filter)
+        if cacheable:
+            with self.filter_cache_lock:
+                cached = self.filter_cache.get(user_id)
+                if not cached or cached[0] != fingerprint:
+                    cached = (fingerprint, dict())
+                    self.filter_cache[user_id] = cached
+                cached[1][key] = visibility_filter
+        return visibility_filter
 
     def generate_linked_query(self, config_read_column, database):
         if not config_read_column:
@@ -847,20 +1039,88 @@ class CalibreDB:
             outcome.reverse()
         return outcome[offset:offset + limit]
 
+    def checkbox_sorted_page(self, query, state, offset, limit, order):
+        """Same order as get_checkbox_sorted for a query of books, but sorted by sqlite: the selected ids are
+        written to a temporary table of the session connection and only the requested page is loaded"""
+        positions = dict()
+        for entry in state:
+            try:
+                positions.setdefault(int(entry), len(positions))
+            except (TypeError, ValueError):
+                pass
+        self.session.execute(text("CREATE TEMP TABLE IF NOT EXISTS checkbox_order "
+                                  "(book INTEGER PRIMARY KEY, position INTEGER NOT NULL)"))
+        self.session.execute(text("DELETE FROM checkbox_order"))
+        if positions:
+            self.session.execute(text("INSERT INTO checkbox_order(book, position) VALUES(:book, :position)"),
+                                 [{"book": book, "position": position} for book, position in positions.items()])
+        unselected = checkbox_order.c.position.is_(None)
+        if order == "asc":
+            order_by = [unselected.desc(), checkbox_order.c.position.desc(), Books.id.desc()]
+        else:
+            order_by = [unselected, checkbox_order.c.position, Books.id]
+        try:
+            return query.outerjoin(checkbox_order, checkbox_order.c.book == Books.id) \
+                .order_by(*order_by).offset(int(offset)).limit(int(limit)).all()
+        finally:
+            self.session.execute(text("DELETE FROM checkbox_order"))
+
     # Fill indexpage with all requested data from database
     def fill_indexpage(self, page, pagesize, database, db_filter, order,
-                       join_archive_read=False, config_read_column=0, *join):
+                       join_archive_read=False, config_read_column=0, *join, cursor=None, keyset=False,
+                       exact_count=True):
         return self.fill_indexpage_with_archived_books(page, database, pagesize, db_filter, order, False,
-                                                       join_archive_read, config_read_column, *join)
+                                                       join_archive_read, config_read_column, *join,
+                                                       cursor=cursor, keyset=keyset, exact_count=exact_count)
+
+    @staticmethod
+    def _keyset_columns(order):
+        # (column, descending) of an order made of plain columns, None if the order can't be continued from a row
+        columns = list()
+        for clause in order:
+            modifier = getattr(clause, 'modifier', None)
+            element = clause.element if modifier in (operators.asc_op, operators.desc_op) else clause
+            if hasattr(element, '__clause_element__'):
+                element = element.__clause_element__()
+            table = getattr(element, 'table', None)
+            if table is None or (getattr(table, 'name', None), getattr(element, 'name', None)) not in KEYSET_COLUMNS:
+                return None
+            columns.append((element, modifier is operators.desc_op))
+        if not any(col.table.name == 'books' and col.name == 'id' for col, __ in columns):
+            # the book id breaks ties, so every row has its own position
+            columns.append((Books.id.__clause_element__(), False))
+        return columns
+
+    @staticmethod
+    def _keyset_value(col):
+        # timestamps are compared as stored, python datetimes are not written in calibre's format
+        return type_coerce(col, String) if isinstance(col.type, DateTime) else col
+
+    def _keyset_filter(self, columns, values):
+        conditions = list()
+        for index, (col, descending) in enumerate(columns):
+            value = self._keyset_value(col)
+            clause = value < values[index] if descending else value > values[index]
+            conditions.append(and_(*([self._keyset_value(prev) == values[prev_index]
+                                      for prev_index, (prev, __) in enumerate(columns[:index])] + [clause])))
+        return or_(*conditions)
+
+    @staticmethod
+    def _keyset_signature(columns):
+        description = ",".join("{}.{}:{}".format(col.table.name, col.name, int(descending))
+                               for col, descending in columns)
+        return hashlib.sha1(description.encode("utf-8")).hexdigest()[:12]
 
     def fill_indexpage_with_archived_books(self, page, database, pagesize, db_filter, order, allow_show_archived,
-                                           join_archive_read, config_read_column, *join):
+                                           join_archive_read, config_read_column, *join, cursor=None, keyset=False,
+                                           exact_count=True):
+        """Returns one page of books, the random books and the pagination. With keyset the next page is
+        addressed by pagination.next_cursor if the order allows it, a cursor continues after the last row of the
+        previous page instead of skipping all rows before it. Without exact_count the total of a cursor is reused
+        instead of counting the matching books again"""
         pagesize = pagesize or self.config.config_books_per_page
         if current_user.show_detail_random():
-            random_query = self.generate_linked_query(config_read_column, database)
-            randm = (random_query.filter(self.common_filters(allow_show_archived))
-                     .order_by(func.random())
-                     .limit(self.config.config_random_books).all())
+            randm = self.random_books(self.config.config_random_books, config_read_column, allow_show_archived)
         else:
             randm = false()
         if join_archive_read:
@@ -888,9 +1148,35 @@ class CalibreDB:
             .filter(self.common_filters(allow_show_archived))
         entries = list()
         pagination = list()
+        columns = self._keyset_columns(order) if keyset else None
         try:
-            pagination = Pagination(page, pagesize, query.count())
-            entries = query.order_by(*order).offset(off).limit(pagesize).all()
+            if columns is None:
+                pagination = Pagination(page, pagesize, query.count())
+                entries = query.order_by(*order).offset(off).limit(pagesize).all()
+            else:
+                signature = self._keyset_signature(columns)
+                position = decode_cursor(cursor, signature) if cursor else None
+                if position is not None and len(position[0]) == len(columns) and not exact_count:
+                    total_count = position[1]
+                else:
+                    total_count = query.count()
+                if position is not None and len(position[0]) == len(columns):
+                    query = query.filter(self._keyset_filter(columns, position[0]))
+                    off = 0
+                query = (query.add_columns(*[self._keyset_value(col).label("keyset_{}".format(index))
+                                             for index, (col, __) in enumerate(columns)])
+                         .order_by(*(list(order) + [col.desc() if descending else col.asc()
+                                                    for col, descending in columns[len(order):]])))
+                rows = query.offset(off).limit(pagesize + 1).all()
+                next_cursor = None
+                if len(rows) > pagesize:
+                    rows = rows[:pagesize]
+                    values = list(rows[-1][-len(columns):])
+                    if None not in values:
+                        next_cursor = encode_cursor(signature, values, total_count)
+                pagination = Pagination(page, pagesize, total_count, next_cursor)
+                # the sort values stay appended to linked rows, they are accessed by name or leading index only
+                entries = rows if join_archive_read else [row[0] for row in rows]
         except Exception as ex:
             log.error_or_exception(ex)
         # display authors in right order
@@ -967,43 +1253,26 @@ class CalibreDB:
         term = strip_whitespaces(term).lower()
         self.create_functions()
 
-        # Try FTS5 search first for better performance
-        fts_ids = None
+        fts_filter = None
         epub_fts_ids = None
-        # Check if FTS5 table exists before attempting search
-        if not hasattr(self, '_fts_available'):
-            try:
-                result = self.session.execute(
-                    text("SELECT name FROM sqlite_master WHERE type='table' AND name='books_fts'")
-                ).fetchone()
-                self._fts_available = result is not None
-            except Exception:
-                self._fts_available = False
-
-        if self._fts_available:
-            try:
-                # Escape FTS5 special characters to prevent query errors
-                term_fts = term.replace('"', '""')
-                # Wrap in quotes for phrase matching and better accuracy
-                fts_results = self.session.execute(
-                    text("SELECT DISTINCT rowid FROM books_fts WHERE books_fts MATCH :term"),
-                    {"term": f'"{term_fts}"'}
-                ).fetchall()
-                if fts_results:
-                    fts_ids = [r[0] for r in fts_results]
-            except Exception as ex:
-                # FTS5 query failed, fall back to traditional search
-                log.debug("FTS5 search failed for term '{}', using fallback: {}".format(term, ex))
+        cc = self.get_cc_columns(config, filter_config_custom_read=True)
+        # index is maintained by TaskSyncMetadataFTS. Until it has synced the current set of custom columns and the
+        # latest changes of metadata.db the ilike search is used, the missing sync is queued
+        metadata_fts = get_metadata_fts_index(ub.app_DB_path)
+        if not (metadata_fts.is_ready(cc) and metadata_fts.is_current(self.current_library_state())):
+            # helper imports this module
+            from .helper import sync_metadata_fts_index
+            sync_metadata_fts_index()
+        else:
+            match = metadata_fts.build_match_query(term)
+            if match:
+                fts_filter = Books.id.in_(
+                    text("SELECT rowid FROM metadata_fts.books_fts WHERE books_fts MATCH :fts_term")
+                    .bindparams(fts_term=match).columns(column("rowid", Integer)))
 
         try:
-            epub_fts = get_epub_fts_index(ub.app_DB_path)
-            if epub_fts.should_sync():
-                epub_rows = (self.session.query(Books.id, Books.path, Data.name)
-                             .join(Data)
-                             .filter(func.lower(Data.format) == "epub")
-                             .all())
-                epub_fts.sync_from_rows(epub_rows, config.get_book_path())
-            epub_fts_ids = epub_fts.search(term)
+            # index is maintained by TaskSyncEpubFTS, searches only read it
+            epub_fts_ids = get_epub_fts_index(ub.app_DB_path).search(term)
         except Exception as ex:
             log.debug("EPUB FTS search failed for term '{}': {}".format(term, ex))
 
@@ -1023,11 +1292,10 @@ class CalibreDB:
         elif len(join) == 1:
             base_query = base_query.outerjoin(join[0])
 
-        # If FTS5 found results, use those IDs
-        if fts_ids:
+        if fts_filter is not None:
             if epub_fts_ids:
-                fts_ids = list(set(fts_ids + epub_fts_ids))
-            return base_query.filter(Books.id.in_(fts_ids))
+                return base_query.filter(or_(fts_filter, Books.id.in_(epub_fts_ids)))
+            return base_query.filter(fts_filter)
 
         # Fallback to traditional search with optimized subqueries
         author_terms = re.split("[, ]+", term)
@@ -1043,7 +1311,6 @@ class CalibreDB:
             author_subquery = author_subquery.filter(and_(*author_filters))
 
         # Build optimized filter expressions
-        cc = self.get_cc_columns(config, filter_config_custom_read=True)
         filter_expression = [
             Books.id.in_(self.session.query(books_tags_link.c.book).join(
                 Tags, books_tags_link.c.tag == Tags.id
@@ -1121,36 +1388,30 @@ class CalibreDB:
 
     # Creates for all stored languages a translated speaking name in the array for the UI
     def speaking_language(self, languages=None, return_all_languages=False, with_count=False, reverse_order=False):
-
+        locale = get_locale()
         if with_count:
-            if not languages:
-                languages = self.session.query(Languages, func.count('books_languages_link.book'))\
-                    .join(books_languages_link).join(Books)\
-                    .filter(self.common_filters(return_all_languages=return_all_languages)) \
-                    .group_by(text('books_languages_link.lang_code')).all()
             tags = list()
-            for lang in languages:
-                tag = Category(isoLanguages.get_language_name(get_locale(), lang[0].lang_code), lang[0].lang_code)
-                tags.append([tag, lang[1]])
+            counts = self.category_counts(CATEGORY_LANGUAGE, return_all_languages=return_all_languages)
+            if not languages:
+                languages = [(entry.item.name, entry.count) for entry in counts.entries]
+            else:
+                languages = [(lang[0].lang_code, lang[1]) for lang in languages]
+            for lang_code, count in languages:
+                tag = Category(isoLanguages.get_language_name(locale, lang_code), lang_code)
+                tags.append([tag, count])
             # Append all books without language to list
-            if not return_all_languages:
-                no_lang_count = (self.session.query(Books)
-                                 .outerjoin(books_languages_link).outerjoin(Languages)
-                                 .filter(Languages.lang_code==None)
-                                 .filter(self.common_filters())
-                                 .count())
-                if no_lang_count:
-                    tags.append([Category(_("None"), "none"), no_lang_count])
+            if not return_all_languages and counts.none_count:
+                tags.append([Category(_("None"), "none"), counts.none_count])
             return sorted(tags, key=lambda x: x[0].name.lower(), reverse=reverse_order)
         else:
             if not languages:
-                languages = self.session.query(Languages) \
-                    .join(books_languages_link) \
-                    .join(Books) \
-                    .filter(self.common_filters(return_all_languages=return_all_languages)) \
-                    .group_by(text('books_languages_link.lang_code')).all()
+                counts = self.category_counts(CATEGORY_LANGUAGE, return_all_languages=return_all_languages)
+                languages = [SpeakingLanguage(entry.item.id, entry.item.name,
+                                              isoLanguages.get_language_name(locale, entry.item.name))
+                             for entry in counts.entries]
+                return sorted(languages, key=lambda x: x.name, reverse=reverse_order)
             for lang in languages:
-                lang.name = isoLanguages.get_language_name(get_locale(), lang.lang_code)
+                lang.name = isoLanguages.get_language_name(locale, lang.lang_code)
             return sorted(languages, key=lambda x: x.name, reverse=reverse_order)
 
     def create_functions(self, config=None):
@@ -1178,11 +1439,44 @@ class CalibreDB:
         except sqliteOperationalError:
             pass
 
+    @staticmethod
+    def _library_state(config_calibre_dir):
+        # Every commit to metadata.db either rewrites the database file or appends to its write-ahead log
+        state = []
+        for file_name in ("metadata.db", "metadata.db-wal"):
+            try:
+                stat_result = os.stat(os.path.join(config_calibre_dir or "", file_name))
+                state.append((stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size))
+            except OSError:
+                state.append(None)
+        return tuple(state)
+
+    def current_library_state(self):
+        return self._library_state(self.config.config_calibre_dir)
+
     def reconnect_db(self, config, app_db_path):
-        # self.dispose()
-        # self.engine.dispose()
+        self.dispose_engine()
+        self.invalidate_filter_cache()
+        get_category_index().clear()
         self.setup_db(config.config_calibre_dir, app_db_path)
         self.update_config(config, config.config_calibre_dir, app_db_path)
+        CalibreDB.library_state = self._library_state(config.config_calibre_dir)
+
+    def reconnect_db_if_changed(self, config, app_db_path):
+        """Reconnects to the calibre database only if metadata.db was modified since the last check,
+        returns True if the database was reloaded"""
+        state = self._library_state(config.config_calibre_dir)
+        with self.engine_lock:
+            if CalibreDB.library_state is None:
+                CalibreDB.library_state = state
+                return False
+            if state == CalibreDB.library_state:
+                return False
+            CalibreDB.library_state = state
+            self._count_pool_stat('library_changes')
+        log.debug("Calibre database was modified, reloading")
+        self.reconnect_db(config, app_db_path)
+        return True
 
 
 def lcase(s):
@@ -1194,6 +1488,10 @@ def lcase(s):
         return s.lower()
 
 
+# language used by books, with its name in the current locale
+SpeakingLanguage = namedtuple('SpeakingLanguage', ['id', 'lang_code', 'name'])
+
+
 class Category:
     name = None
     id = None
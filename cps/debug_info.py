@@ -29,7 +29,7 @@ import os
 from flask import send_file
 
 from . import logger, config
-from .about import collect_stats
+from .about import collect_stats, collect_runtime_stats
 
 log = logger.create()
 
@@ -70,6 +70,7 @@ def send_debug():
     with zipfile.ZipFile(memory_zip, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
         zf.writestr('settings.txt', json.dumps(config.to_dict(), sort_keys=True, indent=2))
         zf.writestr('libs.txt', json.dumps(collect_stats(), sort_keys=True, indent=2, cls=lazyEncoder))
+        zf.writestr('runtime.txt', json.dumps(collect_runtime_stats(), indent=2, cls=lazyEncoder))
         for fp in file_list:
             zf.write(fp, os.path.basename(fp))
     memory_zip.seek(0)
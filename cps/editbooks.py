@@ -48,6 +48,7 @@ from .redirect import get_redirect_location
 from .file_helper import validate_mime_type
 from .usermanagement import user_login_required, login_required_if_no_ano
 from .string_helper import strip_whitespaces
+from .epub_layout import LAYOUT_FORMATS
 
 editbook = Blueprint('edit-book', __name__)
 log = logger.create()
@@ -155,6 +156,11 @@ def upload():
                 upload_text = N_("File %(file)s uploaded", file=link)
                 WorkerThread.add(current_user.name, TaskUpload(upload_text, escape(title)))
                 helper.add_book_to_thumbnail_cache(book_id)
+                helper.update_metadata_fts_index(book_id)
+                helper.update_category_index(book_id)
+                if meta.extension.lower() == ".epub":
+                    helper.update_epub_fts_index(book_id)
+                    helper.update_epub_layout_cache(book_id)
 
                 if len(request.files.getlist("btn-upload")) < 2:
                     if current_user.role_edit() or current_user.role_admin():
@@ -357,8 +363,9 @@ def edit_book_param(param, vals, multi=False):
                         out.append(ret)
                 else:
                     lang_names = list()
+                    locale = get_locale()
                     for lang in book.languages:
-                        lang_names.append(isoLanguages.get_language_name(get_locale(), lang.lang_code))
+                        lang_names.append(isoLanguages.get_language_name(locale, lang.lang_code))
                     ret = {"success":True,
                            "newValue":', '.join(lang_names)}
             elif param == 'author_sort':
@@ -435,6 +442,10 @@ def edit_book_param(param, vals, multi=False):
             if param == 'title' and vals.get('checkT') == False:
                 book.sort = sort_param
                 calibre_db.session.commit()
+            helper.update_metadata_fts_index(book.id)
+            helper.update_category_index(book.id)
+            if param in ['title', 'authors']:
+                helper.update_epub_fts_index(book.id)
         except (OperationalError, IntegrityError, StaleDataError, AttributeError) as e:
             calibre_db.session.rollback()
             log.error_or_exception("Database error: {}".format(e))
@@ -566,6 +577,8 @@ def merge_list_book():
                                                         element.uncompressed_size,
                                                         to_name))
                     check_delete_book([from_book.id], "", True)
+                    helper.update_category_index(to_book.id)
+                    helper.update_epub_layout_cache(to_book.id)
                     return make_response(jsonify(success=True))
     return ""
 
@@ -607,6 +620,10 @@ def table_xchange_author_title():
                 calibre_db.session.rollback()
                 log.error_or_exception("Database error: {}".format(e))
                 return make_response(jsonify(success=False))
+            if modify_date:
+                helper.update_metadata_fts_index(book.id)
+                helper.update_category_index(book.id)
+                helper.update_epub_fts_index(book.id)
 
             if config.config_use_google_drive:
                 gdriveutils.updateGdriveCalibreFromLocal()
@@ -733,6 +750,12 @@ def do_edit_book(book_id, upload_formats=None):
         calibre_db.session.commit()
         if config.config_use_google_drive:
             gdriveutils.updateGdriveCalibreFromLocal()
+        helper.update_metadata_fts_index(book.id)
+        helper.update_category_index(book.id)
+        if edited_books_id:
+            # book folder and file names follow title and author
+            helper.update_epub_fts_index(edited_books_id)
+            helper.update_epub_layout_cache(edited_books_id)
         if edit_error is not True and title_author_error is not True and cover_upload_success is not False:
             flash(_("Metadata successfully updated"), category="success")
 
@@ -1095,6 +1118,9 @@ def delete_book_from_UI(book_id, book_format, location=""):
                 if book_format.upper() in ['KEPUB', 'EPUB', 'EPUB3']:
                     kobo_sync_status.remove_synced_book(book.id, True)
             calibre_db.session.commit()
+            if not book_format:
+                helper.update_metadata_fts_index(book_id)
+            helper.update_category_index(book_id)
         except Exception as ex:
             log.error_or_exception(ex)
             calibre_db.session.rollback()
@@ -1118,6 +1144,8 @@ def delete_book_from_table(book_id):
                         "message": error}
             delete_whole_book(book_id, book)
             calibre_db.session.commit()
+            helper.update_metadata_fts_index(book_id)
+            helper.update_category_index(book_id)
             if error:
                 return {"location": url_for("edit-book.show_edit_book", book_id=book_id),
                            "type": "warning",
@@ -1147,8 +1175,9 @@ def render_edit_book(book_id):
               category="error")
         return redirect(url_for("web.index"))
 
+    locale = get_locale()
     for lang in book.languages:
-        lang.language_name = isoLanguages.get_language_name(get_locale(), lang.lang_code)
+        lang.language_name = isoLanguages.get_language_name(locale, lang.lang_code)
 
     book.authors = calibre_db.order_authors([book])
 
@@ -1480,6 +1509,10 @@ def upload_book_formats(requested_files, book, book_id, no_cover=True):
             link = '<a href="{}">{}</a>'.format(url_for('web.show_book', book_id=book.id), escape(book.title))
             upload_text = N_("File format %(ext)s added to %(book)s", ext=file_ext.upper(), book=link)
             WorkerThread.add(current_user.name, TaskUpload(upload_text, escape(book.title)))
+            if file_ext == "epub":
+                helper.update_epub_fts_index(book_id)
+            if file_ext.upper() in LAYOUT_FORMATS:
+                helper.update_epub_layout_cache(book_id)
             meta = uploader.process(
                 saved_filename,
                 *os.path.splitext(current_filename),
@@ -47,17 +47,15 @@ def _extract_cover(zip_file, cover_file, cover_path, tmp_file_name):
     return cover.cover_processing(tmp_file_name, cf, extension)
 
 
-def get_epub_layout(book, book_data):
-    file_path = os.path.normpath(os.path.join(config.get_book_path(),
-                                              book.path, book_data.name + "." + book_data.format.lower()))
-
+def read_epub_layout(file_path):
+    """rendition:layout of an EPUB file, None if it is reflowable or can't be read"""
     try:
         tree, __ = get_content_opf(file_path, default_ns)
         p = tree.xpath('/pkg:package/pkg:metadata', namespaces=default_ns)[0]
 
         layout = p.xpath('pkg:meta[@property="rendition:layout"]/text()', namespaces=default_ns)
-    except (etree.XMLSyntaxError, KeyError, IndexError, OSError, UnicodeDecodeError) as e:
-        log.error("Could not parse epub metadata of book {} during kobo sync: {}".format(book.id, e))
+    except (etree.XMLSyntaxError, KeyError, IndexError, OSError, UnicodeDecodeError, zipfile.BadZipFile) as e:
+        log.error("Could not parse epub metadata of {}: {}".format(file_path, e))
         layout = []
 
     if len(layout) == 0:
@@ -66,6 +64,12 @@ def get_epub_layout(book, book_data):
         return layout[0]
 
 
+def get_epub_layout(book, book_data):
+    file_path = os.path.normpath(os.path.join(config.get_book_path(),
+                                              book.path, book_data.name + "." + book_data.format.lower()))
+    return read_epub_layout(file_path)
+
+
 def get_epub_info(tmp_file_path, original_file_name, original_file_extension, no_cover_processing):
     ns = {
         'n': 'urn:oasis:names:tc:opendocument:xmlns:container',
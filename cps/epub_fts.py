@@ -9,10 +9,14 @@
 
 import os
 import posixpath
+import queue
 import re
 import sqlite3
 import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from urllib.request import pathname2url
 from zipfile import ZipFile, BadZipFile
 
 from lxml import etree
@@ -27,26 +31,27 @@ _NS = {
 }
 
 _CHUNK_SIZE = 4000
-_SYNC_INTERVAL_SECONDS = 300
+# books extracted but not yet written, per extraction worker
+_QUEUE_FACTOR = 4
+# commit after this many reindexed books, so an interrupted rebuild keeps its progress
+_CHECKPOINT_INTERVAL = 50
+# idle read-only connections kept for searches
+_READER_POOL_SIZE = 8
 
 
 class EpubFTSIndex:
     def __init__(self, app_db_path):
         settings_dir = os.path.dirname(app_db_path) if app_db_path else "."
         self._db_path = os.path.join(settings_dir, "epub_fts.db")
+        # serializes writers, readers use their own read-only connections and never wait for it
         self._lock = threading.Lock()
-        self._last_sync = 0
+        self._schema_ready = False
+        self._readers = queue.LifoQueue(maxsize=_READER_POOL_SIZE)
 
     @property
     def db_path(self):
         return self._db_path
 
-    def should_sync(self, force=False):
-        if force:
-            return True
-        now = datetime.utcnow().timestamp()
-        return (now - self._last_sync) >= _SYNC_INTERVAL_SECONDS
-
     def _connect(self):
         conn = sqlite3.connect(self._db_path)
         conn.execute("PRAGMA journal_mode=WAL")
@@ -70,7 +75,34 @@ class EpubFTSIndex:
             "tokenize='porter unicode61')"
         )
         conn.execute("CREATE INDEX IF NOT EXISTS idx_epub_fts_meta_path ON epub_fts_meta(file_path)")
+        conn.execute("CREATE TABLE IF NOT EXISTS epub_fts_state (key TEXT PRIMARY KEY, value TEXT)")
         conn.commit()
+        self._schema_ready = True
+
+    def _ensure_schema(self):
+        if not self._schema_ready:
+            with self._lock:
+                if not self._schema_ready:
+                    conn = self._connect()
+                    try:
+                        self._init_schema(conn)
+                    finally:
+                        conn.close()
+
+    def _acquire_reader(self):
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            # WAL mode lets read-only connections query while a sync is writing
+            conn = sqlite3.connect("file:{}?mode=ro".format(pathname2url(self._db_path)), uri=True,
+                                   check_same_thread=False)
+            return conn
+
+    def _release_reader(self, conn):
+        try:
+            self._readers.put_nowait(conn)
+        except queue.Full:
+            conn.close()
 
     def clear(self):
         with self._lock:
@@ -78,17 +110,19 @@ class EpubFTSIndex:
                 self._init_schema(conn)
                 conn.execute("DELETE FROM epub_fts")
                 conn.execute("DELETE FROM epub_fts_meta")
+                conn.execute("DELETE FROM epub_fts_state")
                 conn.commit()
-            self._last_sync = 0
 
     def get_stats(self):
-        with self._lock:
-            with self._connect() as conn:
-                self._init_schema(conn)
-                books_indexed = conn.execute("SELECT COUNT(*) FROM epub_fts_meta").fetchone()[0]
-                chunks_indexed = conn.execute("SELECT COUNT(*) FROM epub_fts").fetchone()[0]
-                total_chars = conn.execute("SELECT COALESCE(SUM(length(content)), 0) FROM epub_fts").fetchone()[0]
-                last_indexed = conn.execute("SELECT MAX(indexed_at) FROM epub_fts_meta").fetchone()[0]
+        self._ensure_schema()
+        conn = self._acquire_reader()
+        try:
+            books_indexed = conn.execute("SELECT COUNT(*) FROM epub_fts_meta").fetchone()[0]
+            chunks_indexed = conn.execute("SELECT COUNT(*) FROM epub_fts").fetchone()[0]
+            total_chars = conn.execute("SELECT COALESCE(SUM(length(content)), 0) FROM epub_fts").fetchone()[0]
+            last_indexed = conn.execute("SELECT MAX(indexed_at) FROM epub_fts_meta").fetchone()[0]
+        finally:
+            self._release_reader(conn)
 
         avg_chunks = 0.0
         if books_indexed:
@@ -115,91 +149,9 @@ class EpubFTSIndex:
             return ""
         return " ".join('"{}"'.format(token.replace('"', '""')) for token in tokens)
 
-    def _split_text(self, text):
-        text = re.sub(r"\s+", " ", text).strip()
-        if not text:
-            return []
-        chunks = []
-        start = 0
-        while start < len(text):
-            end = min(start + _CHUNK_SIZE, len(text))
-            if end < len(text):
-                split_at = text.rfind(" ", start, end)
-                if split_at > start:
-                    end = split_at
-            chunk = text[start:end].strip()
-            if chunk:
-                chunks.append(chunk)
-            start = end + 1
-        return chunks
-
-    def _extract_epub_sections(self, epub_file):
-        sections = []
-        try:
-            with ZipFile(epub_file) as epub_zip:
-                container = epub_zip.read("META-INF/container.xml")
-                container_tree = etree.fromstring(container)
-                opf_path = container_tree.xpath('n:rootfiles/n:rootfile/@full-path', namespaces=_NS)[0]
-
-                opf = epub_zip.read(opf_path)
-                opf_tree = etree.fromstring(opf)
-                opf_dir = posixpath.dirname(opf_path)
-
-                manifest = {}
-                for item in opf_tree.xpath('//pkg:manifest/pkg:item', namespaces=_NS):
-                    item_id = item.get("id")
-                    if not item_id:
-                        continue
-                    manifest[item_id] = (item.get("href", ""), item.get("media-type", ""))
-
-                spine = opf_tree.xpath('//pkg:spine/pkg:itemref', namespaces=_NS)
-                for itemref in spine:
-                    idref = itemref.get("idref")
-                    if not idref or idref not in manifest:
-                        continue
-                    href, media_type = manifest[idref]
-                    if not href:
-                        continue
-                    lower_href = href.lower()
-                    is_html = ("html" in media_type) or lower_href.endswith((".xhtml", ".html", ".htm"))
-                    if not is_html:
-                        continue
-
-                    content_path = posixpath.normpath(posixpath.join(opf_dir, href))
-                    try:
-                        html_content = epub_zip.read(content_path)
-                    except KeyError:
-                        continue
-
-                    parser = etree.HTMLParser(recover=True)
-                    tree = etree.fromstring(html_content, parser)
-                    if tree is None:
-                        continue
-
-                    for node in tree.xpath("//script|//style"):
-                        parent = node.getparent()
-                        if parent is not None:
-                            parent.remove(node)
-
-                    section_name = None
-                    for xpath in ("//title/text()", "//h1//text()", "//h2//text()"):
-                        title_text = tree.xpath(xpath)
-                        if title_text:
-                            section_name = re.sub(r"\s+", " ", title_text[0]).strip()
-                            if section_name:
-                                break
-                    if not section_name:
-                        section_name = posixpath.basename(content_path)
-
-                    text_content = " ".join(t.strip() for t in tree.xpath("//text()") if t and t.strip())
-                    for chunk in self._split_text(text_content):
-                        sections.append((section_name[:200], chunk))
-        except (BadZipFile, OSError, IOError, etree.XMLSyntaxError, IndexError) as ex:
-            log.debug("Unable to index EPUB '%s': %s", epub_file, ex)
-        return sections
-
-    def _reindex_book(self, conn, book_id, file_path, stat_result):
-        sections = self._extract_epub_sections(file_path)
+    def _reindex_book(self, conn, book_id, file_path, stat_result, sections=None):
+        if sections is None:
+            sections = extract_epub_sections(file_path)
         conn.execute("DELETE FROM epub_fts WHERE book_id = ?", (book_id,))
         if sections:
             conn.executemany(
@@ -212,69 +164,184 @@ class EpubFTSIndex:
             (book_id, file_path, stat_result.st_mtime, stat_result.st_size, datetime.utcnow().isoformat()),
         )
 
-    def sync_from_rows(self, rows, base_book_path, force=False, progress_callback=None):
-        now = datetime.utcnow().timestamp()
-        if not force and now - self._last_sync < _SYNC_INTERVAL_SECONDS:
-            return {"indexed": 0, "removed": 0, "seen": 0}
+    def _remove_book(self, conn, book_id):
+        conn.execute("DELETE FROM epub_fts WHERE book_id = ?", (book_id,))
+        conn.execute("DELETE FROM epub_fts_meta WHERE book_id = ?", (book_id,))
 
+    def _sync_row(self, conn, row, base_book_path, existing, force):
+        # returns 1 if the book was (re)indexed, -1 if it was removed and 0 if it is unchanged
+        book_id = int(row[0])
+        epub_path = os.path.join(base_book_path, row[1], row[2] + ".epub")
+        try:
+            stat_result = os.stat(epub_path)
+        except OSError:
+            self._remove_book(conn, book_id)
+            return -1
+
+        meta = existing.get(book_id)
+        if not force and meta is not None:
+            _, mtime, size = meta
+            if mtime == stat_result.st_mtime and size == stat_result.st_size:
+                return 0
+
+        self._reindex_book(conn, book_id, epub_path, stat_result)
+        return 1
+
+    def _get_state(self, conn, key):
+        row = conn.execute("SELECT value FROM epub_fts_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_state(self, conn, key, value):
+        if value is None:
+            conn.execute("DELETE FROM epub_fts_state WHERE key = ?", (key,))
+        else:
+            conn.execute("INSERT OR REPLACE INTO epub_fts_state(key, value) VALUES(?, ?)", (key, value))
+
+    @staticmethod
+    def _extract_stage(jobs, workers):
+        """Yields (job, sections) for (book_id, epub_path, stat_result) jobs, extraction runs in
+        a process pool if more than one worker is requested. At most workers * _QUEUE_FACTOR books are
+        in flight, results are returned in job order to the single writer"""
+        if workers <= 1:
+            for job in jobs:
+                yield job, extract_epub_sections(job[1])
+            return
+        pending = deque()
+        executor = ProcessPoolExecutor(max_workers=workers)
+        try:
+            for job in jobs:
+                pending.append((job, executor.submit(extract_epub_sections, job[1])))
+                if len(pending) >= workers * _QUEUE_FACTOR:
+                    done_job, future = pending.popleft()
+                    yield done_job, future.result()
+            while pending:
+                done_job, future = pending.popleft()
+                yield done_job, future.result()
+        finally:
+            for __, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def sync_from_rows(self, rows, base_book_path, force=False, progress_callback=None, should_stop=None,
+                       workers=1):
+        """Syncs the index with all epub rows (book_id, path, name). A forced rebuild is checkpointed,
+        rerunning it after an interruption continues with the books not reindexed so far"""
         with self._lock:
-            now = datetime.utcnow().timestamp()
-            if not force and now - self._last_sync < _SYNC_INTERVAL_SECONDS:
-                return {"indexed": 0, "removed": 0, "seen": 0}
-
             with self._connect() as conn:
                 self._init_schema(conn)
                 existing = {
                     row[0]: row[1:]
                     for row in conn.execute(
-                        "SELECT book_id, file_path, file_mtime, file_size FROM epub_fts_meta"
+                        "SELECT book_id, file_path, file_mtime, file_size, indexed_at FROM epub_fts_meta"
                     ).fetchall()
                 }
+                rebuild_started = None
+                if force:
+                    rebuild_started = self._get_state(conn, "rebuild_started")
+                    if rebuild_started:
+                        log.info("Resuming EPUB full-text index rebuild started at %s", rebuild_started)
+                    else:
+                        rebuild_started = datetime.utcnow().isoformat()
+                        self._set_state(conn, "rebuild_started", rebuild_started)
+                        conn.commit()
+
                 seen_ids = set()
-                indexed_count = 0
-                removed_count = 0
+                counter = {"processed": 0, "indexed": 0, "removed": 0, "bytes": 0}
                 total_rows = len(rows)
-                processed_count = 0
-
-                for row in rows:
-                    book_id = int(row[0])
-                    book_rel_path = row[1]
-                    book_name = row[2]
-                    epub_path = os.path.join(base_book_path, book_rel_path, book_name + ".epub")
-                    seen_ids.add(book_id)
-                    processed_count += 1
-
-                    try:
-                        stat_result = os.stat(epub_path)
-                    except OSError:
-                        conn.execute("DELETE FROM epub_fts WHERE book_id = ?", (book_id,))
-                        conn.execute("DELETE FROM epub_fts_meta WHERE book_id = ?", (book_id,))
-                        removed_count += 1
-                        if progress_callback:
-                            progress_callback(processed_count, total_rows, indexed_count, removed_count)
-                        continue
-
-                    meta = existing.get(book_id)
-                    if not force and meta is not None:
-                        _, mtime, size = meta
-                        if mtime == stat_result.st_mtime and size == stat_result.st_size:
-                            if progress_callback:
-                                progress_callback(processed_count, total_rows, indexed_count, removed_count)
-                            continue
+                stopped = False
 
-                    self._reindex_book(conn, book_id, epub_path, stat_result)
-                    indexed_count += 1
+                def report():
                     if progress_callback:
-                        progress_callback(processed_count, total_rows, indexed_count, removed_count)
+                        progress_callback(counter["processed"], total_rows, counter["indexed"],
+                                          counter["removed"], counter["bytes"])
+
+                def reindex_jobs():
+                    # stat and compare in the writer, only changed books are handed to the extraction stage
+                    for row in rows:
+                        if should_stop and should_stop():
+                            return
+                        book_id = int(row[0])
+                        seen_ids.add(book_id)
+                        epub_path = os.path.join(base_book_path, row[1], row[2] + ".epub")
+                        try:
+                            stat_result = os.stat(epub_path)
+                        except OSError:
+                            self._remove_book(conn, book_id)
+                            counter["processed"] += 1
+                            counter["removed"] += 1
+                            report()
+                            continue
+                        meta = existing.get(book_id)
+                        if meta is not None:
+                            _, mtime, size, indexed_at = meta
+                            unchanged = mtime == stat_result.st_mtime and size == stat_result.st_size
+                            if unchanged and (not force or indexed_at >= rebuild_started):
+                                counter["processed"] += 1
+                                report()
+                                continue
+                        yield book_id, epub_path, stat_result
+
+                extracted = self._extract_stage(reindex_jobs(), workers)
+                try:
+                    for (book_id, epub_path, stat_result), sections in extracted:
+                        self._reindex_book(conn, book_id, epub_path, stat_result, sections)
+                        counter["processed"] += 1
+                        counter["indexed"] += 1
+                        counter["bytes"] += stat_result.st_size
+                        if counter["indexed"] % _CHECKPOINT_INTERVAL == 0:
+                            conn.commit()
+                        report()
+                        if should_stop and should_stop():
+                            break
+                finally:
+                    extracted.close()
+                stopped = bool(should_stop and should_stop())
+
+                # an interrupted sync has not seen all books, so nothing can be considered stale
+                if not stopped:
+                    stale_ids = [book_id for book_id in existing if book_id not in seen_ids]
+                    if stale_ids:
+                        conn.executemany("DELETE FROM epub_fts WHERE book_id = ?",
+                                         [(book_id,) for book_id in stale_ids])
+                        conn.executemany("DELETE FROM epub_fts_meta WHERE book_id = ?",
+                                         [(book_id,) for book_id in stale_ids])
+                        counter["removed"] += len(stale_ids)
+                    if force:
+                        self._set_state(conn, "rebuild_started", None)
 
-                stale_ids = [book_id for book_id in existing if book_id not in seen_ids]
-                if stale_ids:
-                    conn.executemany("DELETE FROM epub_fts WHERE book_id = ?", [(book_id,) for book_id in stale_ids])
-                    conn.executemany("DELETE FROM epub_fts_meta WHERE book_id = ?", [(book_id,) for book_id in stale_ids])
-                    removed_count += len(stale_ids)
+                conn.commit()
+                return {"indexed": counter["indexed"], "removed": counter["removed"], "seen": len(seen_ids),
+                        "bytes": counter["bytes"]}
 
+    def sync_books(self, book_ids, rows, base_book_path):
+        """Incremental sync of the given books, rows holds the epub formats still present for them"""
+        with self._lock:
+            with self._connect() as conn:
+                self._init_schema(conn)
+                book_ids = set(int(book_id) for book_id in book_ids)
+                existing = {
+                    row[0]: row[1:]
+                    for row in conn.execute(
+                        "SELECT book_id, file_path, file_mtime, file_size FROM epub_fts_meta WHERE book_id IN ({})"
+                        .format(",".join("?" * len(book_ids))), tuple(book_ids)
+                    ).fetchall()
+                } if book_ids else {}
+                indexed_count = 0
+                removed_count = 0
+                seen_ids = set()
+                for row in rows:
+                    seen_ids.add(int(row[0]))
+                    outcome = self._sync_row(conn, row, base_book_path, existing, False)
+                    if outcome > 0:
+                        indexed_count += 1
+                    elif outcome < 0:
+                        removed_count += 1
+                # deleted books or removed epub formats
+                for book_id in book_ids - seen_ids:
+                    if book_id in existing:
+                        self._remove_book(conn, book_id)
+                        removed_count += 1
                 conn.commit()
-                self._last_sync = now
                 return {"indexed": indexed_count, "removed": removed_count, "seen": len(seen_ids)}
 
     def search(self, term, limit=1000):
@@ -286,27 +353,29 @@ class EpubFTSIndex:
         if not query:
             return []
 
-        with self._lock:
-            with self._connect() as conn:
-                self._init_schema(conn)
-                sql = (
-                    "SELECT book_id, section, "
-                    "snippet(epub_fts, 2, '[', ']', ' ... ', 18) AS snippet_text, "
-                    "bm25(epub_fts) AS rank "
-                    "FROM epub_fts WHERE epub_fts MATCH ? "
-                    "ORDER BY rank LIMIT ?"
-                )
-                fetch_limit = max(int(limit) * 6, int(limit))
+        self._ensure_schema()
+        sql = (
+            "SELECT book_id, section, "
+            "snippet(epub_fts, 2, '[', ']', ' ... ', 18) AS snippet_text, "
+            "bm25(epub_fts) AS rank "
+            "FROM epub_fts WHERE epub_fts MATCH ? "
+            "ORDER BY rank LIMIT ?"
+        )
+        fetch_limit = max(int(limit) * 6, int(limit))
+        conn = self._acquire_reader()
+        try:
+            try:
+                rows = conn.execute(sql, (query, fetch_limit)).fetchall()
+            except sqlite3.OperationalError:
+                fallback = self._build_match_query(term)
+                if not fallback:
+                    return []
                 try:
-                    rows = conn.execute(sql, (query, fetch_limit)).fetchall()
+                    rows = conn.execute(sql, (fallback, fetch_limit)).fetchall()
                 except sqlite3.OperationalError:
-                    fallback = self._build_match_query(term)
-                    if not fallback:
-                        return []
-                    try:
-                        rows = conn.execute(sql, (fallback, fetch_limit)).fetchall()
-                    except sqlite3.OperationalError:
-                        return []
+                    return []
+        finally:
+            self._release_reader(conn)
 
         results = []
         seen = set()
@@ -325,6 +394,92 @@ class EpubFTSIndex:
         return results
 
 
+def split_text(text):
+    text = re.sub(r"\s+", " ", text).strip()
+    if not text:
+        return []
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + _CHUNK_SIZE, len(text))
+        if end < len(text):
+            split_at = text.rfind(" ", start, end)
+            if split_at > start:
+                end = split_at
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        start = end + 1
+    return chunks
+
+
+def extract_epub_sections(epub_file):
+    # module level so it can be pickled into worker processes
+    sections = []
+    try:
+        with ZipFile(epub_file) as epub_zip:
+            container = epub_zip.read("META-INF/container.xml")
+            container_tree = etree.fromstring(container)
+            opf_path = container_tree.xpath('n:rootfiles/n:rootfile/@full-path', namespaces=_NS)[0]
+
+            opf = epub_zip.read(opf_path)
+            opf_tree = etree.fromstring(opf)
+            opf_dir = posixpath.dirname(opf_path)
+
+            manifest = {}
+            for item in opf_tree.xpath('//pkg:manifest/pkg:item', namespaces=_NS):
+                item_id = item.get("id")
+                if not item_id:
+                    continue
+                manifest[item_id] = (item.get("href", ""), item.get("media-type", ""))
+
+            spine = opf_tree.xpath('//pkg:spine/pkg:itemref', namespaces=_NS)
+            for itemref in spine:
+                idref = itemref.get("idref")
+                if not idref or idref not in manifest:
+                    continue
+                href, media_type = manifest[idref]
+                if not href:
+                    continue
+                lower_href = href.lower()
+                is_html = ("html" in media_type) or lower_href.endswith((".xhtml", ".html", ".htm"))
+                if not is_html:
+                    continue
+
+                content_path = posixpath.normpath(posixpath.join(opf_dir, href))
+                try:
+                    html_content = epub_zip.read(content_path)
+                except KeyError:
+                    continue
+
+                parser = etree.HTMLParser(recover=True)
+                tree = etree.fromstring(html_content, parser)
+                if tree is None:
+                    continue
+
+                for node in tree.xpath("//script|//style"):
+                    parent = node.getparent()
+                    if parent is not None:
+                        parent.remove(node)
+
+                section_name = None
+                for xpath in ("//title/text()", "//h1//text()", "//h2//text()"):
+                    title_text = tree.xpath(xpath)
+                    if title_text:
+                        section_name = re.sub(r"\s+", " ", title_text[0]).strip()
+                        if section_name:
+                            break
+                if not section_name:
+                    section_name = posixpath.basename(content_path)
+
+                text_content = " ".join(t.strip() for t in tree.xpath("//text()") if t and t.strip())
+                for chunk in split_text(text_content):
+                    sections.append((section_name[:200], chunk))
+    except (BadZipFile, OSError, IOError, etree.XMLSyntaxError, IndexError) as ex:
+        log.debug("Unable to index EPUB '%s': %s", epub_file, ex)
+    return sections
+
+
 def strip_search_term(term):
     return re.sub(r"\s+", " ", str(term or "").strip())
 
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sqlite3
+import threading
+from urllib.request import pathname2url
+
+from . import logger
+
+log = logger.create()
+
+# formats whose rendition layout is reported to Kobo devices
+LAYOUT_FORMATS = ('EPUB', 'KEPUB')
+# rows written per transaction
+_BATCH_SIZE = 500
+
+
+class EpubLayoutCache:
+    """rendition:layout of the EPUB and KEPUB files of all books, stored in a sidecar database next to app.db.
+    An entry is valid as long as mtime and size of the file are unchanged, Kobo sync only reads it and never opens
+    book files. The entries are written by TaskSyncEpubLayout"""
+    def __init__(self, app_db_path):
+        settings_dir = os.path.dirname(app_db_path) if app_db_path else "."
+        self._db_path = os.path.join(settings_dir, "epub_layout.db")
+        # held for schema setup and writes only, never while files are parsed
+        self._lock = threading.Lock()
+        self._warm_lock = threading.Lock()
+        self._schema_ready = False
+        self._warm_pending = False
+        self.stats = {'hits': 0, 'misses': 0}
+
+    @property
+    def db_path(self):
+        return self._db_path
+
+    def _connect(self):
+        conn = sqlite3.connect(self._db_path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _init_schema(self, conn):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS epub_layout ("
+            "book_id INTEGER NOT NULL, "
+            "format TEXT NOT NULL, "
+            "file_mtime REAL NOT NULL, "
+            "file_size INTEGER NOT NULL, "
+            "layout TEXT, "
+            "PRIMARY KEY (book_id, format))"
+        )
+        conn.commit()
+        self._schema_ready = True
+
+    def ensure_schema(self):
+        if not self._schema_ready:
+            with self._lock:
+                if not self._schema_ready:
+                    conn = self._connect()
+                    try:
+                        self._init_schema(conn)
+                    finally:
+                        conn.close()
+
+    def open_reader(self):
+        """Read-only connection for a series of lookups, it has to be closed by the caller"""
+        self.ensure_schema()
+        return sqlite3.connect("file:{}?mode=ro".format(pathname2url(self._db_path)), uri=True)
+
+    def lookup(self, conn, book_id, book_format, file_path):
+        """Returns (known, layout). The file is only checked with stat, an entry for a changed or not yet seen
+        file is unknown"""
+        try:
+            stat_result = os.stat(file_path)
+        except OSError:
+            # nothing to sync for a missing file, no reason to warm the cache for it
+            return True, None
+        row = conn.execute("SELECT file_mtime, file_size, layout FROM epub_layout WHERE book_id = ? AND format = ?",
+                           (int(book_id), book_format.upper())).fetchone()
+        if row and row[0] == stat_result.st_mtime and row[1] == stat_result.st_size:
+            self.stats['hits'] += 1
+            return True, row[2]
+        self.stats['misses'] += 1
+        return False, None
+
+    def update(self, book_id, book_format, file_path, read_layout):
+        """Reads the layout of a file with read_layout(file_path), stores and returns it"""
+        try:
+            stat_result = os.stat(file_path)
+        except OSError:
+            return None
+        layout = read_layout(file_path)
+        self.ensure_schema()
+        with self._lock:
+            conn = self._connect()
+            try:
+                self._write(conn, [(int(book_id), book_format.upper(), stat_result.st_mtime, stat_result.st_size,
+                                    layout)])
+            finally:
+                conn.close()
+        return layout
+
+    def claim_warm(self):
+        """True if no warm up is pending, the caller has to queue one then"""
+        with self._warm_lock:
+            if self._warm_pending:
+                return False
+            self._warm_pending = True
+            return True
+
+    def warm_done(self):
+        with self._warm_lock:
+            self._warm_pending = False
+
+    def sync_from_rows(self, rows, base_book_path, read_layout, book_ids=None, should_stop=None):
+        """Updates the entries from (book_id, path, name, format) rows, read_layout(file_path) is only called for
+        new or changed files. Entries not in rows are removed, limited to book_ids unless it is None"""
+        updated = removed = 0
+        self.ensure_schema()
+        conn = self._connect()
+        try:
+            if book_ids is None:
+                existing = conn.execute("SELECT book_id, format, file_mtime, file_size FROM epub_layout")
+            else:
+                book_ids = [int(book_id) for book_id in book_ids]
+                existing = conn.execute("SELECT book_id, format, file_mtime, file_size FROM epub_layout "
+                                        "WHERE book_id IN ({})".format(",".join("?" * len(book_ids))),
+                                        book_ids)
+            existing = dict(((row[0], row[1]), row[2:]) for row in existing.fetchall())
+            batch = list()
+            for book_id, book_path, name, book_format in rows:
+                if should_stop and should_stop():
+                    break
+                key = (int(book_id), book_format.upper())
+                stored = existing.pop(key, None)
+                file_path = os.path.join(base_book_path, book_path, name + "." + book_format.lower())
+                try:
+                    stat_result = os.stat(file_path)
+                except OSError:
+                    if stored is not None:
+                        existing[key] = stored
+                    continue
+                if stored and stored[0] == stat_result.st_mtime and stored[1] == stat_result.st_size:
+                    continue
+                batch.append(key + (stat_result.st_mtime, stat_result.st_size, read_layout(file_path)))
+                if len(batch) >= _BATCH_SIZE:
+                    updated += self._locked_write(conn, batch)
+                    batch = list()
+            updated += self._locked_write(conn, batch)
+            if not (should_stop and should_stop()):
+                with self._lock:
+                    conn.executemany("DELETE FROM epub_layout WHERE book_id = ? AND format = ?", list(existing))
+                    conn.commit()
+                removed = len(existing)
+        finally:
+            conn.close()
+        return {"updated": updated, "removed": removed}
+
+    def _locked_write(self, conn, batch):
+        with self._lock:
+            return self._write(conn, batch)
+
+    @staticmethod
+    def _write(conn, batch):
+        conn.executemany("INSERT OR REPLACE INTO epub_layout(book_id, format, file_mtime, file_size, layout) "
+                         "VALUES(?, ?, ?, ?, ?)", batch)
+        conn.commit()
+        return len(batch)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        try:
+            conn = self.open_reader()
+            try:
+                stats['entries'] = conn.execute("SELECT COUNT(*) FROM epub_layout").fetchone()[0]
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            stats['entries'] = 0
+        return stats
+
+
+_instance = None
+_instance_lock = threading.Lock()
+
+
+def get_epub_layout_cache(app_db_path):
+    global _instance
+    with _instance_lock:
+        if _instance is None:
+            _instance = EpubLayoutCache(app_db_path)
+        return _instance
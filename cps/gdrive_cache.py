@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+from collections import OrderedDict
+
+# resolved folder paths kept in memory, the least recently used one is dropped first
+GDRIVE_FOLDER_CACHE_SIZE = 10000
+# file metadata kept in memory
+GDRIVE_FILE_CACHE_SIZE = 20000
+# seconds an entry is used, changes done on Google Drive without watch notifications show up after it
+GDRIVE_CACHE_TTL = 300
+
+
+class DriveLookupCache:
+    """In-memory tier in front of gdrive.db and the Drive API: folder path -> folder id and
+    (folder id, title) -> file. For folders whose children were listed at once, a title not in the cache is known
+    to be missing. Entries are dropped on change notifications and on changes done by Calibre-Web"""
+    def __init__(self, max_folders=GDRIVE_FOLDER_CACHE_SIZE, max_files=GDRIVE_FILE_CACHE_SIZE, ttl=GDRIVE_CACHE_TTL):
+        self.max_folders = max_folders
+        self.max_files = max_files
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._folders = OrderedDict()
+        # (folder id, lower case title) -> (expires, [files])
+        self._files = OrderedDict()
+        # folder id -> expiry of its complete listing
+        self._listed = dict()
+        self.stats = {'hits': 0, 'misses': 0, 'listings': 0, 'invalidations': 0}
+
+    @staticmethod
+    def _path_key(path):
+        return path if path.endswith('/') else path + '/'
+
+    def get_folder_id(self, path):
+        key = self._path_key(path)
+        with self._lock:
+            entry = self._folders.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._folders.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return entry[1]
+                del self._folders[key]
+            self.stats['misses'] += 1
+            return None
+
+    def set_folder_id(self, path, folder_id):
+        key = self._path_key(path)
+        with self._lock:
+            self._folders[key] = (time.monotonic() + self.ttl, folder_id)
+            self._folders.move_to_end(key)
+            while len(self._folders) > self.max_folders:
+                self._folders.popitem(last=False)
+
+    def get_file(self, folder_id, title, nocase=False):
+        """Returns (known, file), known is False if the Drive has to be asked"""
+        key = (folder_id, title.lower())
+        now = time.monotonic()
+        with self._lock:
+            entry = self._files.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._files[key]
+                entry = None
+            if entry is not None:
+                self._files.move_to_end(key)
+                for drive_file in entry[1]:
+                    if nocase or drive_file['title'] == title:
+                        self.stats['hits'] += 1
+                        return True, drive_file
+            if self._listed.get(folder_id, 0) > now:
+                # complete listing, the file doesn't exist
+                self.stats['hits'] += 1
+                return True, None
+            self.stats['misses'] += 1
+            return False, None
+
+    def set_file(self, folder_id, drive_file):
+        with self._lock:
+            self._add_file(folder_id, drive_file, time.monotonic() + self.ttl)
+            self._trim()
+
+    def store_listing(self, folder_id, drive_files):
+        """Stores all children of a folder, titles not among them are known to be missing until the entries expire"""
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            self.stats['listings'] += 1
+            for key in [key for key in self._files if key[0] == folder_id]:
+                del self._files[key]
+            for drive_file in drive_files:
+                self._add_file(folder_id, drive_file, expires)
+            self._listed[folder_id] = expires
+            self._trim()
+
+    def _add_file(self, folder_id, drive_file, expires):
+        key = (folder_id, drive_file['title'].lower())
+        entry = self._files.get(key)
+        files = [f for f in entry[1] if f['id'] != drive_file['id']] if entry is not None else []
+        files.append(drive_file)
+        self._files[key] = (expires, files)
+        self._files.move_to_end(key)
+
+    def _trim(self):
+        while len(self._files) > self.max_files:
+            (folder_id, __), __ = self._files.popitem(last=False)
+            # the listing of the folder is incomplete now
+            self._listed.pop(folder_id, None)
+
+    def invalidate(self, file_id=None, parent_ids=()):
+        """Drops the entries of a changed file or folder and the listings of its parent folders. Without ids
+        everything is dropped"""
+        with self._lock:
+            self.stats['invalidations'] += 1
+            if file_id is None and not parent_ids:
+                self._folders.clear()
+                self._files.clear()
+                self._listed.clear()
+                return
+            for folder_id in parent_ids:
+                self._listed.pop(folder_id, None)
+            if file_id is None:
+                return
+            for key, (__, files) in list(self._files.items()):
+                if key[0] == file_id or any(f['id'] == file_id for f in files):
+                    del self._files[key]
+                    self._listed.pop(key[0], None)
+            self._listed.pop(file_id, None)
+            # paths of a moved or renamed folder and of everything below it
+            paths = [path for path, (__, folder_id) in self._folders.items() if folder_id == file_id]
+            for path in list(self._folders):
+                if any(path.startswith(prefix) for prefix in paths):
+                    del self._folders[path]
+
+    def clear(self):
+        self.invalidate()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['folders'] = len(self._folders)
+            stats['files'] = len(self._files)
+        return stats
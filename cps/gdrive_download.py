@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import codecs
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import chardet
+
+from . import logger
+
+log = logger.create()
+
+# bytes per Range request
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Range requests running at the same time, ahead of the chunk currently sent
+DOWNLOAD_RANGES_IN_FLIGHT = 4
+# disk space of the recently served files
+DOWNLOAD_CACHE_SIZE = 1024 * 1024 * 1024
+_PART_SUFFIX = ".part"
+
+
+class DownloadError(Exception):
+    pass
+
+
+def _fetch_range(get_http, url, start, end):
+    # every request gets its own Http object, they are not thread safe
+    resp, content = get_http().request(url, headers={"Range": 'bytes={}-{}'.format(start, end)})
+    if resp.status != 206:
+        raise DownloadError('An error occurred: {}'.format(resp))
+    return content
+
+
+def fetch_ranges(get_http, url, total_size, chunk_size=DOWNLOAD_CHUNK_SIZE, in_flight=DOWNLOAD_RANGES_IN_FLIGHT):
+    """Yields the content of a Drive file in order, up to in_flight Range requests are running at a time"""
+    ranges = [(start, min(total_size, start + chunk_size) - 1) for start in range(0, total_size, chunk_size)]
+    if in_flight <= 1:
+        for start, end in ranges:
+            yield _fetch_range(get_http, url, start, end)
+        return
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=in_flight)
+    try:
+        for start, end in ranges:
+            pending.append(executor.submit(_fetch_range, get_http, url, start, end))
+            if len(pending) >= in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+class Utf8Converter:
+    """Converts a text file to utf-8 chunk by chunk. The encoding is detected once on the start of the file and
+    characters split between chunks are decoded as a whole"""
+    def __init__(self, sample_size=DOWNLOAD_CHUNK_SIZE):
+        self.sample_size = sample_size
+        self.encoding = None
+        self._decoder = None
+        self._sample = b""
+
+    def feed(self, data, final=False):
+        if self._decoder is None:
+            self._sample += data
+            if len(self._sample) < self.sample_size and not final:
+                return b""
+            encoding = chardet.detect(self._sample[:self.sample_size])['encoding'] or 'utf-8'
+            # a file starting with plain ascii can contain other characters later
+            self.encoding = 'utf-8' if encoding.lower() == 'ascii' else encoding
+            self._decoder = codecs.getincrementaldecoder(self.encoding)(errors='replace')
+            data, self._sample = self._sample, b""
+        return self._decoder.decode(data, final).encode('utf-8')
+
+
+class DriveFileCache:
+    """Recently served Drive files on disk, keyed by file id and content version. The least recently served files
+    are deleted once the size limit is exceeded. Files are only added after they were downloaded completely"""
+    def __init__(self, cache_dir, max_bytes=DOWNLOAD_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = None
+        self._bytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    @staticmethod
+    def _name(file_id, version):
+        return hashlib.sha1("{}:{}".format(file_id, version).encode("utf-8")).hexdigest()
+
+    def _load(self):
+        # entries of earlier runs, oldest first
+        if self._entries is not None:
+            return
+        self._entries = OrderedDict()
+        self._bytes = 0
+        files = list()
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                if name.endswith(_PART_SUFFIX):
+                    # interrupted download
+                    os.remove(path)
+                    continue
+                stat_result = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat_result.st_mtime, name, stat_result.st_size))
+        for __, name, size in sorted(files):
+            self._entries[name] = size
+            self._bytes += size
+
+    def open(self, file_id, version):
+        """Returns the opened cached file, None if it isn't cached"""
+        name = self._name(file_id, version)
+        with self._lock:
+            self._load()
+            if name in self._entries:
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    cached = open(path, "rb")
+                    os.utime(path)
+                except OSError:
+                    self._bytes -= self._entries.pop(name)
+                else:
+                    self._entries.move_to_end(name)
+                    self.stats['hits'] += 1
+                    return cached
+            self.stats['misses'] += 1
+            return None
+
+    def writer(self, file_id, version, size):
+        """Returns a _CacheWriter for a file which is downloaded now, None if it is too large to be cached"""
+        if size > self.max_bytes:
+            return None
+        return _CacheWriter(self, self._name(file_id, version), size)
+
+    def _add(self, name, part_path, size):
+        with self._lock:
+            self._load()
+            os.replace(part_path, os.path.join(self.cache_dir, name))
+            self._bytes -= self._entries.pop(name, 0)
+            self._entries[name] = size
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                evicted, evicted_size = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.stats['evictions'] += 1
+                try:
+                    os.remove(os.path.join(self.cache_dir, evicted))
+                except OSError as ex:
+                    log.debug("Could not delete cached Google Drive file: {}".format(ex))
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self._entries) if self._entries is not None else 0
+            stats['bytes'] = self._bytes
+        return stats
+
+
+class _CacheWriter:
+    def __init__(self, cache, name, size):
+        self._cache = cache
+        self._name = name
+        self._size = size
+        self._written = 0
+        self._path = os.path.join(cache.cache_dir, "{}.{}{}".format(name, uuid.uuid4().hex, _PART_SUFFIX))
+        self._file = open(self._path, "wb")
+
+    def write(self, data):
+        self._file.write(data)
+        self._written += len(data)
+
+    def commit(self):
+        self._file.close()
+        if self._written != self._size:
+            self.discard()
+            return
+        try:
+            self._cache._add(self._name, self._path, self._size)
+        except OSError as ex:
+            log.debug("Could not cache Google Drive file: {}".format(ex))
+            self.discard()
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
+
+
+def _read_chunks(cached, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    with cached:
+        while True:
+            data = cached.read(chunk_size)
+            if not data:
+                return
+            yield data
+
+
+def stream_drive_file(df, cache=None, in_flight=DOWNLOAD_RANGES_IN_FLIGHT, convert_encoding=False):
+    """Yields the content of a Drive file, from the cache if it holds the current version, otherwise downloaded in
+    parallel ranges and written to the cache on the way. Text files are converted to utf-8 if requested"""
+    total_size = int(df.metadata.get('fileSize'))
+    # md5Checksum changes with the content, Google Docs don't have one
+    version = df.metadata.get('md5Checksum') or df.metadata.get('modifiedDate')
+    cache = cache if version else None
+    cached = cache.open(df['id'], version) if cache else None
+    writer = None
+    if cached:
+        chunks = _read_chunks(cached)
+    else:
+        writer = cache.writer(df['id'], version, total_size) if cache else None
+        chunks = fetch_ranges(df.auth.Get_Http_Object, df.metadata.get('downloadUrl'), total_size,
+                              in_flight=in_flight)
+    converter = Utf8Converter() if convert_encoding else None
+    completed = False
+    try:
+        for data in chunks:
+            if writer:
+                writer.write(data)
+            if converter:
+                data = converter.feed(data)
+                if not data:
+                    continue
+            yield data
+        if converter:
+            data = converter.feed(b"", True)
+            if data:
+                yield data
+        completed = True
+    except DownloadError as ex:
+        log.warning(ex)
+    finally:
+        chunks.close()
+        if writer:
+            if completed:
+                writer.commit()
+            else:
+                writer.discard()
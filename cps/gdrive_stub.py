@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import re
+import threading
+from collections import Counter
+from itertools import count
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# the query terms gdriveutils sends, joined with " and "
+_QUOTED = r"'((?:[^'\\]|\\.)*)'"
+_TERMS = (
+    ('parent', re.compile(_QUOTED + r" in parents$")),
+    ('title', re.compile(r"title = " + _QUOTED + "$")),
+    ('contains', re.compile(r"title contains " + _QUOTED + "$")),
+    ('mime', re.compile(r"mimeType = " + _QUOTED + "$")),
+    ('trashed', re.compile(r"trashed = (true|false)$")),
+)
+_SPLIT = re.compile(r" and (?=(?:[^'\\]|\\.|'(?:[^'\\]|\\.)*')*$)")
+
+
+def _unquote(value):
+    return re.sub(r"\\(.)", r"\1", value)
+
+
+class _StubResponse(dict):
+    def __init__(self, status):
+        super().__init__(status=str(status))
+        self.status = status
+
+
+class _StubHttp:
+    def __init__(self, drive):
+        self._drive = drive
+
+    def request(self, uri, method="GET", headers=None, **__):
+        self._drive.requests['download'] += 1
+        drive_file = self._drive.files.get(uri.rsplit('/', 1)[-1])
+        if drive_file is None:
+            return _StubResponse(404), b""
+        content = drive_file.content
+        byte_range = (headers or {}).get("Range")
+        if not byte_range:
+            return _StubResponse(200), content
+        start, end = byte_range.split("=", 1)[1].split("-")
+        end = int(end) if end else len(content) - 1
+        return _StubResponse(206), content[int(start):end + 1]
+
+
+class _StubAuth:
+    access_token_expired = False
+    service = None
+
+    def __init__(self, drive):
+        self._drive = drive
+
+    def Refresh(self):
+        pass
+
+    def Authorize(self):
+        pass
+
+    def Get_Http_Object(self):
+        return _StubHttp(self._drive)
+
+
+class StubFile(dict):
+    """Subset of pydrive's GoogleDriveFile used by gdriveutils, the content is kept in memory"""
+    def __init__(self, drive, metadata=None):
+        super().__init__(metadata or {})
+        self._drive = drive
+        self.auth = drive.auth
+        self.content = b""
+        self.setdefault('parents', [])
+        self.setdefault('mimeType', 'application/octet-stream')
+        self['labels'] = {'trashed': False}
+
+    @property
+    def metadata(self):
+        return self
+
+    def _update_size(self):
+        self['fileSize'] = str(len(self.content))
+        self['md5Checksum'] = hashlib.md5(self.content).hexdigest()
+
+    def SetContentFile(self, filename):
+        with open(filename, "rb") as f:
+            self.content = f.read()
+        self._update_size()
+
+    def SetContentString(self, content, encoding="utf-8"):
+        self.content = content.encode(encoding)
+        self._update_size()
+
+    def GetContentFile(self, filename, **__):
+        self._drive.requests['download'] += 1
+        with open(filename, "wb") as f:
+            f.write(self.content)
+
+    def GetContentString(self, encoding="utf-8", **__):
+        self._drive.requests['download'] += 1
+        return self.content.decode(encoding)
+
+    def Upload(self, param=None):
+        self._drive.requests['upload'] += 1
+        self._drive.store(self)
+
+    def Trash(self, param=None):
+        self._drive.requests['trash'] += 1
+        self['labels'] = {'trashed': True}
+
+    def GetPermissions(self):
+        return []
+
+    def InsertPermission(self, new_permission, param=None):
+        return new_permission
+
+
+class _StubFileList:
+    def __init__(self, drive, query):
+        self._drive = drive
+        self._query = query
+
+    def GetList(self):
+        self._drive.requests['list'] += 1
+        return self._drive.query(self._query)
+
+
+class StubDrive:
+    """Offline stand-in for pydrive's GoogleDrive with the folder tree in memory. It answers the queries gdriveutils
+    sends, serves downloads including Range requests and counts the requests, so lookups can be checked and
+    measured without a Google account"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = count(1)
+        self.files = dict()
+        self.requests = Counter()
+        self.auth = _StubAuth(self)
+
+    def ListFile(self, param=None):
+        return _StubFileList(self, (param or {}).get('q', ''))
+
+    def CreateFile(self, metadata=None):
+        return StubFile(self, metadata)
+
+    def store(self, drive_file):
+        with self._lock:
+            if 'id' not in drive_file:
+                drive_file['id'] = "stub{}".format(next(self._ids))
+            drive_file['downloadUrl'] = "stub://files/" + drive_file['id']
+            if drive_file['mimeType'] != FOLDER_MIME_TYPE:
+                drive_file._update_size()
+            self.files[drive_file['id']] = drive_file
+
+    def add(self, title, parent_id='root', content=None):
+        """Adds a file, or a folder if content is None, and returns it"""
+        metadata = {'title': title, 'parents': [{'id': parent_id}]}
+        if content is None:
+            metadata['mimeType'] = FOLDER_MIME_TYPE
+        drive_file = StubFile(self, metadata)
+        if content is not None:
+            drive_file.content = content
+        self.store(drive_file)
+        return drive_file
+
+    @classmethod
+    def from_directory(cls, directory, folder_title):
+        """Drive with the content of a local directory, e.g. a calibre library, in the folder folder_title"""
+        drive = cls()
+        folders = {directory: drive.add(folder_title)['id']}
+        for root, dir_names, file_names in os.walk(directory):
+            for name in sorted(dir_names):
+                folders[os.path.join(root, name)] = drive.add(name, folders[root])['id']
+            for name in sorted(file_names):
+                with open(os.path.join(root, name), "rb") as f:
+                    drive.add(name, folders[root], f.read())
+        return drive
+
+    def query(self, query):
+        conditions = list()
+        for term in _SPLIT.split(query.strip()):
+            for kind, pattern in _TERMS:
+                match = pattern.match(term.strip())
+                if match:
+                    conditions.append((kind, _unquote(match.group(1))))
+                    break
+            else:
+                raise ValueError("Unsupported Drive query term: {}".format(term))
+        with self._lock:
+            return [f for f in self.files.values() if all(self._matches(f, kind, value)
+                                                          for kind, value in conditions)]
+
+    @staticmethod
+    def _matches(drive_file, kind, value):
+        if kind == 'parent':
+            return any(parent['id'] == value for parent in drive_file['parents'])
+        if kind == 'title':
+            return drive_file['title'] == value
+        if kind == 'contains':
+            return value.lower() in drive_file['title'].lower()
+        if kind == 'mime':
+            return drive_file['mimeType'] == value
+        return drive_file['labels']['trashed'] == (value == 'true')
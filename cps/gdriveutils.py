@@ -19,7 +19,6 @@
 import os
 import json
 import shutil
-import chardet
 import ssl
 import sqlite3
 import mimetypes
@@ -67,7 +66,10 @@ except ImportError as err:
         gdrive_support = False
 
 from . import logger, cli_param, config, db
-from .constants import CONFIG_DIR as _CONFIG_DIR
+from .constants import CONFIG_DIR as _CONFIG_DIR, CACHE_TYPE_GDRIVE
+from .fs import FileSystem
+from .gdrive_cache import DriveLookupCache
+from .gdrive_download import DriveFileCache, stream_drive_file
 
 
 SETTINGS_YAML  = os.path.join(_CONFIG_DIR, 'settings.yaml')
@@ -82,6 +84,22 @@ if gdrive_support:
 else:
     log.debug("Cannot import pydrive, httplib2, using gdrive will not work: {}".format(importError))
 
+# folder ids and file metadata looked up recently, in front of gdrive.db and the Drive API
+lookup_cache = DriveLookupCache()
+_download_cache = None
+
+
+def get_download_cache():
+    """Disk cache of recently downloaded files, None if it is disabled"""
+    global _download_cache
+    if _download_cache is None and cli_param.gdrive_cache_size > 0:
+        try:
+            _download_cache = DriveFileCache(FileSystem().get_cache_dir(CACHE_TYPE_GDRIVE),
+                                             cli_param.gdrive_cache_size * 1024 * 1024)
+        except OSError:
+            return None
+    return _download_cache
+
 
 class Singleton:
     """
@@ -138,7 +156,11 @@ class Gauth:
 @Singleton
 class Gdrive:
     def __init__(self):
-        self.drive = getDrive(gauth=Gauth.Instance().auth)
+        if cli_param.gdrive_stub:
+            from .gdrive_stub import StubDrive
+            self.drive = StubDrive.from_directory(cli_param.gdrive_stub, config.config_google_drive_folder)
+        else:
+            self.drive = getDrive(gauth=Gauth.Instance().auth)
 
 
 def is_gdrive_ready():
@@ -242,8 +264,12 @@ def getFolderInFolder(parentId, folderName, drive):
 
 # Search for id of root folder in gdrive database, if not found request from gdrive and store in internal database
 def getEbooksFolderId(drive=None):
+    cached_id = lookup_cache.get_folder_id('/')
+    if cached_id:
+        return cached_id
     storedPathName = session.query(GdriveId).filter(GdriveId.path == '/').first()
     if storedPathName:
+        lookup_cache.set_folder_id('/', storedPathName.gdrive_id)
         return storedPathName.gdrive_id
     else:
         gDriveId = GdriveId()
@@ -258,24 +284,46 @@ def getEbooksFolderId(drive=None):
         except OperationalError as ex:
             log.error_or_exception('Database error: {}'.format(ex))
             session.rollback()
+        if gDriveId.gdrive_id:
+            lookup_cache.set_folder_id('/', gDriveId.gdrive_id)
         return gDriveId.gdrive_id
 
 
 def getFile(pathId, fileName, drive, nocase):
+    known, cached_file = lookup_cache.get_file(pathId, fileName, nocase)
+    if known:
+        return cached_file
     metaDataFile = "'%s' in parents and trashed = false and title contains '%s'" % (pathId, fileName.replace("'", r"\'"))
     fileList = drive.ListFile({'q': metaDataFile}).GetList()
     if fileList.__len__() == 0:
         return None
     if nocase:
-        return fileList[0] if db.lcase(fileList[0]['title']) == db.lcase(fileName) else None
+        if db.lcase(fileList[0]['title']) == db.lcase(fileName):
+            lookup_cache.set_file(pathId, fileList[0])
+            return fileList[0]
+        return None
     for f in fileList:
         if f['title'] == fileName:
+            lookup_cache.set_file(pathId, f)
             return f
     return None
 
 
+def prefetchFolder(folderId, drive, path=None):
+    # one listing of all children answers the following lookups in this folder, also for missing files
+    fileList = drive.ListFile({'q': "'%s' in parents and trashed = false" % folderId}).GetList()
+    lookup_cache.store_listing(folderId, fileList)
+    if path is not None:
+        for f in fileList:
+            if f['mimeType'] == 'application/vnd.google-apps.folder':
+                lookup_cache.set_folder_id(path.rstrip('/') + '/' + f['title'], f['id'])
+    return fileList
+
+
 def getFolderId(path, drive):
-    currentFolderId = None
+    currentFolderId = lookup_cache.get_folder_id(path)
+    if currentFolderId:
+        return currentFolderId
     try:
         currentFolderId = getEbooksFolderId(drive)
         sqlCheckPath = path if path[-1] == '/' else path + '/'
@@ -289,6 +337,10 @@ def getFolderId(path, drive):
                     currentPath = "/".join(s[:i+1])
                     if currentPath[-1] != '/':
                         currentPath = currentPath + '/'
+                    cachedFolderId = lookup_cache.get_folder_id(currentPath)
+                    if cachedFolderId:
+                        currentFolderId = cachedFolderId
+                        continue
                     storedPathName = session.query(GdriveId).filter(GdriveId.path == currentPath).first()
                     if storedPathName:
                         currentFolderId = storedPathName.gdrive_id
@@ -308,6 +360,8 @@ def getFolderId(path, drive):
                 session.commit()
         else:
             currentFolderId = storedPathName.gdrive_id
+        if currentFolderId:
+            lookup_cache.set_folder_id(sqlCheckPath, currentFolderId)
     except (OperationalError, IntegrityError, StaleDataError, sqlite3.IntegrityError) as ex:
         log.error_or_exception('Database error: {}'.format(ex))
         session.rollback()
@@ -324,6 +378,12 @@ def getFileFromEbooksFolder(path, fileName, nocase=False):
     if path:
         # sqlCheckPath=path if path[-1] =='/' else path + '/'
         folderId = getFolderId(path, drive)
+        if folderId and not lookup_cache.get_file(folderId, fileName, nocase)[0]:
+            # book folders are small, cover, formats and metadata.opf are read with one listing
+            try:
+                prefetchFolder(folderId, drive, path)
+            except ApiRequestError as ex:
+                log.error('{} {}'.format(ex.error['message'], path))
     else:
         folderId = getEbooksFolderId(drive)
     if folderId:
@@ -335,6 +395,7 @@ def getFileFromEbooksFolder(path, fileName, nocase=False):
 def moveGdriveFileRemote(origin_file_id, new_title):
     origin_file_id['title'] = new_title
     origin_file_id.Upload()
+    lookup_cache.invalidate(origin_file_id['id'], [parent['id'] for parent in origin_file_id.get('parents', [])])
 
 
 # Download metadata.db from gdrive
@@ -378,6 +439,8 @@ def moveGdriveFolderRemote(origin_file, target_folder, single_book=False):
     if len(children['items']) == 1:
         deleteDatabaseEntry(previous_parents)
         drive.auth.service.files().delete(fileId=previous_parents).execute()
+    # folder paths below the moved folder changed
+    lookup_cache.clear()
 
 
 def copyToDrive(drive, uploadFile, createRoot, replaceFiles,
@@ -433,10 +496,12 @@ def uploadFileToEbooksFolder(destFile, f, string=False):
             else:
                 driveFile.SetContentString(f)
             driveFile.Upload()
+            lookup_cache.invalidate(driveFile['id'], [parent['id']])
         else:
             existing_Folder = drive.ListFile({'q': "title = '%s' and '%s' in parents and trashed = false" %
                                                    (x.replace("'", r"\'"), parent['id'])}).GetList()
             if len(existing_Folder) == 0:
+                lookup_cache.invalidate(parent_ids=[parent['id']])
                 parent = drive.CreateFile({'title': x, 'parents': [{"kind": "drive#fileLink", 'id': parent['id']}],
                                            "mimeType": "application/vnd.google-apps.folder"})
                 parent.Upload()
@@ -533,8 +598,16 @@ def getChangeById(drive, change_id):
         return None
 
 
+# Drops the cached lookups affected by the change resource of a watch notification
+def invalidateOnChange(change):
+    drive_file = change.get('file') or {}
+    lookup_cache.invalidate(change.get('fileId') or drive_file.get('id'),
+                            [parent['id'] for parent in drive_file.get('parents', [])])
+
+
 # Deletes the local hashes database to force search for new folder names
 def deleteDatabaseOnChange():
+    lookup_cache.clear()
     try:
         session.query(GdriveId).delete()
         session.commit()
@@ -546,6 +619,7 @@ def deleteDatabaseOnChange():
 
 def updateGdriveCalibreFromLocal():
     copyToDrive(Gdrive.Instance().drive, config.config_calibre_dir, False, True)
+    lookup_cache.clear()
     for x in os.listdir(config.config_calibre_dir):
         if os.path.isdir(os.path.join(config.config_calibre_dir, x)):
             shutil.rmtree(os.path.join(config.config_calibre_dir, x))
@@ -554,6 +628,7 @@ def updateGdriveCalibreFromLocal():
 # update gdrive.db on edit of books title
 def updateDatabaseOnEdit(ID, newPath):
     sqlCheckPath = newPath if newPath[-1] == '/' else newPath + '/'
+    lookup_cache.invalidate(ID)
     storedPathName = session.query(GdriveId).filter(GdriveId.gdrive_id == ID).first()
     if storedPathName:
         storedPathName.path = sqlCheckPath
@@ -566,6 +641,7 @@ def updateDatabaseOnEdit(ID, newPath):
 
 # Deletes the hashes in database of deleted book
 def deleteDatabaseEntry(ID):
+    lookup_cache.invalidate(ID)
     session.query(GdriveId).filter(GdriveId.gdrive_id == ID).delete()
     try:
         session.commit()
@@ -574,6 +650,7 @@ def deleteDatabaseEntry(ID):
         session.rollback()
 
 def deleteDatabasePath(Pathname):
+    lookup_cache.clear()
     session.query(GdriveId).filter(GdriveId.path.contains(Pathname)).delete()
     try:
         session.commit()
@@ -634,34 +711,11 @@ def get_metadata_backup_via_gdrive(metadata_path):
         return None
 
 
-# Creates chunks for downloading big files
-def partial(total_byte_len, part_size_limit):
-    s = []
-    for p in range(0, total_byte_len, part_size_limit):
-        last = min(total_byte_len - 1, p + part_size_limit - 1)
-        s.append([p, last])
-    return s
-
-
-# downloads files in chunks from gdrive
+# downloads files in parallel chunks from gdrive, recently served files are read from the local cache
 def do_gdrive_download(df, headers, convert_encoding=False):
-    total_size = int(df.metadata.get('fileSize'))
-    download_url = df.metadata.get('downloadUrl')
-    s = partial(total_size, 1024 * 1024)  # I'm downloading BIG files, so 100M chunk size is fine for me
-
-    def stream(convert_encoding):
-        for byte in s:
-            headers = {"Range": 'bytes={}-{}'.format(byte[0], byte[1])}
-            resp, content = df.auth.Get_Http_Object().request(download_url, headers=headers)
-            if resp.status == 206:
-                if convert_encoding:
-                    result = chardet.detect(content)
-                    content = content.decode(result['encoding']).encode('utf-8')
-                yield content
-            else:
-                log.warning('An error occurred: {}'.format(resp))
-                return
-    return Response(stream_with_context(stream(convert_encoding)), headers=headers)
+    return Response(stream_with_context(stream_drive_file(df, get_download_cache(), cli_param.gdrive_download_ranges,
+                                                          convert_encoding)),
+                    headers=headers)
 
 
 _SETTINGS_YAML_TEMPLATE = """
@@ -25,6 +25,9 @@ import re
 import regex
 import shutil
 import socket
+import threading
+import time
+from collections import OrderedDict, namedtuple
 from datetime import datetime, timedelta, timezone
 import requests
 import unidecode
@@ -38,6 +41,7 @@ from .cw_login import current_user
 from sqlalchemy.sql.expression import true, false, and_, or_, text, func
 from sqlalchemy.exc import InvalidRequestError, OperationalError
 from werkzeug.datastructures import Headers
+from werkzeug.exceptions import NotFound
 from werkzeug.security import generate_password_hash
 from markupsafe import escape
 from urllib.parse import quote
@@ -63,6 +67,12 @@ from .services.worker import WorkerThread
 from .tasks.mail import TaskEmail
 from .tasks.thumbnail import TaskClearCoverThumbnailCache, TaskGenerateCoverThumbnails
 from .tasks.metadata_backup import TaskBackupMetadata
+from .tasks.epub_fts import TaskSyncEpubFTS
+from .tasks.epub_layout import TaskSyncEpubLayout
+from .tasks.metadata_fts import TaskSyncMetadataFTS
+from .metadata_fts import get_metadata_fts_index
+from .category_index import get_category_index
+from .epub_layout import get_epub_layout_cache, LAYOUT_FORMATS
 from .file_helper import get_temp_dir
 from .epub_helper import get_content_opf, create_new_metadata_backup, updateEpub, replace_metadata
 from .embed_helper import do_calibre_export
@@ -78,6 +88,17 @@ except (ImportError, RuntimeError) as e:
     use_IM = False
     MissingDelegateError = BaseException
 
+# Cover requests are answered from an LRU cache of resolved cover files keyed by book id, resolution and the
+# visibility restrictions of the user. Entries expire to catch up with external changes of the library
+COVER_CACHE_SIZE = 4096
+COVER_CACHE_TTL = 600
+COVER_SOURCE_FILE = 0
+COVER_SOURCE_GDRIVE = 1
+COVER_SOURCE_GENERIC = 2
+CoverCacheEntry = namedtuple('CoverCacheEntry', ['source', 'directory', 'filename', 'etag', 'last_modified'])
+_cover_cache = OrderedDict()
+_cover_cache_lock = threading.Lock()
+
 
 # Convert existing book entry to new format
 def convert_book_format(book_id, calibre_path, old_book_format, new_book_format, user_id, ereader_mail=None):
@@ -98,6 +119,22 @@ def convert_book_format(book_id, calibre_path, old_book_format, new_book_format,
             error_message = _("%(format)s not found: %(fn)s",
                               format=old_book_format, fn=data.name + "." + old_book_format.lower())
             return error_message
+    _queue_convert_task(book, file_path, old_book_format, new_book_format, user_id, ereader_mail)
+    return None
+
+
+# Queues a conversion for a book whose format data is already known, without accessing the library files.
+# Missing source files are reported by the conversion task itself
+def queue_book_format_conversion(book, data_name, calibre_path, old_book_format, new_book_format, user_id):
+    for queued in WorkerThread.get_instance().tasks:
+        if (isinstance(queued.task, TaskConvert) and not queued.task.dead and queued.task.book_id == book.id
+                and queued.task.settings.get('new_book_format') == new_book_format):
+            return
+    file_path = os.path.join(calibre_path, book.path, data_name)
+    _queue_convert_task(book, file_path, old_book_format, new_book_format, user_id)
+
+
+def _queue_convert_task(book, file_path, old_book_format, new_book_format, user_id, ereader_mail=None):
     # read settings and append converter task to queue
     if ereader_mail:
         settings = config.get_mail_settings()
@@ -113,7 +150,6 @@ def convert_book_format(book_id, calibre_path, old_book_format, new_book_format,
     settings['old_book_format'] = old_book_format
     settings['new_book_format'] = new_book_format
     WorkerThread.add(user_id, TaskConvert(file_path, book.id, txt, settings, ereader_mail, user_id))
-    return None
 
 
 # Texts are not lazy translated as they are supposed to get send out as is
@@ -709,9 +745,14 @@ def delete_book(book, calibrepath, book_format):
         clear_cover_thumbnail_cache(book.id)  # here it breaks
         calibre_db.delete_dirty_metadata(book.id)
     if config.config_use_google_drive:
-        return delete_book_gdrive(book, book_format)
+        result = delete_book_gdrive(book, book_format)
     else:
-        return delete_book_file(book, calibrepath, book_format)
+        result = delete_book_file(book, calibrepath, book_format)
+    if not book_format or book_format.upper() == "EPUB":
+        update_epub_fts_index(book.id)
+    if not book_format or book_format.upper() in LAYOUT_FORMATS:
+        update_epub_layout_cache(book.id)
+    return result
 
 
 def get_cover_on_failure():
@@ -723,8 +764,18 @@ def get_cover_on_failure():
 
 
 def get_book_cover(book_id, resolution=None):
+    # Repeated requests for the same cover are answered from the cover cache without any database access
+    key = (book_id, resolution, calibre_db.visibility_fingerprint())
+    entry = _get_cover_cache_entry(key)
+    if entry is not None:
+        response = _send_book_cover(entry)
+        if response is not None:
+            return response
+        # file was removed after the entry was cached
     book = calibre_db.get_filtered_book(book_id, allow_show_archived=True)
-    return get_book_cover_internal(book, resolution=resolution)
+    entry = _resolve_book_cover(book, resolution)
+    _set_cover_cache_entry(key, entry)
+    return _send_book_cover(entry) or get_cover_on_failure()
 
 
 def get_book_cover_with_uuid(book_uuid, resolution=None):
@@ -735,6 +786,12 @@ def get_book_cover_with_uuid(book_uuid, resolution=None):
 
 
 def get_book_cover_internal(book, resolution=None):
+    return _send_book_cover(_resolve_book_cover(book, resolution)) or get_cover_on_failure()
+
+
+# Finds the file to send for a book cover: a cached thumbnail, the cover in the library or on Google Drive,
+# or the generic cover for books without a cover or which are not visible
+def _resolve_book_cover(book, resolution=None):
     if book and book.has_cover:
 
         # Send the book cover thumbnail if it exists in cache
@@ -743,33 +800,85 @@ def get_book_cover_internal(book, resolution=None):
             if thumbnail:
                 cache = fs.FileSystem()
                 if cache.get_cache_file_exists(thumbnail.filename, CACHE_TYPE_THUMBNAILS):
-                    return send_from_directory(cache.get_cache_file_dir(thumbnail.filename, CACHE_TYPE_THUMBNAILS),
-                                               thumbnail.filename)
-
+                    return CoverCacheEntry(COVER_SOURCE_FILE,
+                                           cache.get_cache_file_dir(thumbnail.filename, CACHE_TYPE_THUMBNAILS),
+                                           thumbnail.filename,
+                                           "{}-{}-{}".format(book.id, resolution,
+                                                             int(thumbnail.generated_at.timestamp())),
+                                           thumbnail.generated_at)
+
+        etag = "{}-{}".format(book.id, int(book.last_modified.timestamp()))
         # Send the book cover from Google Drive if configured
         if config.config_use_google_drive:
-            try:
-                if not gd.is_gdrive_ready():
-                    return get_cover_on_failure()
-                cover_file = gd.get_cover_via_gdrive(book.path)
-                if cover_file:
-                    return Response(cover_file, mimetype='image/jpeg')
-                else:
-                    log.error('{}/cover.jpg not found on Google Drive'.format(book.path))
-                    return get_cover_on_failure()
-            except Exception as ex:
-                log.error_or_exception(ex)
-                return get_cover_on_failure()
+            return CoverCacheEntry(COVER_SOURCE_GDRIVE, None, book.path, etag, book.last_modified)
 
         # Send the book cover from the Calibre directory
         else:
             cover_file_path = os.path.join(config.get_book_path(), book.path)
             if os.path.isfile(os.path.join(cover_file_path, "cover.jpg")):
-                return send_from_directory(cover_file_path, "cover.jpg")
+                return CoverCacheEntry(COVER_SOURCE_FILE, cover_file_path, "cover.jpg", etag, book.last_modified)
+    return CoverCacheEntry(COVER_SOURCE_GENERIC, None, None, None, None)
+
+
+# Returns None if the cover file does not exist anymore
+def _send_book_cover(entry):
+    if entry.source == COVER_SOURCE_GENERIC:
+        return get_cover_on_failure()
+    if request.if_none_match.contains(entry.etag):
+        response = make_response('', 304)
+        response.set_etag(entry.etag)
+        return response
+    if entry.source == COVER_SOURCE_GDRIVE:
+        try:
+            if not gd.is_gdrive_ready():
+                return get_cover_on_failure()
+            cover_file = gd.get_cover_via_gdrive(entry.filename)
+            if cover_file:
+                response = Response(cover_file, mimetype='image/jpeg')
+                response.set_etag(entry.etag)
+                response.last_modified = entry.last_modified
+                return response
             else:
+                log.error('{}/cover.jpg not found on Google Drive'.format(entry.filename))
                 return get_cover_on_failure()
-    else:
-        return get_cover_on_failure()
+        except Exception as ex:
+            log.error_or_exception(ex)
+            return get_cover_on_failure()
+    try:
+        return send_from_directory(entry.directory, entry.filename, etag=entry.etag,
+                                   last_modified=entry.last_modified)
+    except NotFound:
+        return None
+
+
+def _get_cover_cache_entry(key):
+    with _cover_cache_lock:
+        cached = _cover_cache.get(key)
+        if cached is None:
+            return None
+        if cached[0] < time.monotonic():
+            del _cover_cache[key]
+            return None
+        _cover_cache.move_to_end(key)
+        return cached[1]
+
+
+def _set_cover_cache_entry(key, entry):
+    with _cover_cache_lock:
+        _cover_cache[key] = (time.monotonic() + COVER_CACHE_TTL, entry)
+        _cover_cache.move_to_end(key)
+        while len(_cover_cache) > COVER_CACHE_SIZE:
+            _cover_cache.popitem(last=False)
+
+
+# Removes the cached covers of a book, or all cached covers if no book is given
+def invalidate_cover_cache(book_id=None):
+    with _cover_cache_lock:
+        if book_id is None:
+            _cover_cache.clear()
+        else:
+            for key in [key for key in _cover_cache if key[0] == book_id]:
+                del _cover_cache[key]
 
 
 def get_book_cover_thumbnail(book, resolution):
@@ -1104,17 +1213,20 @@ def get_download_link(book_id, book_format, client):
 
 
 def clear_cover_thumbnail_cache(book_id):
+    invalidate_cover_cache(book_id)
     if config.schedule_generate_book_covers:
         WorkerThread.add(None, TaskClearCoverThumbnailCache(book_id), hidden=True)
 
 
 def replace_cover_thumbnail_cache(book_id):
+    invalidate_cover_cache(book_id)
     if config.schedule_generate_book_covers:
         WorkerThread.add(None, TaskClearCoverThumbnailCache(book_id), hidden=True)
         WorkerThread.add(None, TaskGenerateCoverThumbnails(book_id), hidden=True)
 
 
 def delete_thumbnail_cache():
+    invalidate_cover_cache()
     WorkerThread.add(None, TaskClearCoverThumbnailCache(-1))
 
 
@@ -1128,6 +1240,41 @@ def update_thumbnail_cache():
         WorkerThread.add(None, TaskGenerateCoverThumbnails())
 
 
+def update_epub_fts_index(book_id):
+    if not config.config_use_google_drive:
+        WorkerThread.add(None, TaskSyncEpubFTS([book_id]), hidden=True)
+
+
+def update_epub_layout_cache(book_id=None):
+    # without book id the whole library is checked, at most one of these runs is queued at a time
+    if config.config_use_google_drive:
+        return
+    if book_id is not None:
+        WorkerThread.add(None, TaskSyncEpubLayout([book_id]), hidden=True)
+    elif get_epub_layout_cache(ub.app_DB_path).claim_warm():
+        WorkerThread.add(None, TaskSyncEpubLayout(), hidden=True)
+
+
+def update_metadata_fts_index(book_id):
+    WorkerThread.add(None, TaskSyncMetadataFTS([book_id]), hidden=True)
+
+
+def update_category_index(book_id):
+    # called after the commit, the changed library state is known then
+    get_category_index().books_changed([book_id], calibre_db.current_library_state())
+
+
+def sync_metadata_fts_index():
+    # library wide sync of the changes since the last one, at most one of these runs is queued at a time
+    if get_metadata_fts_index(ub.app_DB_path).claim_sync():
+        WorkerThread.add(None, TaskSyncMetadataFTS(), hidden=True)
+
+
+def rebuild_metadata_fts_index():
+    get_metadata_fts_index(ub.app_DB_path).clear()
+    WorkerThread.add(None, TaskSyncMetadataFTS(), hidden=True)
+
+
 def set_all_metadata_dirty():
     WorkerThread.add(None, TaskBackupMetadata(export_language=get_locale(),
                                               translated_title=_("Cover"),
@@ -16,8 +16,10 @@
 #   You should have received a copy of the GNU General Public License
 #   along with this program. If not, see <http://www.gnu.org/licenses/>.
 import sys
+import importlib
+import threading
+from types import MappingProxyType
 
-from .iso_language_names import LANGUAGE_NAMES as _LANGUAGE_NAMES
 from . import logger
 from .string_helper import strip_whitespaces
 
@@ -46,23 +48,53 @@ except ImportError as ex:
     get = languages.get
 
 
+UNKNOWN_TRANSLATION = "Unknown"
+
+# locale -> read-only table of language code to translated name, filled on first use of a locale
+_locale_tables = dict()
+_locale_lock = threading.Lock()
+
+
+def _load_language_names(locale):
+    # iso_language_names holds the names for all locales, only the table of the requested one is kept
+    with _locale_lock:
+        table = _locale_tables.get(locale)
+        if table is not None:
+            return table
+        module = importlib.import_module(".iso_language_names", __package__)
+        try:
+            names = module.LANGUAGE_NAMES.get(str(locale))
+            if names is None:
+                names = module.LANGUAGE_NAMES.get(getattr(locale, "language", None))
+        finally:
+            # the other locales are freed, a further locale imports the module again
+            sys.modules.pop(module.__name__, None)
+            package = sys.modules.get(__package__)
+            if getattr(package, "iso_language_names", None) is module:
+                delattr(package, "iso_language_names")
+            del module
+        table = MappingProxyType(dict(names)) if names is not None else None
+        _locale_tables[locale] = table
+        return table
+
+
 def get_language_names(locale):
-    names = _LANGUAGE_NAMES.get(str(locale))
-    if names is None:
-        names = _LANGUAGE_NAMES.get(locale.language)
-    return names
+    try:
+        return _locale_tables[locale]
+    except KeyError:
+        return _load_language_names(locale)
 
 
 def get_language_name(locale, lang_code):
-    UNKNOWN_TRANSLATION = "Unknown"
     names = get_language_names(locale)
     if names is None:
         log.error(f"Missing language names for locale: {str(locale)}/{locale.language}")
         return UNKNOWN_TRANSLATION
 
-    name = names.get(lang_code, UNKNOWN_TRANSLATION)
-    if name == UNKNOWN_TRANSLATION:
+    name = names.get(lang_code)
+    if name is None:
         log.error("Missing translation for language name: {}".format(lang_code))
+        return UNKNOWN_TRANSLATION
 
     return name
 
@@ -18,18 +18,21 @@
 #  along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import base64
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 import os
 import uuid
-import zipfile
-from time import gmtime, strftime
+from time import gmtime, strftime, perf_counter
 import json
+import itertools
+from collections import OrderedDict
 from urllib.parse import unquote
 
 from flask import (
     Blueprint,
     request,
     make_response,
+    Response,
+    stream_with_context,
     jsonify,
     current_app,
     url_for,
@@ -41,11 +44,13 @@ from werkzeug.datastructures import Headers
 from sqlalchemy import func
 from sqlalchemy.sql.expression import and_, or_
 from sqlalchemy.exc import StatementError
+from sqlalchemy.orm import selectinload
 import requests
 
 from . import config, logger, kobo_auth, db, calibre_db, helper, shelf as shelf_lib, ub, csrf, kobo_sync_status
 from . import isoLanguages
-from .epub import get_epub_layout
+from .epub import read_epub_layout
+from .epub_layout import get_epub_layout_cache
 from .constants import COVER_THUMBNAIL_SMALL, COVER_THUMBNAIL_MEDIUM, COVER_THUMBNAIL_LARGE, BASE_DIR
 from .helper import get_download_link
 from .services import SyncToken as SyncToken
@@ -57,6 +62,10 @@ KOBO_STOREAPI_URL = "https://storeapi.kobo.com"
 KOBO_IMAGEHOST_URL = "https://cdn.kobo.com/book-images"
 
 SYNC_ITEM_LIMIT = 100
+# number of books loaded at once while writing the sync response
+SYNC_CHUNK_SIZE = 20
+# book ids per IN clause when the uuids of shelf books are loaded, sqlite allows at most 999 variables
+TAG_ITEM_CHUNK_SIZE = 500
 
 kobo = Blueprint("kobo", __name__, url_prefix="/kobo/<auth_token>")
 kobo_auth.disable_failed_auth_redirect_for_blueprint(kobo)
@@ -163,11 +172,13 @@ def HandleSyncRequest():
     new_reading_state_last_modified = sync_token.reading_state_last_modified
 
     new_archived_last_modified = datetime.min
-    sync_results = []
+    timings = OrderedDict()
+    phase_start = perf_counter()
 
-    # We reload the book database so that the user gets a fresh view of the library
-    # in case of external changes (e.g: adding a book through Calibre).
-    calibre_db.reconnect_db(config, ub.app_DB_path)
+    # We reload the book database if it was changed externally so that the user gets a fresh view
+    # of the library (e.g: adding a book through Calibre).
+    calibre_db.reconnect_db_if_changed(config, ub.app_DB_path)
+    phase_start = _record_phase(timings, "reconnect", phase_start)
 
     only_kobo_shelves = current_user.kobo_only_shelves_sync
 
@@ -205,49 +216,75 @@ def HandleSyncRequest():
                            .order_by(db.Books.last_modified)
                            .order_by(db.Books.id))
 
-    reading_states_in_new_entitlements = []
-    books = changed_entries.limit(SYNC_ITEM_LIMIT)
-    log.debug("Books to Sync: {}".format(len(books.all())))
-    for book in books:
-        formats = [data.format for data in book.Books.data]
-        if 'KEPUB' not in formats and config.config_kepubifypath and 'EPUB' in formats:
-            helper.convert_book_format(book.Books.id, config.get_book_path(), 'EPUB', 'KEPUB', current_user.name)
-
-        kobo_reading_state = get_or_create_reading_state(book.Books.id)
-        entitlement = {
-            "BookEntitlement": create_book_entitlement(book.Books, archived=(book.is_archived==True)),
-            "BookMetadata": get_metadata(book.Books),
-        }
+    # Shelves are synced first, their commits would otherwise expire the prefetched reading states
+    shelf_results = []
+    sync_shelves(sync_token, shelf_results, only_kobo_shelves)
+    phase_start = _record_phase(timings, "shelves", phase_start)
 
-        if kobo_reading_state.last_modified > sync_token.reading_state_last_modified:
-            entitlement["ReadingState"] = get_kobo_reading_state_response(book.Books, kobo_reading_state)
+    # Only the columns needed to decide about each entry are fetched here, the full books are loaded
+    # in chunks while the response is written
+    entry_columns = [db.Books.id, db.Books.uuid, db.Books.path, db.Books.title, db.Books.timestamp,
+                     db.Books.last_modified, ub.ArchivedBook.last_modified.label("archive_last_modified"),
+                     ub.ArchivedBook.is_archived]
+    if only_kobo_shelves:
+        entry_columns.append(ub.BookShelf.date_added)
+    batch = []
+    seen_ids = set()
+    for entry in changed_entries.with_entities(*entry_columns).limit(SYNC_ITEM_LIMIT):
+        if entry.id not in seen_ids:
+            seen_ids.add(entry.id)
+            batch.append(entry)
+    book_ids = [entry.id for entry in batch]
+    log.debug("Books to Sync: {}".format(len(book_ids)))
+
+    if config.config_kepubifypath and book_ids:
+        formats = dict()
+        for data in calibre_db.session.query(db.Data.book, db.Data.format, db.Data.name)\
+                .filter(db.Data.book.in_(book_ids)):
+            formats.setdefault(data.book, dict())[data.format] = data.name
+        for entry in batch:
+            book_formats = formats.get(entry.id, dict())
+            if 'KEPUB' not in book_formats and 'EPUB' in book_formats:
+                helper.queue_book_format_conversion(entry, book_formats['EPUB'], config.get_book_path(),
+                                                   'EPUB', 'KEPUB', current_user.name)
+
+    reading_states = get_or_create_reading_states(book_ids)
+
+    entitlements = []
+    for entry in batch:
+        kobo_reading_state = reading_states.get(entry.id)
+        if not kobo_reading_state.last_modified > sync_token.reading_state_last_modified:
+            kobo_reading_state = None
+        ts_created = entry.timestamp.replace(tzinfo=None)
+        date_added = getattr(entry, "date_added", None)
+        if date_added:
+            ts_created = max(ts_created, date_added)
+        entitlements.append((entry, ts_created > sync_token.books_last_created, kobo_reading_state))
+
+    # the entitlements are built before anything is marked as synced, a book whose entitlement failed is neither
+    # recorded nor moves the sync token and is offered again by the next sync
+    entitlement_results = build_entitlement_results(entitlements)
+    reading_states_in_new_entitlements = []
+    for entry, __, kobo_reading_state in entitlements:
+        if entry.id not in entitlement_results:
+            continue
+        if kobo_reading_state:
             new_reading_state_last_modified = max(new_reading_state_last_modified, kobo_reading_state.last_modified)
-            reading_states_in_new_entitlements.append(book.Books.id)
-
-        ts_created = book.Books.timestamp.replace(tzinfo=None)
-
-        try:
-            ts_created = max(ts_created, book.date_added)
-        except AttributeError:
-            pass
-
-        if ts_created > sync_token.books_last_created:
-            sync_results.append({"NewEntitlement": entitlement})
-        else:
-            sync_results.append({"ChangedEntitlement": entitlement})
-
-        new_books_last_modified = max(
-            book.Books.last_modified.replace(tzinfo=None), new_books_last_modified
-        )
-        try:
-            new_books_last_modified = max(
-                new_books_last_modified, book.date_added
-            )
-        except AttributeError:
-            pass
-
+            reading_states_in_new_entitlements.append(entry.id)
+        ts_created = entry.timestamp.replace(tzinfo=None)
+        date_added = getattr(entry, "date_added", None)
+        if date_added:
+            ts_created = max(ts_created, date_added)
+        new_books_last_modified = max(entry.last_modified.replace(tzinfo=None), new_books_last_modified)
+        if date_added:
+            new_books_last_modified = max(new_books_last_modified, date_added)
         new_books_last_created = max(ts_created, new_books_last_created)
-        kobo_sync_status.add_synced_books(book.Books.id)
+    failed_dates_added = [entry.date_added for entry in batch
+                          if entry.id not in entitlement_results and getattr(entry, "date_added", None)]
+    if failed_dates_added:
+        # shelf entries are selected by the date they were added, the token has to stay before the failed ones
+        new_books_last_modified = min(new_books_last_modified, min(failed_dates_added) - timedelta(microseconds=1))
+    phase_start = _record_phase(timings, "entitlements", phase_start)
 
     max_change = changed_entries.filter(ub.ArchivedBook.is_archived)\
         .filter(ub.ArchivedBook.user_id == current_user.id) \
@@ -257,11 +294,10 @@ def HandleSyncRequest():
 
     new_archived_last_modified = max(new_archived_last_modified, max_change)
 
-    # no. of books returned
-    book_count = changed_entries.count()
-    # last entry:
-    cont_sync = bool(book_count)
-    log.debug("Remaining books to Sync: {}".format(book_count))
+    # any entry besides this batch requires another sync round, failed books wait for the next sync
+    cont_sync = changed_entries.filter(db.Books.id.notin_(book_ids)).first() is not None
+    log.debug("Remaining books to Sync: {}".format(cont_sync))
+    phase_start = _record_phase(timings, "archive", phase_start)
     # generate reading state data
     changed_reading_states = ub.session.query(ub.KoboReadingState)
 
@@ -282,19 +318,26 @@ def HandleSyncRequest():
     changed_reading_states = changed_reading_states.filter(
         and_(ub.KoboReadingState.user_id == current_user.id,
              ub.KoboReadingState.book_id.notin_(reading_states_in_new_entitlements)))\
-        .order_by(ub.KoboReadingState.last_modified)
-    cont_sync |= bool(changed_reading_states.count() > SYNC_ITEM_LIMIT)
-    for kobo_reading_state in changed_reading_states.limit(SYNC_ITEM_LIMIT).all():
-        book = calibre_db.session.query(db.Books).filter(db.Books.id == kobo_reading_state.book_id).one_or_none()
-        if book:
-            sync_results.append({
-                "ChangedReadingState": {
-                    "ReadingState": get_kobo_reading_state_response(book, kobo_reading_state)
-                }
-            })
+        .order_by(ub.KoboReadingState.last_modified)\
+        .options(selectinload(ub.KoboReadingState.current_bookmark),
+                 selectinload(ub.KoboReadingState.statistics),
+                 selectinload(ub.KoboReadingState.book_read_link))
+    changed_reading_states = changed_reading_states.limit(SYNC_ITEM_LIMIT + 1).all()
+    cont_sync |= len(changed_reading_states) > SYNC_ITEM_LIMIT
+    changed_reading_states = changed_reading_states[:SYNC_ITEM_LIMIT]
+    state_books = dict()
+    if changed_reading_states:
+        state_books = {book.id: book for book in
+                       calibre_db.session.query(db.Books.id, db.Books.uuid, db.Books.timestamp)
+                       .filter(db.Books.id.in_([state.book_id for state in changed_reading_states]))}
+    for kobo_reading_state in changed_reading_states:
+        if kobo_reading_state.book_id in state_books:
             new_reading_state_last_modified = max(new_reading_state_last_modified, kobo_reading_state.last_modified)
+    phase_start = _record_phase(timings, "reading states", phase_start)
 
-    sync_shelves(sync_token, sync_results, only_kobo_shelves)
+    sync_results = list(itertools.chain(entitlement_results.values(),
+                                        generate_reading_state_results(changed_reading_states, state_books),
+                                        shelf_results))
 
     # update last created timestamp to distinguish between new and changed entitlements
     if not cont_sync:
@@ -303,10 +346,63 @@ def HandleSyncRequest():
     sync_token.archive_last_modified = new_archived_last_modified
     sync_token.reading_state_last_modified = new_reading_state_last_modified
 
-    return generate_sync_response(sync_token, sync_results, cont_sync)
+    return generate_sync_response(sync_token, sync_results, cont_sync, timings, phase_start,
+                                  synced_book_ids=list(entitlement_results))
+
+
+def _record_phase(timings, phase, start):
+    now = perf_counter()
+    timings[phase] = now - start
+    return now
+
+
+# Returns the entitlements of the synced books by book id, the books are loaded in chunks to keep memory usage flat.
+# Books which were deleted meanwhile or whose entitlement can't be built are left out
+def build_entitlement_results(entitlements):
+    results = OrderedDict()
+    for chunk_start in range(0, len(entitlements), SYNC_CHUNK_SIZE):
+        chunk = entitlements[chunk_start:chunk_start + SYNC_CHUNK_SIZE]
+        books = {book.id: book for book in
+                 calibre_db.session.query(db.Books)
+                 .options(selectinload(db.Books.data),
+                          selectinload(db.Books.authors),
+                          selectinload(db.Books.comments),
+                          selectinload(db.Books.series),
+                          selectinload(db.Books.languages),
+                          selectinload(db.Books.publishers))
+                 .filter(db.Books.id.in_([entry.id for entry, __, __ in chunk]))}
+        for entry, new_entitlement, kobo_reading_state in chunk:
+            book = books.get(entry.id)
+            if not book:
+                continue
+            try:
+                entitlement = {
+                    "BookEntitlement": create_book_entitlement(book, archived=(entry.is_archived == True)),
+                    "BookMetadata": get_metadata(book),
+                }
+                if kobo_reading_state:
+                    entitlement["ReadingState"] = get_kobo_reading_state_response(book, kobo_reading_state)
+            except Exception as ex:
+                log.error_or_exception("Kobo entitlement of book {} could not be created: {}".format(book.id, ex))
+                continue
+            results[entry.id] = {"NewEntitlement": entitlement} if new_entitlement \
+                else {"ChangedEntitlement": entitlement}
+    return results
+
 
+def generate_reading_state_results(changed_reading_states, state_books):
+    for kobo_reading_state in changed_reading_states:
+        book = state_books.get(kobo_reading_state.book_id)
+        if book:
+            yield {
+                "ChangedReadingState": {
+                    "ReadingState": get_kobo_reading_state_response(book, kobo_reading_state)
+                }
+            }
 
-def generate_sync_response(sync_token, sync_results, set_cont=False):
+
+def generate_sync_response(sync_token, sync_results, set_cont=False, timings=None, phase_start=None,
+                           synced_book_ids=None):
     extra_headers = {}
     if config.config_kobo_proxy and not set_cont:
         # Merge in sync results from the official Kobo store.
@@ -314,7 +410,7 @@ def generate_sync_response(sync_token, sync_results, set_cont=False):
             store_response = make_request_to_kobo_store(sync_token)
 
             store_sync_results = store_response.json()
-            sync_results += store_sync_results
+            sync_results = itertools.chain(sync_results, store_sync_results)
             sync_token.merge_from_store_response(store_response)
             extra_headers["x-kobo-sync"] = store_response.headers.get("x-kobo-sync")
             extra_headers["x-kobo-sync-mode"] = store_response.headers.get("x-kobo-sync-mode")
@@ -324,15 +420,34 @@ def generate_sync_response(sync_token, sync_results, set_cont=False):
             log.error_or_exception("Failed to receive or parse response from Kobo's sync endpoint: {}".format(ex))
     if set_cont:
         extra_headers["x-kobo-sync"] = "continue"
+    # jsonify decodes the Unicode string different to what kobo expects. Everything is serialized before the new
+    # token is sent, a failure results in an error response and the client keeps its old token
+    serialized_results = [json.dumps(result) for result in sync_results]
+    # books are only recorded as synced once their entitlements are ready to be sent
+    kobo_sync_status.add_synced_books_batch(synced_book_ids)
     sync_token.to_headers(extra_headers)
 
-    # log.debug("Kobo Sync Content: {}".format(sync_results))
-    # jsonify decodes the Unicode string different to what kobo expects
-    response = make_response(json.dumps(sync_results), extra_headers)
+    response = Response(stream_with_context(_stream_sync_results(serialized_results, timings, phase_start)),
+                        headers=extra_headers)
     response.headers["Content-Type"] = "application/json; charset=utf-8"
     return response
 
 
+# Writes the serialized sync results entry by entry
+def _stream_sync_results(serialized_results, timings=None, phase_start=None):
+    yield "["
+    separator = ""
+    for result in serialized_results:
+        yield separator + result
+        separator = ", "
+    yield "]"
+    if timings is not None:
+        _record_phase(timings, "response", phase_start)
+        kobo_sync_status.record_sync_timings(timings)
+        log.debug("Kobo sync timings: {}".format(", ".join("{} {:.1f} ms".format(phase, duration * 1000)
+                                                            for phase, duration in timings.items())))
+
+
 @kobo.route("/v1/library/<book_uuid>/metadata")
 @requires_kobo_auth
 @download_required
@@ -439,14 +554,23 @@ def get_language(book):
 def get_metadata(book):
     download_urls = []
     kepub = [data for data in book.data if data.format == 'KEPUB']
-
-    for book_data in kepub if len(kepub) > 0 else book.data:
-        if book_data.format not in KOBO_FORMATS:
-            continue
-        for kobo_format in KOBO_FORMATS[book_data.format]:
-            # log.debug('Id: %s, Format: %s' % (book.id, kobo_format))
-            try:
-                if get_epub_layout(book, book_data) == 'pre-paginated':
+    # the layout is read when files are added, sync only checks that the file is unchanged
+    layout_cache = get_epub_layout_cache(ub.app_DB_path)
+    layout_reader = layout_cache.open_reader()
+    try:
+        for book_data in kepub if len(kepub) > 0 else book.data:
+            if book_data.format not in KOBO_FORMATS:
+                continue
+            file_path = os.path.normpath(os.path.join(config.get_book_path(), book.path,
+                                                      book_data.name + "." + book_data.format.lower()))
+            known, layout = layout_cache.lookup(layout_reader, book.id, book_data.format, file_path)
+            if not known:
+                # the entitlement isn't sent again for an unchanged book, the layout has to be right now
+                layout = layout_cache.update(book.id, book_data.format, file_path, read_epub_layout)
+                helper.update_epub_layout_cache()
+            for kobo_format in KOBO_FORMATS[book_data.format]:
+                # log.debug('Id: %s, Format: %s' % (book.id, kobo_format))
+                if layout == 'pre-paginated':
                     kobo_format = 'EPUB3FL'
                 download_urls.append(
                     {
@@ -458,8 +582,8 @@ def get_metadata(book):
                         # "DrmType": "None", # Not required
                     }
                 )
-            except (zipfile.BadZipfile, FileNotFoundError) as e:
-                log.error(e)
+    finally:
+        layout_reader.close()
 
     book_uuid = book.uuid
     metadata = {
@@ -683,7 +807,8 @@ def sync_shelves(sync_token, sync_results, only_kobo_shelves=False):
             }
         })
         ub.session.delete(shelf)
-        ub.session_commit()
+    # all archived shelves are removed in one transaction
+    ub.session_commit()
 
     extra_filters = []
     if only_kobo_shelves:
@@ -741,14 +866,18 @@ def create_kobo_tag(shelf):
         "Name": shelf.name,
         "Type": "UserTag"
     }
-    for book_shelf in shelf.books:
-        book = calibre_db.get_book(book_shelf.book_id)
-        if not book:
-            log.info("Book (id: %s) in BookShelf (id: %s) not found in book database",  book_shelf.book_id, shelf.id)
+    book_ids = [book_shelf.book_id for book_shelf in shelf.books]
+    uuids = dict()
+    for chunk_start in range(0, len(book_ids), TAG_ITEM_CHUNK_SIZE):
+        uuids.update(calibre_db.session.query(db.Books.id, db.Books.uuid)
+                     .filter(db.Books.id.in_(book_ids[chunk_start:chunk_start + TAG_ITEM_CHUNK_SIZE])))
+    for book_id in book_ids:
+        if book_id not in uuids:
+            log.info("Book (id: %s) in BookShelf (id: %s) not found in book database",  book_id, shelf.id)
             continue
         tag["Items"].append(
             {
-                "RevisionId": book.uuid,
+                "RevisionId": uuids[book_id],
                 "Type": "ProductRevisionTagItem"
             }
         )
@@ -852,6 +981,34 @@ def get_or_create_reading_state(book_id):
     return book_read.kobo_reading_state
 
 
+# Bulk version of get_or_create_reading_state, returns the reading states of the current user by book id
+def get_or_create_reading_states(book_ids):
+    if not book_ids:
+        return dict()
+    books_read = dict()
+    for book_read in ub.session.query(ub.ReadBook)\
+            .filter(ub.ReadBook.user_id == int(current_user.id), ub.ReadBook.book_id.in_(book_ids))\
+            .options(selectinload(ub.ReadBook.kobo_reading_state)):
+        books_read.setdefault(book_read.book_id, book_read)
+    for book_id in book_ids:
+        book_read = books_read.get(book_id)
+        if not book_read:
+            book_read = ub.ReadBook(user_id=current_user.id, book_id=book_id)
+            ub.session.add(book_read)
+        if not book_read.kobo_reading_state:
+            kobo_reading_state = ub.KoboReadingState(user_id=book_read.user_id, book_id=book_id)
+            kobo_reading_state.current_bookmark = ub.KoboBookmark()
+            kobo_reading_state.statistics = ub.KoboStatistics()
+            book_read.kobo_reading_state = kobo_reading_state
+    ub.session_commit()
+    return {kobo_reading_state.book_id: kobo_reading_state for kobo_reading_state in
+            ub.session.query(ub.KoboReadingState)
+            .filter(ub.KoboReadingState.user_id == int(current_user.id), ub.KoboReadingState.book_id.in_(book_ids))
+            .options(selectinload(ub.KoboReadingState.current_bookmark),
+                     selectinload(ub.KoboReadingState.statistics),
+                     selectinload(ub.KoboReadingState.book_read_link))}
+
+
 def get_kobo_reading_state_response(book, kobo_reading_state):
     return {
         "EntitlementId": book.uuid,
@@ -17,12 +17,19 @@
 #  along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
+import threading
+from collections import OrderedDict
+
 from .cw_login import current_user
 from . import ub
 from datetime import datetime, timezone
 from sqlalchemy.sql.expression import or_, and_, true
 # from sqlalchemy import exc
 
+# accumulated duration of the phases of kobo library sync requests
+_sync_timings = OrderedDict()
+_sync_timings_lock = threading.Lock()
+
 
 # Add the current book id to kobo_synced_books table for current user, if entry is already present,
 # do nothing (safety precaution)
@@ -37,6 +44,20 @@ def add_synced_books(book_id):
         ub.session_commit()
 
 
+# Add all given book ids which are not already present to kobo_synced_books table for current user
+def add_synced_books_batch(book_ids):
+    if not book_ids:
+        return
+    present = set(entry.book_id for entry in ub.session.query(ub.KoboSyncedBooks.book_id)
+                  .filter(ub.KoboSyncedBooks.book_id.in_(book_ids))
+                  .filter(ub.KoboSyncedBooks.user_id == current_user.id))
+    for book_id in book_ids:
+        if book_id not in present:
+            ub.session.add(ub.KoboSyncedBooks(user_id=current_user.id, book_id=book_id))
+            present.add(book_id)
+    ub.session_commit()
+
+
 # Select all entries of current book in kobo_synced_books table, which are from current user and delete them
 def remove_synced_book(book_id, all=False, session=None):
     if not all:
@@ -88,3 +109,16 @@ def update_on_sync_shelfs(user_id):
     for a in shelves_to_archive:
         ub.session.add(ub.ShelfArchive(uuid=a.uuid, user_id=user_id))
         ub.session_commit()
+
+
+def record_sync_timings(timings):
+    with _sync_timings_lock:
+        for phase, duration in timings.items():
+            count, total = _sync_timings.get(phase, (0, 0.0))
+            _sync_timings[phase] = (count + 1, total + duration)
+
+
+# Returns number of measurements and average duration in seconds per sync phase
+def get_sync_timings():
+    with _sync_timings_lock:
+        return OrderedDict((phase, (count, total / count)) for phase, (count, total) in _sync_timings.items())
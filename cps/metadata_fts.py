@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime
+from urllib.request import pathname2url
+
+from . import logger
+
+log = logger.create()
+
+# custom column types which are part of the simple search
+FTS_CC_DATATYPES = ('text', 'comments', 'enumeration')
+# rows written per transaction
+_BATCH_SIZE = 500
+
+
+class MetadataFTSIndex:
+    """FTS5 index over the searchable metadata of metadata.db, stored in a sidecar database next to app.db.
+    metadata.db is only opened read-only. The index is attached to the calibre database connections as
+    'metadata_fts' so searches can use it as subquery"""
+    def __init__(self, app_db_path):
+        settings_dir = os.path.dirname(app_db_path) if app_db_path else "."
+        self._db_path = os.path.join(settings_dir, "metadata_fts.db")
+        self._lock = threading.Lock()
+        self._schema_ready = False
+        self._ready_columns = None
+        # library state the last library wide sync started with, searches only use the index while it is current
+        self._synced_state = None
+        self._sync_lock = threading.Lock()
+        self._sync_pending = False
+
+    @property
+    def db_path(self):
+        return self._db_path
+
+    def _connect(self):
+        conn = sqlite3.connect(self._db_path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _init_schema(self, conn):
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5("
+            "title, authors, series, tags, publishers, comments, custom, "
+            "tokenize='unicode61 remove_diacritics 2')"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS books_fts_state (key TEXT PRIMARY KEY, value TEXT)")
+        conn.commit()
+        self._schema_ready = True
+
+    def ensure_schema(self):
+        if not self._schema_ready:
+            with self._lock:
+                if not self._schema_ready:
+                    conn = self._connect()
+                    try:
+                        self._init_schema(conn)
+                    finally:
+                        conn.close()
+
+    @staticmethod
+    def columns_signature(custom_columns):
+        return ",".join(str(c.id) for c in sorted(custom_columns, key=lambda c: c.id)
+                        if c.datatype in FTS_CC_DATATYPES)
+
+    def is_ready(self, custom_columns):
+        """The index can answer searches once a full sync with the same set of custom columns has finished"""
+        signature = self.columns_signature(custom_columns)
+        if self._ready_columns is None:
+            self.ensure_schema()
+            conn = self._connect()
+            try:
+                state = dict(conn.execute("SELECT key, value FROM books_fts_state "
+                                          "WHERE key IN ('columns', 'synced_at')").fetchall())
+            finally:
+                conn.close()
+            # the signature is empty without searchable custom columns, synced_at marks a completed sync
+            self._ready_columns = state.get("columns", "") if "synced_at" in state else False
+        return self._ready_columns is not False and self._ready_columns == signature
+
+    def is_current(self, library_state):
+        """True if metadata.db wasn't changed since the last library wide sync"""
+        return library_state is not None and library_state == self._synced_state
+
+    def claim_sync(self):
+        """True if no library wide sync is pending, the caller has to queue one then"""
+        with self._sync_lock:
+            if self._sync_pending:
+                return False
+            self._sync_pending = True
+            return True
+
+    def sync_done(self):
+        with self._sync_lock:
+            self._sync_pending = False
+
+    @staticmethod
+    def build_match_query(term):
+        # every word has to match the start of a word in any of the indexed columns
+        tokens = [t for t in re.split(r"[\s,]+", term) if t]
+        return " ".join('"{}"*'.format(token.replace('"', '""')) for token in tokens)
+
+    @staticmethod
+    def _book_select(custom_columns):
+        columns = [
+            "b.id",
+            "b.last_modified",
+            "b.title",
+            "(SELECT group_concat(replace(a.name, '|', ','), ' ') FROM books_authors_link l "
+            "JOIN authors a ON a.id = l.author WHERE l.book = b.id)",
+            "(SELECT group_concat(s.name, ' ') FROM books_series_link l "
+            "JOIN series s ON s.id = l.series WHERE l.book = b.id)",
+            "(SELECT group_concat(t.name, ' ') FROM books_tags_link l "
+            "JOIN tags t ON t.id = l.tag WHERE l.book = b.id)",
+            "(SELECT group_concat(p.name, ' ') FROM books_publishers_link l "
+            "JOIN publishers p ON p.id = l.publisher WHERE l.book = b.id)",
+            "(SELECT group_concat(c.text, ' ') FROM comments c WHERE c.book = b.id)",
+        ]
+        custom = []
+        for c in custom_columns:
+            if c.datatype == 'comments':
+                custom.append("(SELECT group_concat(v.value, ' ') FROM custom_column_{0} v "
+                              "WHERE v.book = b.id)".format(int(c.id)))
+            elif c.datatype in FTS_CC_DATATYPES:
+                custom.append("(SELECT group_concat(v.value, ' ') FROM books_custom_column_{0}_link l "
+                              "JOIN custom_column_{0} v ON v.id = l.value WHERE l.book = b.id)".format(int(c.id)))
+        columns.append(" || ' ' || ".join("coalesce({}, '')".format(c) for c in custom) if custom else "''")
+        return "SELECT " + ", ".join(columns) + " FROM books b"
+
+    def _write_rows(self, conn, cursor):
+        count = 0
+        max_modified = ""
+        while True:
+            rows = cursor.fetchmany(_BATCH_SIZE)
+            if not rows:
+                break
+            conn.executemany("DELETE FROM books_fts WHERE rowid = ?", [(row[0],) for row in rows])
+            conn.executemany(
+                "INSERT INTO books_fts(rowid, title, authors, series, tags, publishers, comments, custom) "
+                "VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+                [(row[0],) + tuple(row[2:]) for row in rows])
+            conn.commit()
+            count += len(rows)
+            max_modified = max([max_modified] + [str(row[1] or "") for row in rows])
+        return count, max_modified
+
+    def _open_library(self, calibre_dir):
+        uri = "file:{}?mode=ro".format(pathname2url(os.path.join(calibre_dir, "metadata.db")))
+        return sqlite3.connect(uri, uri=True)
+
+    def sync(self, calibre_dir, custom_columns, book_ids=None, library_state=None):
+        """Updates the index. With book_ids only these books are reindexed, otherwise all books modified
+        since the last sync are reindexed and deleted books are removed. A changed set of searchable
+        custom columns triggers a full rebuild. library_state is the state of metadata.db before the sync"""
+        custom_columns = [c for c in custom_columns if c.datatype in FTS_CC_DATATYPES]
+        signature = self.columns_signature(custom_columns)
+        with self._lock:
+            library = self._open_library(calibre_dir)
+            conn = self._connect()
+            try:
+                self._init_schema(conn)
+                state = dict(conn.execute("SELECT key, value FROM books_fts_state").fetchall())
+                select = self._book_select(custom_columns)
+                removed = 0
+                if book_ids is not None:
+                    book_ids = [int(book_id) for book_id in book_ids]
+                    cursor = library.execute(select + " WHERE b.id IN ({})".format(",".join("?" * len(book_ids))),
+                                             book_ids)
+                    indexed, __ = self._write_rows(conn, cursor)
+                    present = set(row[0] for row in library.execute(
+                        "SELECT id FROM books WHERE id IN ({})".format(",".join("?" * len(book_ids))), book_ids))
+                    missing = [(book_id,) for book_id in book_ids if book_id not in present]
+                    conn.executemany("DELETE FROM books_fts WHERE rowid = ?", missing)
+                    removed = len(missing)
+                    conn.commit()
+                    return {"indexed": indexed, "removed": removed}
+
+                full_rebuild = state.get("columns") != signature
+                if full_rebuild:
+                    conn.execute("DELETE FROM books_fts")
+                    cursor = library.execute(select)
+                else:
+                    # calibre and Calibre-Web update last_modified on every metadata change
+                    cursor = library.execute(select + " WHERE b.last_modified >= ?",
+                                             (state.get("last_modified", ""),))
+                indexed, max_modified = self._write_rows(conn, cursor)
+                if not full_rebuild:
+                    library_ids = set(row[0] for row in library.execute("SELECT id FROM books"))
+                    stale = [(row[0],) for row in conn.execute("SELECT rowid FROM books_fts")
+                             if row[0] not in library_ids]
+                    conn.executemany("DELETE FROM books_fts WHERE rowid = ?", stale)
+                    removed = len(stale)
+                if max_modified:
+                    conn.execute("INSERT OR REPLACE INTO books_fts_state(key, value) VALUES('last_modified', ?)",
+                                 (max(max_modified, state.get("last_modified", "")),))
+                conn.execute("INSERT OR REPLACE INTO books_fts_state(key, value) VALUES('columns', ?)",
+                             (signature,))
+                conn.execute("INSERT OR REPLACE INTO books_fts_state(key, value) VALUES('synced_at', ?)",
+                             (datetime.utcnow().isoformat(),))
+                conn.commit()
+                self._ready_columns = signature
+                self._synced_state = library_state
+                return {"indexed": indexed, "removed": removed}
+            finally:
+                conn.close()
+                library.close()
+
+    def clear(self):
+        with self._lock:
+            conn = self._connect()
+            try:
+                self._init_schema(conn)
+                conn.execute("DELETE FROM books_fts")
+                conn.execute("DELETE FROM books_fts_state")
+                conn.commit()
+                self._ready_columns = False
+                self._synced_state = None
+            finally:
+                conn.close()
+
+
+_instance = None
+_instance_lock = threading.Lock()
+
+
+def get_metadata_fts_index(app_db_path):
+    global _instance
+    with _instance_lock:
+        if _instance is None:
+            _instance = MetadataFTSIndex(app_db_path)
+        return _instance
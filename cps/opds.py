@@ -28,10 +28,10 @@ from flask_babel import get_locale
 from flask_babel import gettext as _
 
 
-from sqlalchemy.sql.expression import func, text, or_, and_, true
+from sqlalchemy.sql.expression import func, or_, and_, true
 from sqlalchemy.exc import InvalidRequestError, OperationalError
 
-from . import logger, config, db, calibre_db, ub, isoLanguages, constants
+from . import logger, config, db, calibre_db, ub, isoLanguages, constants, category_index
 from .usermanagement import requires_basic_auth_if_no_ano, auth
 from .helper import get_download_link, get_book_cover
 from .pagination import Pagination
@@ -82,11 +82,11 @@ def feed_booksindex():
 def feed_letter_books(book_id):
     off = request.args.get("offset") or 0
     letter = true() if book_id == "00" else func.upper(db.Books.sort).startswith(book_id)
-    entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
-                                                        db.Books,
-                                                        letter,
-                                                        [db.Books.sort],
-                                                        True, config.config_read_column)
+    entries, __, pagination = fill_feed_page((int(off) / (int(config.config_books_per_page)) + 1), 0,
+                                             db.Books,
+                                             letter,
+                                             [db.Books.sort],
+                                             True, config.config_read_column)
     cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination, cc=cc)
 
@@ -97,9 +97,9 @@ def feed_new():
     if not auth.current_user().check_visibility(constants.SIDEBAR_RECENT):
         abort(404)
     off = request.args.get("offset") or 0
-    entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
-                                                        db.Books, True, [db.Books.timestamp.desc()],
-                                                        True, config.config_read_column)
+    entries, __, pagination = fill_feed_page((int(off) / (int(config.config_books_per_page)) + 1), 0,
+                                             db.Books, True, [db.Books.timestamp.desc()],
+                                             True, config.config_read_column)
     cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination, cc=cc)
 
@@ -109,8 +109,7 @@ def feed_new():
 def feed_discover():
     if not auth.current_user().check_visibility(constants.SIDEBAR_RANDOM):
         abort(404)
-    query = calibre_db.generate_linked_query(config.config_read_column, db.Books)
-    entries = query.filter(calibre_db.common_filters()).order_by(func.random()).limit(config.config_books_per_page)
+    entries = calibre_db.random_books(config.config_books_per_page, config.config_read_column)
     pagination = Pagination(1, config.config_books_per_page, int(config.config_books_per_page))
     cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination, cc=cc)
@@ -122,10 +121,10 @@ def feed_best_rated():
     if not auth.current_user().check_visibility(constants.SIDEBAR_BEST_RATED):
         abort(404)
     off = request.args.get("offset") or 0
-    entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
-                                                        db.Books, db.Books.ratings.any(db.Ratings.rating > 9),
-                                                        [db.Books.timestamp.desc()],
-                                                        True, config.config_read_column)
+    entries, __, pagination = fill_feed_page((int(off) / (int(config.config_books_per_page)) + 1), 0,
+                                             db.Books, db.Books.ratings.any(db.Ratings.rating > 9),
+                                             [db.Books.timestamp.desc()],
+                                             True, config.config_read_column)
     cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination, cc=cc)
 
@@ -136,21 +135,11 @@ def feed_hot():
     if not auth.current_user().check_visibility(constants.SIDEBAR_HOT):
         abort(404)
     off = request.args.get("offset") or 0
-    all_books = ub.session.query(ub.Downloads, func.count(ub.Downloads.book_id)).order_by(
-        func.count(ub.Downloads.book_id).desc()).group_by(ub.Downloads.book_id)
-    hot_books = all_books.offset(off).limit(config.config_books_per_page)
-    entries = list()
-    for book in hot_books:
-        query = calibre_db.generate_linked_query(config.config_read_column, db.Books)
-        download_book = query.filter(calibre_db.common_filters()).filter(
-            book.Downloads.book_id == db.Books.id).first()
-        if download_book:
-            entries.append(download_book)
-        else:
-            ub.delete_download(book.Downloads.book_id)
-    num_books = entries.__len__()
-    pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1),
-                            config.config_books_per_page, num_books)
+    entries, __, pagination = fill_feed_page((int(off) / (int(config.config_books_per_page)) + 1), 0,
+                                             db.Books, ub.DownloadCount.count > 0,
+                                             [ub.DownloadCount.count.desc()],
+                                             True, config.config_read_column,
+                                             ub.DownloadCount, ub.DownloadCount.book_id == db.Books.id)
     cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination, cc=cc)
 
@@ -160,7 +149,7 @@ def feed_hot():
 def feed_authorindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_AUTHOR):
         abort(404)
-    return render_element_index(db.Authors.sort, db.books_authors_link, 'opds.feed_letter_author')
+    return render_category_index(category_index.CATEGORY_AUTHOR, 'opds.feed_letter_author')
 
 
 @opds.route("/opds/author/letter/<book_id>")
@@ -168,17 +157,7 @@ def feed_authorindex():
 def feed_letter_author(book_id):
     if not auth.current_user().check_visibility(constants.SIDEBAR_AUTHOR):
         abort(404)
-    off = request.args.get("offset") or 0
-    letter = true() if book_id == "00" else func.upper(db.Authors.sort).startswith(book_id)
-    entries = calibre_db.session.query(db.Authors).join(db.books_authors_link).join(db.Books)\
-        .filter(calibre_db.common_filters()).filter(letter)\
-        .group_by(text('books_authors_link.author'))\
-        .order_by(db.Authors.sort)
-    pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1), config.config_books_per_page,
-                            entries.count())
-    entries = entries.limit(config.config_books_per_page).offset(off).all()
-    cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
-    return render_xml_template('feed.xml', listelements=entries, folder='opds.feed_author', pagination=pagination, cc=cc)
+    return render_category_letter(category_index.CATEGORY_AUTHOR, book_id, 'opds.feed_author')
 
 
 @opds.route("/opds/author/<int:book_id>")
@@ -192,17 +171,7 @@ def feed_author(book_id):
 def feed_publisherindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_PUBLISHER):
         abort(404)
-    off = request.args.get("offset") or 0
-    entries = calibre_db.session.query(db.Publishers)\
-        .join(db.books_publishers_link)\
-        .join(db.Books).filter(calibre_db.common_filters())\
-        .group_by(text('books_publishers_link.publisher'))\
-        .order_by(db.Publishers.sort)\
-        .limit(config.config_books_per_page).offset(off)
-    pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1), config.config_books_per_page,
-                            len(calibre_db.session.query(db.Publishers).all()))
-    cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
-    return render_xml_template('feed.xml', listelements=entries, folder='opds.feed_publisher', pagination=pagination, cc=cc)
+    return render_category_letter(category_index.CATEGORY_PUBLISHER, "00", 'opds.feed_publisher')
 
 
 @opds.route("/opds/publisher/<int:book_id>")
@@ -216,7 +185,7 @@ def feed_publisher(book_id):
 def feed_categoryindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_CATEGORY):
         abort(404)
-    return render_element_index(db.Tags.name, db.books_tags_link, 'opds.feed_letter_category')
+    return render_category_index(category_index.CATEGORY_TAG, 'opds.feed_letter_category')
 
 
 @opds.route("/opds/category/letter/<book_id>")
@@ -224,19 +193,7 @@ def feed_categoryindex():
 def feed_letter_category(book_id):
     if not auth.current_user().check_visibility(constants.SIDEBAR_CATEGORY):
         abort(404)
-    off = request.args.get("offset") or 0
-    letter = true() if book_id == "00" else func.upper(db.Tags.name).startswith(book_id)
-    entries = calibre_db.session.query(db.Tags)\
-        .join(db.books_tags_link)\
-        .join(db.Books)\
-        .filter(calibre_db.common_filters()).filter(letter)\
-        .group_by(text('books_tags_link.tag'))\
-        .order_by(db.Tags.name)
-    pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1), config.config_books_per_page,
-                            entries.count())
-    entries = entries.offset(off).limit(config.config_books_per_page).all()
-    cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
-    return render_xml_template('feed.xml', listelements=entries, folder='opds.feed_category', pagination=pagination, cc=cc)
+    return render_category_letter(category_index.CATEGORY_TAG, book_id, 'opds.feed_category')
 
 
 @opds.route("/opds/category/<int:book_id>")
@@ -250,7 +207,7 @@ def feed_category(book_id):
 def feed_seriesindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_SERIES):
         abort(404)
-    return render_element_index(db.Series.sort, db.books_series_link, 'opds.feed_letter_series')
+    return render_category_index(category_index.CATEGORY_SERIES, 'opds.feed_letter_series')
 
 
 @opds.route("/opds/series/letter/<book_id>")
@@ -258,30 +215,18 @@ def feed_seriesindex():
 def feed_letter_series(book_id):
     if not auth.current_user().check_visibility(constants.SIDEBAR_SERIES):
         abort(404)
-    off = request.args.get("offset") or 0
-    letter = true() if book_id == "00" else func.upper(db.Series.sort).startswith(book_id)
-    entries = calibre_db.session.query(db.Series)\
-        .join(db.books_series_link)\
-        .join(db.Books)\
-        .filter(calibre_db.common_filters()).filter(letter)\
-        .group_by(text('books_series_link.series'))\
-        .order_by(db.Series.sort)
-    pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1), config.config_books_per_page,
-                            entries.count())
-    entries = entries.offset(off).limit(config.config_books_per_page).all()
-    cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
-    return render_xml_template('feed.xml', listelements=entries, folder='opds.feed_series', pagination=pagination, cc=cc)
+    return render_category_letter(category_index.CATEGORY_SERIES, book_id, 'opds.feed_series')
 
 
 @opds.route("/opds/series/<int:book_id>")
 @requires_basic_auth_if_no_ano
 def feed_series(book_id):
     off = request.args.get("offset") or 0
-    entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
-                                                        db.Books,
-                                                        db.Books.series.any(db.Series.id == book_id),
-                                                        [db.Books.series_index],
-                                                        True, config.config_read_column)
+    entries, __, pagination = fill_feed_page((int(off) / (int(config.config_books_per_page)) + 1), 0,
+                                             db.Books,
+                                             db.Books.series.any(db.Series.id == book_id),
+                                             [db.Books.series_index],
+                                             True, config.config_read_column)
     cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination, cc=cc)
 
@@ -292,19 +237,13 @@ def feed_ratingindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_RATING):
         abort(404)
     off = request.args.get("offset") or 0
-    entries = calibre_db.session.query(db.Ratings, func.count('books_ratings_link.book').label('count'),
-                                       (db.Ratings.rating / 2).label('name')) \
-        .join(db.books_ratings_link)\
-        .join(db.Books)\
-        .filter(calibre_db.common_filters()) \
-        .group_by(text('books_ratings_link.rating'))\
-        .order_by(db.Ratings.rating).all()
-
+    entries = sorted(calibre_db.category_counts(category_index.CATEGORY_RATING).entries,
+                     key=lambda x: x.item.rating)
     pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1), config.config_books_per_page,
                             len(entries))
     element = list()
     for entry in entries:
-        element.append(FeedObject(entry[0].id, _("{} Stars").format(entry.name)))
+        element.append(FeedObject(entry.item.id, _("{} Stars").format(entry.name)))
     cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
     return render_xml_template('feed.xml', listelements=element, folder='opds.feed_ratings', pagination=pagination, cc=cc)
 
@@ -321,15 +260,11 @@ def feed_formatindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_FORMAT):
         abort(404)
     off = request.args.get("offset") or 0
-    entries = calibre_db.session.query(db.Data).join(db.Books)\
-        .filter(calibre_db.common_filters()) \
-        .group_by(db.Data.format)\
-        .order_by(db.Data.format).all()
+    entries = sorted(calibre_db.category_counts(category_index.CATEGORY_FORMAT).entries, key=lambda x: x.format)
     pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1), config.config_books_per_page,
                             len(entries))
-    element = list()
-    for entry in entries:
-        element.append(FeedObject(entry.format, entry.format))
+    # format items carry the format as id and name
+    element = [entry.item for entry in entries]
     cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
     return render_xml_template('feed.xml', listelements=element, folder='opds.feed_format', pagination=pagination, cc=cc)
 
@@ -338,11 +273,11 @@ def feed_formatindex():
 @requires_basic_auth_if_no_ano
 def feed_format(book_id):
     off = request.args.get("offset") or 0
-    entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
-                                                        db.Books,
-                                                        db.Books.data.any(db.Data.format == book_id.upper()),
-                                                        [db.Books.timestamp.desc()],
-                                                        True, config.config_read_column)
+    entries, __, pagination = fill_feed_page((int(off) / (int(config.config_books_per_page)) + 1), 0,
+                                             db.Books,
+                                             db.Books.data.any(db.Data.format == book_id.upper()),
+                                             [db.Books.timestamp.desc()],
+                                             True, config.config_read_column)
     cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination, cc=cc)
 
@@ -370,11 +305,11 @@ def feed_languagesindex():
 @requires_basic_auth_if_no_ano
 def feed_languages(book_id):
     off = request.args.get("offset") or 0
-    entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
-                                                        db.Books,
-                                                        db.Books.languages.any(db.Languages.id == book_id),
-                                                        [db.Books.timestamp.desc()],
-                                                        True, config.config_read_column)
+    entries, __, pagination = fill_feed_page((int(off) / (int(config.config_books_per_page)) + 1), 0,
+                                             db.Books,
+                                             db.Books.languages.any(db.Languages.id == book_id),
+                                             [db.Books.timestamp.desc()],
+                                             True, config.config_read_column)
     cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination, cc=cc)
 
@@ -412,13 +347,13 @@ def feed_shelf(book_id):
     pagination = list()
     # user is allowed to access shelf
     if shelf:
-        result, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1),
-                                                           config.config_books_per_page,
-                                                           db.Books,
-                                                           ub.BookShelf.shelf == shelf.id,
-                                                           [ub.BookShelf.order.asc()],
-                                                           True, config.config_read_column,
-                                                           ub.BookShelf, ub.BookShelf.book_id == db.Books.id)
+        result, __, pagination = fill_feed_page((int(off) / (int(config.config_books_per_page)) + 1),
+                                                config.config_books_per_page,
+                                                db.Books,
+                                                ub.BookShelf.shelf == shelf.id,
+                                                [ub.BookShelf.order.asc()],
+                                                True, config.config_read_column,
+                                                ub.BookShelf, ub.BookShelf.book_id == db.Books.id)
         # delete shelf entries where book is not existent anymore, can happen if book is deleted outside calibre-web
         wrong_entries = calibre_db.session.query(ub.BookShelf) \
             .join(db.Books, ub.BookShelf.book_id == db.Books.id, isouter=True) \
@@ -526,6 +461,11 @@ def feed_search(term):
 
 
 
+def fill_feed_page(*args):
+    # clients walk a feed by its next links, later pages continue after the last book and reuse the first total
+    return calibre_db.fill_indexpage(*args, cursor=request.args.get("cursor"), keyset=True, exact_count=False)
+
+
 def render_xml_template(*args, **kwargs):
     # ToDo: return time in current timezone similar to %z
     currtime = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S+00:00")
@@ -537,15 +477,51 @@ def render_xml_template(*args, **kwargs):
 
 def render_xml_dataset(data_table, book_id):
     off = request.args.get("offset") or 0
-    entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
-                                                        db.Books,
-                                                        getattr(db.Books, data_table.__tablename__).any(data_table.id == book_id),
-                                                        [db.Books.timestamp.desc()],
-                                                        True, config.config_read_column)
+    entries, __, pagination = fill_feed_page((int(off) / (int(config.config_books_per_page)) + 1), 0,
+                                             db.Books,
+                                             getattr(db.Books, data_table.__tablename__).any(data_table.id == book_id),
+                                             [db.Books.timestamp.desc()],
+                                             True, config.config_read_column)
     cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination, cc=cc)
 
 
+def render_category_index(category, folder):
+    # first letters of the categories visible to the user, from the category index
+    shift = 0
+    off = int(request.args.get("offset") or 0)
+    char_list = calibre_db.category_counts(category).char_list
+    elements = []
+    if off == 0 and char_list:
+        elements.append({'id': "00", 'name': _("All")})
+        shift = 1
+    for char in char_list[off + shift - 1:int(off + int(config.config_books_per_page) - shift)]:
+        elements.append({'id': char, 'name': char})
+    pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1), config.config_books_per_page,
+                            len(char_list) + 1)
+    cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
+    return render_xml_template('feed.xml', letterelements=elements, folder=folder, pagination=pagination, cc=cc)
+
+
+def render_category_letter(category, letter, folder):
+    # read-only category items instead of session bound entities, ordered like the sort column of the category
+    off = int(request.args.get("offset") or 0)
+    by_sort = category in (category_index.CATEGORY_AUTHOR, category_index.CATEGORY_SERIES,
+                           category_index.CATEGORY_PUBLISHER)
+    items = [entry.item for entry in calibre_db.category_counts(category).entries]
+    if by_sort:
+        items.sort(key=lambda x: (x.sort or "").lower())
+    else:
+        items.sort(key=lambda x: x.name.lower())
+    if letter != "00":
+        items = [item for item in items if ((item.sort if by_sort else item.name) or "").upper().startswith(letter)]
+    pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1), config.config_books_per_page,
+                            len(items))
+    items = items[off:off + int(config.config_books_per_page)]
+    cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
+    return render_xml_template('feed.xml', listelements=items, folder=folder, pagination=pagination, cc=cc)
+
+
 def render_element_index(database_column, linked_table, folder):
     shift = 0
     off = int(request.args.get("offset") or 0)
@@ -20,15 +20,37 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import base64
+import binascii
+import json
 from math import ceil
 
 
+def encode_cursor(signature, values, total_count):
+    """Opaque token for the page following the row with the given sort values"""
+    payload = json.dumps({"o": signature, "v": list(values), "t": int(total_count)}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token, signature):
+    """Returns (values, total_count) of a cursor, None if it is invalid or belongs to a different sort order"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode("utf-8"))
+        if payload["o"] != signature or not isinstance(payload["v"], list):
+            return None
+        return payload["v"], int(payload["t"])
+    except (binascii.Error, ValueError, TypeError, KeyError, UnicodeDecodeError):
+        return None
+
+
 # simple pagination for the feed
 class Pagination(object):
-    def __init__(self, page, per_page, total_count):
+    def __init__(self, page, per_page, total_count, next_cursor=None):
         self.page = int(page)
         self.per_page = int(per_page)
         self.total_count = int(total_count)
+        # continues after the last row of this page without counting the rows before, if the sort order allows it
+        self.next_cursor = next_cursor
 
     @property
     def next_offset(self):
@@ -55,7 +77,7 @@ class Pagination(object):
 
     @property
     def has_next(self):
-        return self.page < self.pages
+        return self.next_cursor is not None or self.page < self.pages
 
     # right_edge: last right_edges count of all pages are shown as number, means, if 10 pages are paginated -> 9,10 shown
     # left_edge: first left_edges count of all pages are shown as number                                    -> 1,2 shown
@@ -16,10 +16,17 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import itertools
+import threading
+from collections import namedtuple
+
 from flask import render_template, g, abort, request
 from flask_babel import gettext as _
+from flask_babel import get_locale
 from werkzeug.local import LocalProxy
 from .cw_login import current_user
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
 from sqlalchemy.sql.expression import or_
 
 from . import config, constants, logger, ub
@@ -28,6 +35,55 @@ from .ub import User
 
 log = logger.create()
 
+# The sidebar entries are cached per user, locale and the settings they depend on, the accessible shelves
+# per user. Every committed change of shelves or shelf entries in app.db clears the cache
+_sidebar_cache = dict()
+_shelves_cache = dict()
+_sidebar_cache_lock = threading.Lock()
+# increased on every invalidation, entries read before it are not stored
+_cache_generation = 0
+
+SidebarShelf = namedtuple('SidebarShelf', ['id', 'name', 'is_public', 'book_count'])
+
+
+def invalidate_sidebar_cache():
+    global _cache_generation
+    with _sidebar_cache_lock:
+        _cache_generation += 1
+        _sidebar_cache.clear()
+        _shelves_cache.clear()
+
+
+def _is_shelf_model(obj):
+    return isinstance(obj, (ub.Shelf, ub.BookShelf))
+
+
+# changes are only noted on flush, the cache is cleared once they are committed
+@event.listens_for(Session, "after_flush")
+def _shelves_flushed(session, __):
+    if any(_is_shelf_model(obj) for obj in itertools.chain(session.new, session.dirty, session.deleted)):
+        session.info['shelves_changed'] = True
+
+
+@event.listens_for(Session, "after_bulk_delete")
+@event.listens_for(Session, "after_bulk_update")
+def _shelves_bulk_changed(context):
+    mapper = getattr(context, "mapper", None)
+    if mapper is not None and mapper.class_ in (ub.Shelf, ub.BookShelf):
+        context.session.info['shelves_changed'] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _shelves_committed(session):
+    if session.info.pop('shelves_changed', False):
+        invalidate_sidebar_cache()
+
+
+@event.listens_for(Session, "after_rollback")
+def _shelves_rolled_back(session):
+    session.info.pop('shelves_changed', None)
+
+
 def get_sidebar_config(kwargs=None):
     kwargs = kwargs or []
     simple = bool([e for e in ['kindle', 'tolino', "kobo", "bookeen"]
@@ -37,6 +93,39 @@ def get_sidebar_config(kwargs=None):
         content = isinstance(content, (User, LocalProxy)) and not content.role_anonymous()
     else:
         content = 'conf' in kwargs
+    g.shelves_access = get_accessible_shelves()
+    key = (current_user.id, str(get_locale()), simple, content, current_user.role_admin(),
+           current_user.is_anonymous, current_user.filter_language() == 'all')
+    with _sidebar_cache_lock:
+        sidebar = _sidebar_cache.get(key)
+        generation = _cache_generation
+    if sidebar is None:
+        sidebar = _build_sidebar(simple, content)
+        with _sidebar_cache_lock:
+            if generation == _cache_generation:
+                _sidebar_cache[key] = sidebar
+    return sidebar, simple
+
+
+def get_accessible_shelves():
+    user_id = current_user.id
+    with _sidebar_cache_lock:
+        shelves = _shelves_cache.get(user_id)
+        generation = _cache_generation
+    if shelves is None:
+        shelves = [SidebarShelf(*shelf) for shelf in
+                   ub.session.query(ub.Shelf.id, ub.Shelf.name, ub.Shelf.is_public, func.count(ub.BookShelf.id))
+                   .outerjoin(ub.BookShelf, ub.BookShelf.shelf == ub.Shelf.id)
+                   .filter(or_(ub.Shelf.is_public == 1, ub.Shelf.user_id == user_id))
+                   .group_by(ub.Shelf.id)
+                   .order_by(ub.Shelf.name)]
+        with _sidebar_cache_lock:
+            if generation == _cache_generation:
+                _shelves_cache[user_id] = shelves
+    return shelves
+
+
+def _build_sidebar(simple, content):
     sidebar = list()
     sidebar.append({"glyph": "glyphicon-book", "text": _('Books'), "link": 'web.index', "id": "new",
                     "visibility": constants.SIDEBAR_RECENT, 'public': True, "page": "root",
@@ -100,10 +189,7 @@ def get_sidebar_config(kwargs=None):
             {"glyph": "glyphicon-th-list", "text": _('Books List'), "link": 'web.books_table', "id": "list",
              "visibility": constants.SIDEBAR_LIST, 'public': (not current_user.is_anonymous),
              "show_text": _('Show Books List'), "config_show": content, "no_param":True})
-    g.shelves_access = ub.session.query(ub.Shelf).filter(
-        or_(ub.Shelf.is_public == 1, ub.Shelf.user_id == current_user.id)).order_by(ub.Shelf.name).all()
-
-    return sidebar, simple
+    return sidebar
 
 
 # Returns the template for rendering and includes the instance name
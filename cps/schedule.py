@@ -25,6 +25,9 @@ from .tasks.clean import TaskClean
 from .tasks.thumbnail import TaskGenerateCoverThumbnails, TaskGenerateSeriesThumbnails, TaskClearCoverThumbnailCache
 from .services.worker import WorkerThread
 from .tasks.metadata_backup import TaskBackupMetadata
+from .tasks.epub_fts import TaskSyncEpubFTS
+from .tasks.epub_layout import TaskSyncEpubLayout
+from .tasks.metadata_fts import TaskSyncMetadataFTS
 
 def get_scheduled_tasks(reconnect=True):
     tasks = list()
@@ -35,6 +38,11 @@ def get_scheduled_tasks(reconnect=True):
     # Delete temp folder
     tasks.append([lambda: TaskClean(), 'delete temp', True])
 
+    # Catch up the search indexes with changes done outside of Calibre-Web
+    tasks.append([lambda: TaskSyncMetadataFTS(), 'sync metadata search index', True])
+    tasks.append([lambda: TaskSyncEpubFTS(), 'sync epub full-text index', False])
+    tasks.append([lambda: TaskSyncEpubLayout(), 'sync epub layout cache', False])
+
     # Generate metadata.opf file for each changed book
     if config.schedule_metadata_backup:
         tasks.append([lambda: TaskBackupMetadata("en"), 'backup metadata', False])
@@ -94,7 +102,13 @@ def register_startup_tasks():
         if constants.APP_MODE in ['development', 'test'] and not should_task_be_running(start, duration):
             scheduler.schedule_tasks_immediately(tasks=get_scheduled_tasks(False))
         else:
-            scheduler.schedule_tasks_immediately(tasks=[[lambda: TaskClean(), 'delete temp', True]])
+            scheduler.schedule_tasks_immediately(tasks=[[lambda: TaskClean(), 'delete temp', True],
+                                                        [lambda: TaskSyncMetadataFTS(), 'sync metadata search index',
+                                                         True],
+                                                        [lambda: TaskSyncEpubFTS(), 'sync epub full-text index',
+                                                         True],
+                                                        [lambda: TaskSyncEpubLayout(), 'sync epub layout cache',
+                                                         True]])
 
 
 def should_task_be_running(start, duration):
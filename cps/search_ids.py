@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from . import logger
+
+log = logger.create()
+
+# users whose last search result is kept, the least recently used one is dropped first
+SEARCH_IDS_MAX_USERS = 500
+# memory held by all stored results together
+SEARCH_IDS_MAX_BYTES = 32 * 1024 * 1024
+# book ids fit into 32 bit
+_TYPECODE = 'i'
+
+
+class SearchedIds:
+    """Book ids of the last search result or book selection of every user, used by the mass shelf actions.
+    The ids are kept as compact int arrays in a size bounded LRU. In shared mode they are stored in a sidecar
+    database next to app.db, so all processes serving the same settings see the same result"""
+    def __init__(self, max_users=SEARCH_IDS_MAX_USERS, max_bytes=SEARCH_IDS_MAX_BYTES):
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._db_path = None
+        self.evictions = 0
+
+    def use_database(self, app_db_path):
+        settings_dir = os.path.dirname(app_db_path) if app_db_path else "."
+        self._db_path = os.path.join(settings_dir, "search_ids.db")
+        conn = self._connect()
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS searched_ids "
+                         "(user_id INTEGER PRIMARY KEY, ids BLOB NOT NULL, updated REAL NOT NULL)")
+            conn.commit()
+        finally:
+            conn.close()
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    @property
+    def shared(self):
+        return self._db_path is not None
+
+    def _connect(self):
+        conn = sqlite3.connect(self._db_path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def set(self, user_id, ids):
+        ids = array(_TYPECODE, ids)
+        size = len(ids) * ids.itemsize
+        if self.shared:
+            conn = self._connect()
+            try:
+                conn.execute("INSERT OR REPLACE INTO searched_ids(user_id, ids, updated) VALUES(?, ?, ?)",
+                             (int(user_id), ids.tobytes(), time.time()))
+                # bounded like the in-memory store, the oldest results go first
+                conn.execute("DELETE FROM searched_ids WHERE user_id IN (SELECT user_id FROM searched_ids "
+                             "ORDER BY updated DESC LIMIT -1 OFFSET ?)", (self.max_users,))
+                conn.commit()
+            except sqlite3.Error as ex:
+                log.error("Could not store search result: %s", ex)
+            finally:
+                conn.close()
+            return
+        with self._lock:
+            old = self._entries.pop(int(user_id), None)
+            if old is not None:
+                self._bytes -= len(old) * old.itemsize
+            if size > self.max_bytes:
+                log.warning("Search result of %d books is too large to be kept", len(ids))
+                return
+            self._entries[int(user_id)] = ids
+            self._bytes += size
+            while len(self._entries) > self.max_users or self._bytes > self.max_bytes:
+                __, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted) * evicted.itemsize
+                self.evictions += 1
+
+    def get(self, user_id):
+        """Returns the stored ids of the user, an empty array if there are none"""
+        if self.shared:
+            conn = self._connect()
+            try:
+                row = conn.execute("SELECT ids FROM searched_ids WHERE user_id = ?", (int(user_id),)).fetchone()
+            except sqlite3.Error as ex:
+                log.error("Could not load search result: %s", ex)
+                row = None
+            finally:
+                conn.close()
+            ids = array(_TYPECODE)
+            if row:
+                ids.frombytes(row[0])
+            return ids
+        with self._lock:
+            ids = self._entries.get(int(user_id))
+            if ids is None:
+                return array(_TYPECODE)
+            self._entries.move_to_end(int(user_id))
+            return ids
+
+    def get_stats(self):
+        if self.shared:
+            conn = self._connect()
+            try:
+                entries, size = conn.execute("SELECT count(*), coalesce(sum(length(ids)), 0) "
+                                             "FROM searched_ids").fetchone()
+            except sqlite3.Error:
+                entries = size = 0
+            finally:
+                conn.close()
+            return {'entries': entries, 'bytes': size, 'evictions': self.evictions, 'shared': True}
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes, 'evictions': self.evictions,
+                    'shared': False}
@@ -16,17 +16,14 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import threading
 import abc
 import uuid
-import time
+import heapq
 
-try:
-    import queue
-except ImportError:
-    import Queue as queue
 from datetime import datetime
-from collections import namedtuple
+from collections import namedtuple, deque, OrderedDict
 
 from cps import logger
 
@@ -45,6 +42,27 @@ TASK_CLEANUP_TRIGGER = 20
 
 QueuedTask = namedtuple('QueuedTask', 'num, user, added, task, hidden')
 
+# Tasks run in named lanes, every lane has its own queue and number of threads. Long running tasks like
+# conversions or thumbnail generation don't delay e-mails this way
+LANE_MAIL = 'mail'
+LANE_CONVERT = 'convert'
+LANE_THUMBNAILS = 'thumbnails'
+LANE_MAINTENANCE = 'maintenance'
+LANES = OrderedDict([
+    (LANE_MAIL, 4),
+    (LANE_CONVERT, os.cpu_count() or 1),
+    (LANE_THUMBNAILS, 2),
+    (LANE_MAINTENANCE, 1),
+])
+
+# Within a lane tasks with higher priority are started first, tasks with equal priority in order of adding
+PRIORITY_LOW = -1
+PRIORITY_NORMAL = 0
+PRIORITY_HIGH = 1
+
+# Number of started tasks used for the average waiting time of a lane
+LANE_WAIT_SAMPLES = 50
+
 
 def _get_main_thread():
     for t in threading.enumerate():
@@ -53,14 +71,75 @@ def _get_main_thread():
     raise Exception("main thread not found?!")
 
 
-class ImprovedQueue(queue.Queue):
+class WorkerLane:
+    """Priority queue of one lane. Tasks sharing a serial key are never run at the same time, they are
+    started in queue order"""
+    def __init__(self, name, concurrency):
+        self.name = name
+        self.concurrency = concurrency
+        self.condition = threading.Condition()
+        self.queue = list()
+        self.running_keys = list()
+        self.running = 0
+        self.wait_times = deque(maxlen=LANE_WAIT_SAMPLES)
+
+    def put(self, priority, item):
+        with self.condition:
+            heapq.heappush(self.queue, (-priority, item.num, item))
+            self.condition.notify()
+
+    def get(self, timeout):
+        """Removes the next startable task from the queue, returns None if there is none within timeout"""
+        with self.condition:
+            item = self._next_startable()
+            if item is None:
+                self.condition.wait(timeout)
+                item = self._next_startable()
+            if item is not None:
+                self.running += 1
+                if item.task.serial_key:
+                    self.running_keys.append(item.task.serial_key)
+                self.wait_times.append((datetime.now() - item.added).total_seconds())
+            return item
+
+    def _next_startable(self):
+        blocked = set(self.running_keys)
+        for entry in sorted(self.queue):
+            key = entry[2].task.serial_key
+            if not key or key not in blocked:
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+                return entry[2]
+            # keep the order of tasks with the same key
+            blocked.add(key)
+        return None
+
+    def task_done(self, item):
+        with self.condition:
+            self.running -= 1
+            if item.task.serial_key:
+                self.running_keys.remove(item.task.serial_key)
+            self.condition.notify_all()
+
     def to_list(self):
         """
         Returns a copy of all items in the queue without removing them.
         """
-
-        with self.mutex:
-            return list(self.queue)
+        with self.condition:
+            return [entry[2] for entry in sorted(self.queue)]
+
+    def stats(self):
+        with self.condition:
+            now = datetime.now()
+            oldest = min((entry[2].added for entry in self.queue), default=None)
+            return {
+                'name': self.name,
+                'concurrency': self.concurrency,
+                'running': self.running,
+                'queued': len(self.queue),
+                'longest_wait': (now - oldest).total_seconds() if oldest else 0.0,
+                'average_wait': sum(self.wait_times) / len(self.wait_times) if self.wait_times else 0.0,
+            }
 
 
 # Class for all worker tasks in the background
@@ -79,18 +158,21 @@ class WorkerThread(threading.Thread):
         self.dequeued = list()
 
         self.doLock = threading.Lock()
-        self.queue = ImprovedQueue()
+        self.lanes = OrderedDict((name, WorkerLane(name, concurrency)) for name, concurrency in LANES.items())
         self.num = 0
         self.start()
 
     @classmethod
-    def add(cls, user, task, hidden=False):
+    def add(cls, user, task, hidden=False, priority=None):
         ins = cls.get_instance()
-        ins.num += 1
+        with ins.doLock:
+            ins.num += 1
+            num = ins.num
         username = user if user is not None else 'System'
         log.debug("Add Task for user: {} - {}".format(username, task))
-        ins.queue.put(QueuedTask(
-            num=ins.num,
+        lane = ins.lanes.get(task.lane, ins.lanes[LANE_MAINTENANCE])
+        lane.put(task.priority if priority is None else priority, QueuedTask(
+            num=num,
             user=username,
             added=datetime.now(),
             task=task,
@@ -100,9 +182,12 @@ class WorkerThread(threading.Thread):
     @property
     def tasks(self):
         with self.doLock:
-            tasks = self.queue.to_list() + self.dequeued
+            tasks = self.dequeued + [item for lane in self.lanes.values() for item in lane.to_list()]
             return sorted(tasks, key=lambda x: x.num)
 
+    def get_lane_stats(self):
+        return [lane.stats() for lane in self.lanes.values()]
+
     def cleanup_tasks(self):
         with self.doLock:
             dead = []
@@ -120,19 +205,28 @@ class WorkerThread(threading.Thread):
 
             self.dequeued = sorted(ret, key=lambda y: y.num)
 
-    # Main thread loop starting the different tasks
+    # Starts the threads of all lanes and waits for them to finish
     def run(self):
+        threads = list()
+        for lane in self.lanes.values():
+            for i in range(lane.concurrency):
+                thread = threading.Thread(target=self._run_lane, args=(lane,), name="{}-{}".format(lane.name, i))
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    # Thread loop starting the tasks of one lane
+    def _run_lane(self, lane):
         main_thread = _get_main_thread()
         while main_thread.is_alive():
-            try:
-                # this blocks until something is available. This can cause issues when the main thread dies - this
-                # thread will remain alive. We implement a timeout to unblock every second which allows us to check if
-                # the main thread is still alive.
-                # We don't use a daemon here because we don't want the tasks to just be abruptly halted, leading to
-                # possible file / database corruption
-                item = self.queue.get(timeout=1)
-            except queue.Empty:
-                time.sleep(1)
+            # this blocks until something is available. This can cause issues when the main thread dies - this
+            # thread will remain alive. We implement a timeout to unblock every second which allows us to check if
+            # the main thread is still alive.
+            # We don't use a daemon here because we don't want the tasks to just be abruptly halted, leading to
+            # possible file / database corruption
+            item = lane.get(timeout=1)
+            if item is None:
                 continue
 
             with self.doLock:
@@ -143,16 +237,19 @@ class WorkerThread(threading.Thread):
             if len(self.dequeued) > TASK_CLEANUP_TRIGGER:
                 self.cleanup_tasks()
 
-            # sometimes tasks (like Upload) don't actually have work to do and are created as already finished
-            if item.task.stat is STAT_WAITING:
-                # CalibreTask.start() should wrap all exceptions in its own error handling
-                item.task.start(self)
-
-            # remove self_cleanup tasks and hidden "System Tasks" from list
-            if item.task.self_cleanup or item.hidden:
-                self.dequeued.remove(item)
-
-            self.queue.task_done()
+            try:
+                # sometimes tasks (like Upload) don't actually have work to do and are created as already finished
+                if item.task.stat is STAT_WAITING:
+                    # CalibreTask.start() should wrap all exceptions in its own error handling
+                    item.task.start(self)
+            finally:
+                # remove self_cleanup tasks and hidden "System Tasks" from list
+                if item.task.self_cleanup or item.hidden:
+                    with self.doLock:
+                        if item in self.dequeued:
+                            self.dequeued.remove(item)
+
+                lane.task_done(item)
 
     def end_task(self, task_id):
         ins = self.get_instance()
@@ -164,6 +261,12 @@ class WorkerThread(threading.Thread):
 class CalibreTask:
     __metaclass__ = abc.ABCMeta
 
+    # lane the task is run in and its priority within the lane
+    lane = LANE_MAINTENANCE
+    priority = PRIORITY_NORMAL
+    # tasks with the same serial key in a lane are run one after another
+    serial_key = None
+
     def __init__(self, message):
         self._progress = 0
         self.stat = STAT_WAITING
@@ -116,12 +116,13 @@ def search_from_shelf(shelf_id):
         flash(_("You are not allowed to remove a book from the shelf"), category="error")
         return redirect(url_for('web.index'))
 
-    if current_user.id in ub.searched_ids and ub.searched_ids[current_user.id]:
+    searched_ids = ub.searched_ids.get(current_user.id)
+    if searched_ids:
         books_from_shelf = list()
         books_in_shelf = ub.session.query(ub.BookShelf).filter(ub.BookShelf.shelf == shelf_id).all()
         if books_in_shelf:
             book_ids = [book_id.book_id for book_id in books_in_shelf]
-            for searchid in ub.searched_ids[current_user.id]:
+            for searchid in searched_ids:
                 if searchid in book_ids:
                     books_from_shelf.append(searchid)
         else:
@@ -162,16 +163,17 @@ def search_to_shelf(shelf_id):
         flash(_("You are not allowed to add a book to the shelf"), category="error")
         return redirect(url_for('web.index'))
 
-    if current_user.id in ub.searched_ids and ub.searched_ids[current_user.id]:
+    searched_ids = ub.searched_ids.get(current_user.id)
+    if searched_ids:
         books_for_shelf = list()
         books_in_shelf = ub.session.query(ub.BookShelf).filter(ub.BookShelf.shelf == shelf_id).all()
         if books_in_shelf:
             book_ids = [book_id.book_id for book_id in books_in_shelf]
-            for searchid in ub.searched_ids[current_user.id]:
+            for searchid in searched_ids:
                 if searchid not in book_ids:
                     books_for_shelf.append(searchid)
         else:
-            books_for_shelf = ub.searched_ids[current_user.id]
+            books_for_shelf = list(searched_ids)
 
         if not books_for_shelf:
             log.error("Books are already part of {}".format(shelf.name))
@@ -1020,11 +1020,15 @@ function TaskActions (value, row) {
     return '';
 }
 
+/* Cursor of the page following the one displayed, sent when the table moves one page forward */
+var nextPage = null;
+
 /* Function for keeping checked rows */
 function responseHandler(res) {
     $.each(res.rows, function (i, row) {
         row.state = $.inArray(row.id, selections) !== -1;
     });
+    nextPage = res.next ? {cursor: res.next, offset: res.nextOffset} : null;
     return res;
 }
 
@@ -1331,6 +1335,9 @@ function deleteUser(a, id){
 function queryParams(params)
 {
     params.state = JSON.stringify(selections);
+    if (nextPage && params.offset === nextPage.offset) {
+        params.cursor = nextPage.cursor;
+    }
     return params;
 }
 
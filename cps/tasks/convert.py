@@ -18,6 +18,7 @@
 
 import os
 import re
+import threading
 import glob
 from shutil import copyfile, copyfileobj
 from markupsafe import escape
@@ -27,7 +28,7 @@ from uuid import uuid4
 from sqlalchemy.exc import SQLAlchemyError
 from flask_babel import lazy_gettext as N_
 
-from cps.services.worker import CalibreTask
+from cps.services.worker import CalibreTask, LANE_CONVERT
 from cps import db, app
 from cps import logger, config
 from cps.subproc_wrapper import process_open
@@ -40,15 +41,23 @@ from cps.tasks.mail import TaskEmail
 from cps import gdriveutils, helper
 from cps.constants import SUPPORTED_CALIBRE_BINARIES
 from cps.string_helper import strip_whitespaces
+from cps.epub_layout import LAYOUT_FORMATS
 
 log = logger.create()
 
 current_milli_time = lambda: int(round(time() * 1000))
 
+# conversions of different books run in parallel, their writes to metadata.db are done one at a time
+_db_write_lock = threading.Lock()
+
 
 class TaskConvert(CalibreTask):
+    lane = LANE_CONVERT
+
     def __init__(self, file_path, book_id, task_message, settings, ereader_mail, user=None):
         super(TaskConvert, self).__init__(task_message)
+        # conversions of the same book add formats to the same book folder and database entry
+        self.serial_key = 'convert-{}'.format(book_id)
         self.worker_thread = None
         self.file_path = file_path
         self.book_id = book_id
@@ -151,8 +160,10 @@ class TaskConvert(CalibreTask):
                                          book_format=self.settings['new_book_format'].upper(),
                                          book=book_id, uncompressed_size=os.path.getsize(file_path + format_new_ext))
                     try:
-                        local_db.session.merge(new_format)
-                        local_db.session.commit()
+                        with _db_write_lock:
+                            local_db.session.merge(new_format)
+                            local_db.session.commit()
+                        helper.update_category_index(book_id)
                     except SQLAlchemyError as e:
                         local_db.session.rollback()
                         log.error("Database error: %s", e)
@@ -189,12 +200,18 @@ class TaskConvert(CalibreTask):
                                              book_format=self.settings['new_book_format'].upper(),
                                              book=book_id, uncompressed_size=os.path.getsize(file_path + format_new_ext))
                         try:
-                            local_db.session.merge(new_format)
-                            local_db.session.commit()
+                            with _db_write_lock:
+                                local_db.session.merge(new_format)
+                                local_db.session.commit()
+                            helper.update_category_index(book_id)
                             if self.settings['new_book_format'].upper() in ['KEPUB', 'EPUB', 'EPUB3']:
                                 ub_session = init_db_thread()
                                 remove_synced_book(book_id, True, ub_session)
                                 ub_session.close()
+                            if self.settings['new_book_format'].upper() == 'EPUB':
+                                helper.update_epub_fts_index(book_id)
+                            if self.settings['new_book_format'].upper() in LAYOUT_FORMATS:
+                                helper.update_epub_layout_cache(book_id)
                         except SQLAlchemyError as e:
                             local_db.session.rollback()
                             log.error("Database error: %s", e)
@@ -19,7 +19,8 @@
 from flask_babel import lazy_gettext as N_
 
 from cps import config, logger, db, ub, app
-from cps.services.worker import CalibreTask
+from cps.services.worker import CalibreTask, WorkerThread
+from cps.tasks.metadata_fts import TaskSyncMetadataFTS
 
 
 class TaskReconnectDatabase(CalibreTask):
@@ -33,6 +34,8 @@ class TaskReconnectDatabase(CalibreTask):
             calibre_db = db.CalibreDB(app)
             calibre_db.reconnect_db(config, ub.app_DB_path)
         # self.calibre_db.session.close()
+        # pick up changes done by calibre in the meantime
+        WorkerThread.add(None, TaskSyncMetadataFTS(), hidden=True)
         self._handleSuccess()
 
     @property
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from flask_babel import lazy_gettext as N_
+from sqlalchemy import func
+
+from cps import config, db, logger, ub, app
+from cps.epub_fts import get_epub_fts_index
+from cps.services.worker import CalibreTask, STAT_CANCELLED, STAT_ENDED
+
+
+class TaskSyncEpubFTS(CalibreTask):
+    """Keeps the EPUB full-text index in sync, either for the whole library or for the given book ids"""
+    def __init__(self, book_ids=None, task_message=N_('Updating EPUB full-text index')):
+        super(TaskSyncEpubFTS, self).__init__(task_message)
+        self.log = logger.create()
+        self.book_ids = book_ids
+
+    def run(self, worker_thread):
+        if config.config_use_google_drive:
+            # book files are not available locally
+            self.self_cleanup = True
+            self._handleSuccess()
+            return
+        index = get_epub_fts_index(ub.app_DB_path)
+        with app.app_context():
+            calibre_db = db.CalibreDB(app)
+            query = (calibre_db.session.query(db.Books.id, db.Books.path, db.Data.name)
+                     .join(db.Data)
+                     .filter(func.lower(db.Data.format) == "epub"))
+            if self.book_ids is not None:
+                query = query.filter(db.Books.id.in_(self.book_ids))
+            epub_rows = query.all()
+
+        if self.book_ids is not None:
+            result = index.sync_books(self.book_ids, epub_rows, config.get_book_path())
+        else:
+            result = index.sync_from_rows(epub_rows,
+                                          config.get_book_path(),
+                                          progress_callback=self._update_progress,
+                                          should_stop=self._should_stop)
+        self.log.debug("EPUB full-text index synced: indexed={}, removed={}, seen={}".format(
+            result["indexed"], result["removed"], result["seen"]))
+        if self._should_stop():
+            self.log.info('EPUB full-text index sync has been cancelled.')
+            return
+        if result["indexed"] == 0 and result["removed"] == 0:
+            self.self_cleanup = True
+        self._handleSuccess()
+
+    def _update_progress(self, processed, total, *__):
+        if total:
+            self.progress = float(processed) / float(total)
+
+    def _should_stop(self):
+        return self.stat in (STAT_CANCELLED, STAT_ENDED)
+
+    @property
+    def name(self):
+        return N_('EPUB Full-Text Index')
+
+    def __str__(self):
+        if self.book_ids is not None:
+            return "Update EPUB full-text index for book(s) {}".format(", ".join(str(b) for b in self.book_ids))
+        return "Sync EPUB full-text index"
+
+    @property
+    def is_cancellable(self):
+        return True
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from flask_babel import lazy_gettext as N_
+from sqlalchemy import func
+
+from cps import config, db, logger, ub, app
+from cps.epub_layout import get_epub_layout_cache, LAYOUT_FORMATS
+from cps.services.worker import CalibreTask, STAT_CANCELLED, STAT_ENDED
+
+
+class TaskSyncEpubLayout(CalibreTask):
+    """Reads the rendition layout of new or changed EPUB and KEPUB files for Kobo sync, either for the whole library
+    or for the given book ids"""
+    def __init__(self, book_ids=None, task_message=N_('Updating EPUB layout cache')):
+        super(TaskSyncEpubLayout, self).__init__(task_message)
+        self.log = logger.create()
+        self.book_ids = book_ids
+
+    def run(self, worker_thread):
+        # cps.epub imports helper, which queues this task
+        from cps.epub import read_epub_layout
+        cache = get_epub_layout_cache(ub.app_DB_path)
+        try:
+            if not config.config_calibre_dir or config.config_use_google_drive:
+                # book files are not available locally
+                self.self_cleanup = True
+                self._handleSuccess()
+                return
+            with app.app_context():
+                calibre_db = db.CalibreDB(app)
+                query = (calibre_db.session.query(db.Books.id, db.Books.path, db.Data.name, db.Data.format)
+                         .join(db.Data)
+                         .filter(func.upper(db.Data.format).in_(LAYOUT_FORMATS)))
+                if self.book_ids is not None:
+                    query = query.filter(db.Books.id.in_(self.book_ids))
+                rows = query.all()
+            result = cache.sync_from_rows(rows, config.get_book_path(), read_epub_layout, self.book_ids,
+                                          self._should_stop)
+            self.log.debug("EPUB layout cache synced: updated={}, removed={}".format(result["updated"],
+                                                                                   result["removed"]))
+            if self._should_stop():
+                self.log.info('EPUB layout cache sync has been cancelled.')
+                return
+            if self.book_ids is not None or (result["updated"] == 0 and result["removed"] == 0):
+                self.self_cleanup = True
+            self._handleSuccess()
+        finally:
+            if self.book_ids is None:
+                cache.warm_done()
+
+    def _should_stop(self):
+        return self.stat in (STAT_CANCELLED, STAT_ENDED)
+
+    @property
+    def name(self):
+        return N_('EPUB Layout Cache')
+
+    def __str__(self):
+        if self.book_ids is not None:
+            return "Update EPUB layout cache for book(s) {}".format(", ".join(str(b) for b in self.book_ids))
+        return "Sync EPUB layout cache"
+
+    @property
+    def is_cancellable(self):
+        return True
@@ -29,7 +29,7 @@ from email.utils import formatdate, parseaddr, make_msgid
 from email.generator import Generator
 from flask_babel import lazy_gettext as N_
 
-from cps.services.worker import CalibreTask
+from cps.services.worker import CalibreTask, LANE_MAIL, PRIORITY_HIGH
 from cps.services import gmail
 from cps.embed_helper import do_calibre_export
 from cps import logger, config
@@ -110,6 +110,9 @@ class EmailSSL(EmailBase, smtplib.SMTP_SSL):
 
 
 class TaskEmail(CalibreTask):
+    lane = LANE_MAIL
+    priority = PRIORITY_HIGH
+
     def __init__(self, subject, filepath, attachment, settings, recipient, task_message, text, id=0, internal=False):
         super(TaskEmail, self).__init__(task_message)
         self.subject = subject
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from flask_babel import lazy_gettext as N_
+
+from cps import config, db, logger, ub, app
+from cps.metadata_fts import get_metadata_fts_index
+from cps.services.worker import CalibreTask
+
+
+class TaskSyncMetadataFTS(CalibreTask):
+    """Updates the metadata full-text index for the given book ids, or for all books changed since the last sync"""
+    def __init__(self, book_ids=None, task_message=N_('Updating metadata search index')):
+        super(TaskSyncMetadataFTS, self).__init__(task_message)
+        self.log = logger.create()
+        self.book_ids = book_ids
+
+    def run(self, worker_thread):
+        index = get_metadata_fts_index(ub.app_DB_path)
+        try:
+            if not config.config_calibre_dir:
+                self.self_cleanup = True
+                self._handleSuccess()
+                return
+            with app.app_context():
+                calibre_db = db.CalibreDB(app)
+                custom_columns = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
+                # taken before reading the library, changes done during the sync are found by the next one
+                library_state = calibre_db.current_library_state()
+            result = index.sync(config.config_calibre_dir, custom_columns, self.book_ids, library_state)
+            self.log.debug("Metadata search index synced: indexed={}, removed={}".format(result["indexed"],
+                                                                                       result["removed"]))
+            if self.book_ids is not None or (result["indexed"] == 0 and result["removed"] == 0):
+                self.self_cleanup = True
+            self._handleSuccess()
+        finally:
+            if self.book_ids is None:
+                index.sync_done()
+
+    @property
+    def name(self):
+        return N_('Metadata Search Index')
+
+    def __str__(self):
+        if self.book_ids is not None:
+            return "Update metadata search index for book(s) {}".format(", ".join(str(b) for b in self.book_ids))
+        return "Sync metadata search index"
+
+    @property
+    def is_cancellable(self):
+        return False
@@ -17,14 +17,15 @@
 #   along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import os
-from shutil import copyfile, copyfileobj
+from concurrent.futures import ThreadPoolExecutor
+from shutil import copyfile
 from urllib.request import urlopen
-from io import BytesIO
 from datetime import datetime, timezone
 
 from .. import constants
 from cps import config, db, fs, gdriveutils, logger, ub, app
-from cps.services.worker import CalibreTask, STAT_CANCELLED, STAT_ENDED
+from cps.services.worker import CalibreTask, STAT_CANCELLED, STAT_ENDED, LANE_THUMBNAILS, PRIORITY_LOW, \
+    PRIORITY_NORMAL
 from sqlalchemy import func, text, or_
 from flask_babel import lazy_gettext as N_
 
@@ -34,6 +35,11 @@ try:
 except (ImportError, RuntimeError) as e:
     use_IM = False
 
+# books handled per database commit and checkpoint
+THUMBNAIL_BATCH_SIZE = 100
+THUMBNAIL_WORKERS = min(4, os.cpu_count() or 1)
+THUMBNAIL_CHECKPOINT_FILE = '.generate_checkpoint'
+
 
 def get_resize_height(resolution):
     return int(255 * resolution)
@@ -64,11 +70,36 @@ def get_best_fit(width, height, image_width, image_height):
     return {'width': resize_width, 'height': resize_height}
 
 
+def render_cover_thumbnails(source_path, targets, content=None):
+    """Decodes a cover once and writes a thumbnail for every (resolution, filename, format) target.
+    The cover is either read from source_path or given as content. Runs in the thumbnail thread pool"""
+    with (Image(blob=content) if content is not None else Image(filename=source_path)) as img:
+        for resolution, filename, file_format in targets:
+            height = get_resize_height(resolution)
+            if img.height > height:
+                with img.clone() as thumbnail:
+                    width = get_resize_width(resolution, img.width, img.height)
+                    thumbnail.resize(width=width, height=height, filter='lanczos')
+                    thumbnail.format = file_format
+                    thumbnail.save(filename=filename)
+            elif content is not None:
+                with open(filename, 'wb') as fd:
+                    fd.write(content)
+            else:
+                # take cover as is
+                copyfile(source_path, filename)
+
+
 class TaskGenerateCoverThumbnails(CalibreTask):
+    lane = LANE_THUMBNAILS
+    serial_key = 'cover thumbnails'
+
     def __init__(self, book_id=-1, task_message=''):
         super(TaskGenerateCoverThumbnails, self).__init__(task_message)
         self.log = logger.create()
         self.book_id = book_id
+        # covers of single books are generated before full library runs
+        self.priority = PRIORITY_LOW if book_id == -1 else PRIORITY_NORMAL
         self.app_db_session = ub.get_new_session_instance()
         self.cache = fs.FileSystem()
         self.resolutions = [
@@ -81,30 +112,46 @@ class TaskGenerateCoverThumbnails(CalibreTask):
         if use_IM and self.stat != STAT_CANCELLED and self.stat != STAT_ENDED:
             self.message = 'Scanning Books'
             books_with_covers = self.get_books_with_covers(self.book_id)
+            if self.book_id == -1:
+                checkpoint = self.get_checkpoint()
+                if checkpoint:
+                    # continue a cancelled run after the last completed batch
+                    self.log.info('Resuming cover thumbnail generation after book {}'.format(checkpoint))
+                    books_with_covers = [book for book in books_with_covers if book.id > checkpoint]
             count = len(books_with_covers)
 
             total_generated = 0
-            for i, book in enumerate(books_with_covers):
+            executor = self.create_executor() if count > 1 else None
+            try:
+                for start in range(0, count, THUMBNAIL_BATCH_SIZE):
+                    batch = books_with_covers[start:start + THUMBNAIL_BATCH_SIZE]
 
-                # Generate new thumbnails for missing covers
-                generated = self.create_book_cover_thumbnails(book)
+                    # Generate new thumbnails for missing covers
+                    generated = self.create_book_cover_thumbnails(batch, executor)
+                    if self.book_id == -1:
+                        self.set_checkpoint(batch[-1].id)
 
-                # Increment the progress
-                self.progress = (1.0 / count) * i
+                    # Increment the progress
+                    self.progress = (1.0 / count) * (start + len(batch))
 
-                if generated > 0:
-                    total_generated += generated
-                    self.message = N_('Generated %(count)s cover thumbnails', count=total_generated)
+                    if generated > 0:
+                        total_generated += generated
+                        self.message = N_('Generated %(count)s cover thumbnails', count=total_generated)
 
-                # Check if job has been cancelled or ended
-                if self.stat == STAT_CANCELLED:
-                    self.log.info(f'GenerateCoverThumbnails task has been cancelled.')
-                    return
+                    # Check if job has been cancelled or ended
+                    if self.stat == STAT_CANCELLED:
+                        self.log.info(f'GenerateCoverThumbnails task has been cancelled.')
+                        return
 
-                if self.stat == STAT_ENDED:
-                    self.log.info(f'GenerateCoverThumbnails task has been ended.')
-                    return
+                    if self.stat == STAT_ENDED:
+                        self.log.info(f'GenerateCoverThumbnails task has been ended.')
+                        return
+            finally:
+                if executor:
+                    executor.shutdown(wait=True)
 
+            if self.book_id == -1:
+                self.set_checkpoint(None)
             if total_generated == 0:
                 self.self_cleanup = True
 
@@ -116,117 +163,141 @@ class TaskGenerateCoverThumbnails(CalibreTask):
         filter_exp = (db.Books.id == book_id) if book_id != -1 else True
         with app.app_context():
             calibre_db = db.CalibreDB(app) #, expire_on_commit=False, init=True)
-            books_cover = calibre_db.session.query(db.Books).filter(db.Books.has_cover == 1).filter(filter_exp).all()
+            books_cover = (calibre_db.session.query(db.Books.id, db.Books.path, db.Books.last_modified)
+                           .filter(db.Books.has_cover == 1)
+                           .filter(filter_exp)
+                           .order_by(db.Books.id)
+                           .all())
             # calibre_db.session.close()
         return books_cover
 
-    def get_book_cover_thumbnails(self, book_id):
-        return self.app_db_session \
-            .query(ub.Thumbnail) \
-            .filter(ub.Thumbnail.type == constants.THUMBNAIL_TYPE_COVER) \
-            .filter(ub.Thumbnail.entity_id == book_id) \
-            .filter(or_(ub.Thumbnail.expiration.is_(None), ub.Thumbnail.expiration > datetime.now(timezone.utc))) \
-            .all()
+    def create_executor(self):
+        if config.config_use_google_drive:
+            # covers are downloaded one by one, resizing is not the bottleneck
+            return None
+        # ImageMagick releases the GIL while decoding and resizing, threads don't fork the server process with its
+        # open database connections and initialised ImageMagick
+        return ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS)
 
-    def create_book_cover_thumbnails(self, book):
-        generated = 0
-        book_cover_thumbnails = self.get_book_cover_thumbnails(book.id)
-
-        # Generate new thumbnails for missing covers
-        resolutions = list(map(lambda t: t.resolution, book_cover_thumbnails))
-        missing_resolutions = list(set(self.resolutions).difference(resolutions))
-        for resolution in missing_resolutions:
-            generated += 1
-            self.create_book_cover_single_thumbnail(book, resolution)
-
-        # Replace outdated or missing thumbnails
-        for thumbnail in book_cover_thumbnails:
-            if book.last_modified.replace(tzinfo=None) > thumbnail.generated_at:
-                generated += 1
-                self.update_book_cover_thumbnail(book, thumbnail)
-
-            elif not self.cache.get_cache_file_exists(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS):
-                generated += 1
-                self.update_book_cover_thumbnail(book, thumbnail)
-        return generated
+    def get_checkpoint_path(self):
+        return os.path.join(self.cache.get_cache_dir(constants.CACHE_TYPE_THUMBNAILS), THUMBNAIL_CHECKPOINT_FILE)
 
-    def create_book_cover_single_thumbnail(self, book, resolution):
-        thumbnail = ub.Thumbnail()
-        thumbnail.type = constants.THUMBNAIL_TYPE_COVER
-        thumbnail.entity_id = book.id
-        thumbnail.format = 'jpeg'
-        thumbnail.resolution = resolution
-
-        self.app_db_session.add(thumbnail)
+    def get_checkpoint(self):
         try:
-            self.app_db_session.commit()
-            self.generate_book_thumbnail(book, thumbnail)
-        except Exception as ex:
-            self.log.debug('Error creating book thumbnail: ' + str(ex))
-            self._handleError('Error creating book thumbnail: ' + str(ex))
-            self.app_db_session.rollback()
-
-    def update_book_cover_thumbnail(self, book, thumbnail):
-        thumbnail.generated_at = datetime.now(timezone.utc)
+            with open(self.get_checkpoint_path(), 'r') as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
 
+    def set_checkpoint(self, book_id):
         try:
-            self.app_db_session.commit()
-            self.cache.delete_cache_file(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS)
-            self.generate_book_thumbnail(book, thumbnail)
-        except Exception as ex:
-            self.log.debug('Error updating book thumbnail: ' + str(ex))
-            self._handleError('Error updating book thumbnail: ' + str(ex))
-            self.app_db_session.rollback()
-
-    def generate_book_thumbnail(self, book, thumbnail):
-        if book and thumbnail:
-            if config.config_use_google_drive:
-                if not gdriveutils.is_gdrive_ready():
-                    raise Exception('Google Drive is configured but not ready')
+            if book_id is None:
+                if os.path.isfile(self.get_checkpoint_path()):
+                    os.remove(self.get_checkpoint_path())
+            else:
+                with open(self.get_checkpoint_path(), 'w') as f:
+                    f.write(str(book_id))
+        except OSError as ex:
+            self.log.debug('Could not store cover thumbnail checkpoint: {}'.format(ex))
+
+    def get_book_cover_thumbnails(self, book_ids):
+        thumbnails = dict()
+        for thumbnail in (self.app_db_session
+                          .query(ub.Thumbnail)
+                          .filter(ub.Thumbnail.type == constants.THUMBNAIL_TYPE_COVER)
+                          .filter(ub.Thumbnail.entity_id.in_(book_ids))
+                          .filter(or_(ub.Thumbnail.expiration.is_(None),
+                                      ub.Thumbnail.expiration > datetime.now(timezone.utc)))):
+            thumbnails.setdefault(thumbnail.entity_id, []).append(thumbnail)
+        return thumbnails
+
+    def create_book_cover_thumbnails(self, books, executor=None):
+        thumbnails = self.get_book_cover_thumbnails([book.id for book in books])
+        jobs = []
+        for book in books:
+            book_cover_thumbnails = thumbnails.get(book.id, [])
+            new_thumbnails = []
+            outdated_thumbnails = []
+
+            # Generate new thumbnails for missing covers
+            resolutions = list(map(lambda t: t.resolution, book_cover_thumbnails))
+            for resolution in set(self.resolutions).difference(resolutions):
+                thumbnail = ub.Thumbnail()
+                thumbnail.type = constants.THUMBNAIL_TYPE_COVER
+                thumbnail.entity_id = book.id
+                thumbnail.format = 'jpeg'
+                thumbnail.resolution = resolution
+                self.app_db_session.add(thumbnail)
+                new_thumbnails.append(thumbnail)
+
+            # Replace outdated or missing thumbnails
+            for thumbnail in book_cover_thumbnails:
+                if (book.last_modified.replace(tzinfo=None) > thumbnail.generated_at
+                        or not self.cache.get_cache_file_exists(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS)):
+                    thumbnail.generated_at = datetime.now(timezone.utc)
+                    self.cache.delete_cache_file(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS)
+                    outdated_thumbnails.append(thumbnail)
+            if new_thumbnails or outdated_thumbnails:
+                jobs.append((book, new_thumbnails, outdated_thumbnails))
+        if not jobs:
+            return 0
 
-                content = gdriveutils.get_cover_via_gdrive(book.path)
-                if not content:
-                    raise Exception('Google Drive cover url not found')
+        generated = 0
+        try:
+            # assigns the file names of the new thumbnails
+            self.app_db_session.flush()
+            pending = []
+            for book, new_thumbnails, outdated_thumbnails in jobs:
+                targets = [(thumbnail.resolution,
+                            self.cache.get_cache_file_path(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS),
+                            thumbnail.format)
+                           for thumbnail in new_thumbnails + outdated_thumbnails]
                 try:
-                    stream = BytesIO(content)
-                    with Image(file=stream) as img:
-                        filename = self.cache.get_cache_file_path(thumbnail.filename,
-                                                                  constants.CACHE_TYPE_THUMBNAILS)
-                        height = get_resize_height(thumbnail.resolution)
-                        if img.height > height:
-                            width = get_resize_width(thumbnail.resolution, img.width, img.height)
-                            img.resize(width=width, height=height, filter='lanczos')
-                            img.format = thumbnail.format
-                            img.save(filename=filename)
-                        else:
-                            stream.seek(0)
-                            with open(filename, 'wb') as fd:
-                                copyfileobj(stream, fd)
-
+                    pending.append((book, new_thumbnails, len(targets),
+                                    self.submit_book_thumbnails(book, targets, executor)))
+                except Exception as ex:
+                    self.discard_book_thumbnails(book, new_thumbnails, ex)
 
+            for book, new_thumbnails, count, future in pending:
+                try:
+                    if future:
+                        future.result()
+                    generated += count
                 except Exception as ex:
-                    # Bubble exception to calling function
-                    self.log.debug('Error generating thumbnail file: ' + str(ex))
-                    raise ex
-                finally:
-                    if stream is not None:
-                        stream.close()
-            else:
-                book_cover_filepath = os.path.join(config.get_book_path(), book.path, 'cover.jpg')
-                if not os.path.isfile(book_cover_filepath):
-                    raise Exception('Book cover file not found')
+                    self.discard_book_thumbnails(book, new_thumbnails, ex)
+            self.app_db_session.commit()
+        except Exception as ex:
+            self.log.debug('Error creating book thumbnail: ' + str(ex))
+            self._handleError('Error creating book thumbnail: ' + str(ex))
+            self.app_db_session.rollback()
+            return 0
+        return generated
 
-                with Image(filename=book_cover_filepath) as img:
-                    height = get_resize_height(thumbnail.resolution)
-                    filename = self.cache.get_cache_file_path(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS)
-                    if img.height > height:
-                        width = get_resize_width(thumbnail.resolution, img.width, img.height)
-                        img.resize(width=width, height=height, filter='lanczos')
-                        img.format = thumbnail.format
-                        img.save(filename=filename)
-                    else:
-                        # take cover as is
-                        copyfile(book_cover_filepath, filename)
+    def discard_book_thumbnails(self, book, new_thumbnails, ex):
+        self.log.debug('Error generating thumbnail file for book {}: {}'.format(book.id, ex))
+        for thumbnail in new_thumbnails:
+            self.app_db_session.delete(thumbnail)
+
+    def submit_book_thumbnails(self, book, targets, executor):
+        """Generates the thumbnails of a book from a single decode of its cover. With a thread pool a future
+        is returned, otherwise the thumbnails are generated directly"""
+        content = None
+        book_cover_filepath = None
+        if config.config_use_google_drive:
+            if not gdriveutils.is_gdrive_ready():
+                raise Exception('Google Drive is configured but not ready')
+
+            content = gdriveutils.get_cover_via_gdrive(book.path)
+            if not content:
+                raise Exception('Google Drive cover url not found')
+        else:
+            book_cover_filepath = os.path.join(config.get_book_path(), book.path, 'cover.jpg')
+            if not os.path.isfile(book_cover_filepath):
+                raise Exception('Book cover file not found')
+        if executor:
+            return executor.submit(render_cover_thumbnails, book_cover_filepath, targets, content)
+        render_cover_thumbnails(book_cover_filepath, targets, content)
+        return None
 
     @property
     def name(self):
@@ -244,6 +315,10 @@ class TaskGenerateCoverThumbnails(CalibreTask):
 
 
 class TaskGenerateSeriesThumbnails(CalibreTask):
+    lane = LANE_THUMBNAILS
+    priority = PRIORITY_LOW
+    serial_key = 'series thumbnails'
+
     def __init__(self, task_message=''):
         super(TaskGenerateSeriesThumbnails, self).__init__(task_message)
         self.log = logger.create()
@@ -456,6 +531,9 @@ class TaskGenerateSeriesThumbnails(CalibreTask):
 
 
 class TaskClearCoverThumbnailCache(CalibreTask):
+    lane = LANE_THUMBNAILS
+    serial_key = 'cover thumbnails'
+
     def __init__(self, book_id, task_message=N_('Clearing cover thumbnail cache')):
         super(TaskClearCoverThumbnailCache, self).__init__(task_message)
         self.log = logger.create()
@@ -14,6 +14,8 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+from datetime import timedelta
+
 from markupsafe import escape
 
 from flask import Blueprint, jsonify
@@ -25,7 +27,7 @@ from babel.units import format_unit
 from . import logger
 from .render_template import render_title_template
 from .services.worker import WorkerThread, STAT_WAITING, STAT_FAIL, STAT_STARTED, STAT_FINISH_SUCCESS, STAT_ENDED, \
-    STAT_CANCELLED
+    STAT_CANCELLED, LANE_MAIL, LANE_CONVERT, LANE_THUMBNAILS, LANE_MAINTENANCE
 from .usermanagement import user_login_required
 
 tasks = Blueprint('tasks', __name__)
@@ -44,7 +46,28 @@ def get_email_status_json():
 @user_login_required
 def get_tasks_status():
     # if current user admin, show all email, otherwise only own emails
-    return render_title_template('tasks.html', title=_("Tasks"), page="tasks")
+    lanes = render_lane_status() if current_user.role_admin() else []
+    return render_title_template('tasks.html', title=_("Tasks"), page="tasks", lanes=lanes)
+
+
+# queue depth and waiting times of the worker lanes
+def render_lane_status():
+    lane_names = {
+        LANE_MAIL: _('E-mail'),
+        LANE_CONVERT: _('Conversion'),
+        LANE_THUMBNAILS: _('Thumbnails'),
+        LANE_MAINTENANCE: _('Maintenance'),
+    }
+    rendered_lanes = list()
+    for lane in WorkerThread.get_instance().get_lane_stats():
+        rendered_lanes.append({
+            'name': lane_names.get(lane['name'], lane['name']),
+            'running': "{} / {}".format(lane['running'], lane['concurrency']),
+            'queued': lane['queued'],
+            'longest_wait': format_runtime(timedelta(seconds=int(lane['longest_wait']))),
+            'average_wait': format_runtime(timedelta(seconds=int(lane['average_wait']))),
+        })
+    return rendered_lanes
 
 
 # helper function to apply localize status information in tasklist entries
@@ -54,6 +54,7 @@ from sqlalchemy.orm import backref, relationship, sessionmaker, Session, scoped_
 from werkzeug.security import generate_password_hash
 
 from . import constants, logger
+from .search_ids import SearchedIds
 from .string_helper import strip_whitespaces
 
 log = logger.create()
@@ -61,7 +62,7 @@ log = logger.create()
 session = None
 app_DB_path = None
 Base = declarative_base()
-searched_ids = {}
+searched_ids = SearchedIds()
 
 logged_in = dict()
 
@@ -124,16 +125,10 @@ def check_user_session(user_id, session_key, random):
 user_logged_in.connect(signal_store_user_session)
 
 def store_ids(result):
-    ids = list()
-    for element in result:
-        ids.append(element.id)
-    searched_ids[current_user.id] = ids
+    searched_ids.set(current_user.id, (element.id for element in result))
 
 def store_combo_ids(result):
-    ids = list()
-    for element in result:
-        ids.append(element[0].id)
-    searched_ids[current_user.id] = ids
+    searched_ids.set(current_user.id, (element[0].id for element in result))
 
 
 class UserBase:
@@ -513,6 +508,14 @@ class Downloads(Base):
         return '<Download %r' % self.book_id
 
 
+# Number of users who downloaded a book, maintained by update_download/delete_download for the hot books list
+class DownloadCount(Base):
+    __tablename__ = 'download_count'
+
+    book_id = Column(Integer, primary_key=True)
+    count = Column(Integer, default=0, index=True)
+
+
 # Baseclass representing allowed domains for registration
 class Registration(Base):
     __tablename__ = 'registration'
@@ -572,6 +575,9 @@ def add_missing_tables(engine, _session):
         ArchivedBook.__table__.create(bind=engine)
     if not engine.dialect.has_table(engine.connect(), "thumbnail"):
         Thumbnail.__table__.create(bind=engine)
+    if not engine.dialect.has_table(engine.connect(), "download_count"):
+        DownloadCount.__table__.create(bind=engine)
+        rebuild_download_counts(_session)
 
 
 # migrate all settings missing in registration table
@@ -630,6 +636,9 @@ def update_download(book_id, user_id):
     if not check:
         new_download = Downloads(user_id=user_id, book_id=book_id)
         session.add(new_download)
+        if not session.query(DownloadCount).filter(DownloadCount.book_id == book_id) \
+                .update({DownloadCount.count: DownloadCount.count + 1}, synchronize_session=False):
+            session.add(DownloadCount(book_id=book_id, count=1))
         try:
             session.commit()
         except exc.OperationalError:
@@ -639,11 +648,24 @@ def update_download(book_id, user_id):
 # Delete non-existing downloaded books in calibre-web's own database
 def delete_download(book_id):
     session.query(Downloads).filter(book_id == Downloads.book_id).delete()
+    session.query(DownloadCount).filter(book_id == DownloadCount.book_id).delete()
     try:
         session.commit()
     except exc.OperationalError:
         session.rollback()
 
+
+# Recalculate download counts after bulk changes of the downloads table
+def rebuild_download_counts(_session=None):
+    s = _session if _session else session
+    try:
+        s.query(DownloadCount).delete()
+        s.execute(text("INSERT INTO download_count (book_id, count) "
+                       "SELECT book_id, COUNT(*) FROM downloads GROUP BY book_id"))
+        s.commit()
+    except exc.OperationalError:
+        s.rollback()
+
 # Generate user Guest (translated text), as anonymous user, no rights
 def create_anonymous_user(_session):
     user = User()
@@ -27,10 +27,13 @@ from werkzeug.datastructures import Authorization
 from werkzeug.security import check_password_hash
 
 from . import lm, ub, config, logger, limiter, constants, services
+from .credential_cache import CredentialCache
 
 
 log = logger.create()
 auth = HTTPBasicAuth()
+# OPDS readers send the credentials with every request, a verified password is not hashed again for a short time
+credential_cache = CredentialCache()
 
 
 @auth.verify_password
@@ -49,7 +52,11 @@ def verify_password(username, password):
                 log.error(error)
         else:
             limiter.check()
+            if credential_cache.check(username, password, user):
+                [limiter.limiter.storage.clear(k.key) for k in limiter.current_limits]
+                return user
             if check_password_hash(str(user.password), password):
+                credential_cache.add(username, password, user)
                 [limiter.limiter.storage.clear(k.key) for k in limiter.current_limits]
                 return user
     ip_address = request.headers.get('X-Forwarded-For', request.remote_addr)
@@ -22,7 +22,6 @@ import os
 import json
 import mimetypes
 import chardet  # dependency of requests
-import copy
 from importlib.metadata import metadata
 
 from flask import Blueprint, jsonify, request, redirect, send_from_directory, make_response, flash, abort, url_for
@@ -39,7 +38,7 @@ from sqlalchemy.sql.functions import coalesce
 from werkzeug.datastructures import Headers
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from . import constants, logger, isoLanguages, services
+from . import constants, logger, isoLanguages, services, category_index
 from . import db, ub, config, app
 from . import calibre_db, kobo_sync_status
 from .search import render_search_results, render_adv_search_results
@@ -235,7 +234,7 @@ def update_selected_books():
         valid_id_lookup = {book_id for (book_id,) in valid_ids}
         ids = [book_id for book_id in ids if book_id in valid_id_lookup]
 
-    ub.searched_ids[current_user.id] = ids
+    ub.searched_ids.set(current_user.id, ids)
     return jsonify({"count": len(ids)}), 200
 
 
@@ -365,13 +364,6 @@ def generate_char_list(entries): # data_colum, db_link):
     return char_list
 
 
-def query_char_list(data_colum, db_link):
-    results = (calibre_db.session.query(func.upper(func.substr(data_colum, 1, 1)).label('char'))
-            .join(db_link).join(db.Books).filter(calibre_db.common_filters())
-            .group_by(func.upper(func.substr(data_colum, 1, 1))).all())
-    return results
-
-
 def get_sort_function(sort_param, data):
     order = [db.Books.timestamp.desc()]
     if sort_param == 'stored':
@@ -399,9 +391,9 @@ def get_sort_function(sort_param, data):
     if sort_param == 'seriesdesc':
         order = [db.Books.series_index.desc()]
     if sort_param == 'hotdesc':
-        order = [func.count(ub.Downloads.book_id).desc()]
+        order = [ub.DownloadCount.count.desc()]
     if sort_param == 'hotasc':
-        order = [func.count(ub.Downloads.book_id).asc()]
+        order = [ub.DownloadCount.count.asc()]
     if sort_param is None:
         sort_param = "new"
     return order, sort_param
@@ -475,9 +467,7 @@ def render_rated_books(page, book_id, order):
 
 def render_discover_books(book_id):
     if current_user.check_visibility(constants.SIDEBAR_RANDOM):
-        entries, __, ___ = calibre_db.fill_indexpage(1, 0, db.Books, True, [func.randomblob(2)],
-                                                            join_archive_read=True,
-                                                            config_read_column=config.config_read_column)
+        entries = calibre_db.random_books(config.config_books_per_page, config.config_read_column)
         pagination = Pagination(1, config.config_books_per_page, config.config_books_per_page)
         return render_title_template('index.html', random=false(), entries=entries, pagination=pagination, id=book_id,
                                      title=_("Discover (Random Books)"), page="discover")
@@ -488,33 +478,14 @@ def render_discover_books(book_id):
 def render_hot_books(page, order):
     if current_user.check_visibility(constants.SIDEBAR_HOT):
         if order[1] not in ['hotasc', 'hotdesc']:
-            # Unary expression comparison only working (for this expression) in sqlalchemy 1.4+
-            # if not (order[0][0].compare(func.count(ub.Downloads.book_id).desc()) or
-            #        order[0][0].compare(func.count(ub.Downloads.book_id).asc())):
-            order = [func.count(ub.Downloads.book_id).desc()], 'hotdesc'
-        if current_user.show_detail_random():
-            random_query = calibre_db.generate_linked_query(config.config_read_column, db.Books)
-            random = (random_query.filter(calibre_db.common_filters())
-                     .order_by(func.random())
-                     .limit(config.config_random_books).all())
-        else:
-            random = false()
-
-        off = int(int(config.config_books_per_page) * (page - 1))
-        all_books = ub.session.query(ub.Downloads, func.count(ub.Downloads.book_id)) \
-            .order_by(*order[0]).group_by(ub.Downloads.book_id)
-        hot_books = all_books.offset(off).limit(config.config_books_per_page)
-        entries = list()
-        for book in hot_books:
-            query = calibre_db.generate_linked_query(config.config_read_column, db.Books)
-            download_book = query.filter(calibre_db.common_filters()).filter(
-                book.Downloads.book_id == db.Books.id).first()
-            if download_book:
-                entries.append(download_book)
-            else:
-                ub.delete_download(book.Downloads.book_id)
-        num_books = entries.__len__()
-        pagination = Pagination(page, config.config_books_per_page, num_books)
+            order = [ub.DownloadCount.count.desc()], 'hotdesc'
+        entries, random, pagination = calibre_db.fill_indexpage(page, 0,
+                                                                db.Books,
+                                                                ub.DownloadCount.count > 0,
+                                                                order[0],
+                                                                True, config.config_read_column,
+                                                                ub.DownloadCount,
+                                                                ub.DownloadCount.book_id == db.Books.id)
         return render_title_template('index.html', random=random, entries=entries, pagination=pagination,
                                      title=_("Hot Books (Most Downloaded)"), page="hot", order=order[1])
     else:
@@ -875,6 +846,8 @@ def list_books():
     search_param = request.args.get("search")
     sort_param = request.args.get("sort", "id")
     order = request.args.get("order", "").lower()
+    cursor = request.args.get("cursor")
+    next_cursor = None
     state = None
     join = tuple()
 
@@ -902,16 +875,17 @@ def list_books():
     elif not state:
         order = [db.Books.timestamp.desc()]
 
-    total_count = filtered_count = calibre_db.session.query(db.Books).filter(
-        calibre_db.common_filters(allow_show_archived=True)).count()
+    if not cursor or state is not None or search_param:
+        total_count = filtered_count = calibre_db.session.query(db.Books).filter(
+            calibre_db.common_filters(allow_show_archived=True)).count()
     if state is not None:
         if search_param:
-            books = calibre_db.search_query(search_param, config).all()
-            filtered_count = len(books)
+            query = calibre_db.search_query(search_param, config)
+            filtered_count = query.count()
         else:
             query = calibre_db.generate_linked_query(config.config_read_column, db.Books)
-            books = query.filter(calibre_db.common_filters(allow_show_archived=True)).all()
-        entries = calibre_db.get_checkbox_sorted(books, state, off, limit, order, True)
+            query = query.filter(calibre_db.common_filters(allow_show_archived=True))
+        entries = calibre_db.checkbox_sorted_page(query, state, off, limit, order)
     elif search_param:
         entries, filtered_count, __ = calibre_db.get_search_results(search_param,
                                                                     config,
@@ -920,27 +894,41 @@ def list_books():
                                                                     limit,
                                                                     *join)
     else:
-        entries, __, __ = calibre_db.fill_indexpage_with_archived_books((int(off) / (int(limit)) + 1),
-                                                                        db.Books,
-                                                                        limit,
-                                                                        True,
-                                                                        order,
-                                                                        True,
-                                                                        True,
-                                                                        config.config_read_column,
-                                                                        *join)
+        # the table requests the following page with the cursor of the previous response
+        entries, __, pagination = calibre_db.fill_indexpage_with_archived_books((int(off) / (int(limit)) + 1),
+                                                                                db.Books,
+                                                                                limit,
+                                                                                True,
+                                                                                order,
+                                                                                True,
+                                                                                True,
+                                                                                config.config_read_column,
+                                                                                *join,
+                                                                                cursor=cursor,
+                                                                                keyset=True,
+                                                                                exact_count=False)
+        if pagination:
+            if cursor:
+                # counted for the first page, passed on with the cursor
+                total_count = filtered_count = pagination.total_count
+            next_cursor = pagination.next_cursor
+        elif cursor:
+            total_count = filtered_count = 0
 
     result = list()
+    locale = get_locale()
     for entry in entries:
         val = entry[0]
         val.is_archived = entry[1] is True
         val.read_status = entry[2] == ub.ReadBook.STATUS_FINISHED
-        for lang_index in range(0, len(val.languages)):
-            val.languages[lang_index].language_name = isoLanguages.get_language_name(get_locale(), val.languages[
-                lang_index].lang_code)
+        for lang in val.languages:
+            lang.language_name = isoLanguages.get_language_name(locale, lang.lang_code)
         result.append(val)
 
     table_entries = {'totalNotFiltered': total_count, 'total': filtered_count, "rows": result}
+    if next_cursor:
+        table_entries['next'] = next_cursor
+        table_entries['nextOffset'] = off + limit
     js_list = json.dumps(table_entries, cls=db.AlchemyEncoder)
 
     response = make_response(js_list)
@@ -968,22 +956,11 @@ def update_table_settings():
 @login_required_if_no_ano
 def author_list():
     if current_user.check_visibility(constants.SIDEBAR_AUTHOR):
-        if current_user.get_view_property('author', 'dir') == 'desc':
-            order = db.Authors.sort.desc()
-            order_no = 0
-        else:
-            order = db.Authors.sort.asc()
-            order_no = 1
-        entries = calibre_db.session.query(db.Authors, func.count('books_authors_link.book').label('count')) \
-            .join(db.books_authors_link).join(db.Books).filter(calibre_db.common_filters()) \
-            .group_by(text('books_authors_link.author')).order_by(order).all()
-        char_list = query_char_list(db.Authors.sort, db.books_authors_link)
-        # If not creating a copy, readonly databases can not display authornames with "|" in it as changing the name
-        # starts a change session
-        author_copy = copy.deepcopy(entries)
-        for entry in author_copy:
-            entry.Authors.name = entry.Authors.name.replace('|', ',')
-        return render_title_template('list.html', entries=author_copy, folder='web.books_list', charlist=char_list,
+        order_no = 0 if current_user.get_view_property('author', 'dir') == 'desc' else 1
+        # author names come with "|" already replaced, the entries are not bound to the session
+        counts = calibre_db.category_counts(category_index.CATEGORY_AUTHOR)
+        entries = sorted(counts.entries, key=lambda x: (x[0].sort or "").lower(), reverse=not order_no)
+        return render_title_template('list.html', entries=entries, folder='web.books_list', charlist=counts.char_list,
                                      title="Authors", page="authorlist", data='author', order=order_no)
     else:
         abort(404)
@@ -999,8 +976,10 @@ def download_list():
         order = ub.User.name.asc()
         order_no = 1
     if current_user.check_visibility(constants.SIDEBAR_DOWNLOAD) and current_user.role_admin():
-        entries = ub.session.query(ub.User, func.count(ub.Downloads.book_id).label('count')) \
-            .join(ub.Downloads).group_by(ub.Downloads.user_id).order_by(order).all()
+        entries = [category_index.category_entry(row.id, row.name, row.count)
+                   for row in ub.session.query(ub.User.id, ub.User.name,
+                                               func.count(ub.Downloads.book_id).label('count'))
+                   .join(ub.Downloads).group_by(ub.Downloads.user_id).order_by(order)]
         char_list = ub.session.query(func.upper(func.substr(ub.User.name, 1, 1)).label('char')) \
             .filter(ub.User.role.op('&')(constants.ROLE_ANONYMOUS) != constants.ROLE_ANONYMOUS) \
             .group_by(func.upper(func.substr(ub.User.name, 1, 1))).all()
@@ -1013,23 +992,12 @@ def download_list():
 @web.route("/publisher")
 @login_required_if_no_ano
 def publisher_list():
-    if current_user.get_view_property('publisher', 'dir') == 'desc':
-        order = db.Publishers.name.desc()
-        order_no = 0
-    else:
-        order = db.Publishers.name.asc()
-        order_no = 1
+    order_no = 0 if current_user.get_view_property('publisher', 'dir') == 'desc' else 1
     if current_user.check_visibility(constants.SIDEBAR_PUBLISHER):
-        entries = calibre_db.session.query(db.Publishers, func.count('books_publishers_link.book').label('count')) \
-            .join(db.books_publishers_link).join(db.Books).filter(calibre_db.common_filters()) \
-            .group_by(text('books_publishers_link.publisher')).order_by(order).all()
-        no_publisher_count = (calibre_db.session.query(db.Books)
-                           .outerjoin(db.books_publishers_link).outerjoin(db.Publishers)
-                           .filter(db.Publishers.name == None)
-                           .filter(calibre_db.common_filters())
-                           .count())
-        if no_publisher_count:
-            entries.append([db.Category(_("None"), "-1"), no_publisher_count])
+        counts = calibre_db.category_counts(category_index.CATEGORY_PUBLISHER)
+        entries = list(counts.entries)
+        if counts.none_count:
+            entries.append([db.Category(_("None"), "-1"), counts.none_count])
         entries = sorted(entries, key=lambda x: x[0].name.lower(), reverse=not order_no)
         char_list = generate_char_list(entries)
         return render_title_template('list.html', entries=entries, folder='web.books_list', charlist=char_list,
@@ -1048,18 +1016,12 @@ def series_list():
         else:
             order = db.Series.sort.asc()
             order_no = 1
-        char_list = query_char_list(db.Series.sort, db.books_series_link)
+        counts = calibre_db.category_counts(category_index.CATEGORY_SERIES)
+        char_list = counts.char_list
         if current_user.get_view_property('series', 'series_view') == 'list':
-            entries = calibre_db.session.query(db.Series, func.count('books_series_link.book').label('count')) \
-                .join(db.books_series_link).join(db.Books).filter(calibre_db.common_filters()) \
-                .group_by(text('books_series_link.series')).order_by(order).all()
-            no_series_count = (calibre_db.session.query(db.Books)
-                            .outerjoin(db.books_series_link).outerjoin(db.Series)
-                            .filter(db.Series.name == None)
-                            .filter(calibre_db.common_filters())
-                            .count())
-            if no_series_count:
-                entries.append([db.Category(_("None"), "-1"), no_series_count])
+            entries = list(counts.entries)
+            if counts.none_count:
+                entries.append([db.Category(_("None"), "-1"), counts.none_count])
             entries = sorted(entries, key=lambda x: x[0].name.lower(), reverse=not order_no)
             return render_title_template('list.html',
                                          entries=entries,
@@ -1087,24 +1049,12 @@ def series_list():
 @login_required_if_no_ano
 def ratings_list():
     if current_user.check_visibility(constants.SIDEBAR_RATING):
-        if current_user.get_view_property('ratings', 'dir') == 'desc':
-            order = db.Ratings.rating.desc()
-            order_no = 0
-        else:
-            order = db.Ratings.rating.asc()
-            order_no = 1
-        entries = calibre_db.session.query(db.Ratings, func.count('books_ratings_link.book').label('count'),
-                                           (db.Ratings.rating / 2).label('name')) \
-            .join(db.books_ratings_link).join(db.Books).filter(calibre_db.common_filters()) \
-            .filter(db.Ratings.rating > 0) \
-            .group_by(text('books_ratings_link.rating')).order_by(order).all()
-        no_rating_count = (calibre_db.session.query(db.Books)
-                           .outerjoin(db.books_ratings_link).outerjoin(db.Ratings)
-                           .filter(or_(db.Ratings.rating == None, db.Ratings.rating == 0))
-                           .filter(calibre_db.common_filters())
-                           .count())
-        if no_rating_count:
-            entries.append([db.Category(_("None"), "-1", -1), no_rating_count])
+        order_no = 0 if current_user.get_view_property('ratings', 'dir') == 'desc' else 1
+        # books rated 0 are counted as unrated
+        counts = calibre_db.category_counts(category_index.CATEGORY_RATING)
+        entries = list(counts.entries)
+        if counts.none_count:
+            entries.append([db.Category(_("None"), "-1", -1), counts.none_count])
         entries = sorted(entries, key=lambda x: x[0].rating, reverse=not order_no)
         return render_title_template('list.html', entries=entries, folder='web.books_list', charlist=list(),
                                      title=_("Ratings list"), page="ratingslist", data="ratings", order=order_no)
@@ -1116,23 +1066,11 @@ def ratings_list():
 @login_required_if_no_ano
 def formats_list():
     if current_user.check_visibility(constants.SIDEBAR_FORMAT):
-        if current_user.get_view_property('formats', 'dir') == 'desc':
-            order = db.Data.format.desc()
-            order_no = 0
-        else:
-            order = db.Data.format.asc()
-            order_no = 1
-        entries = calibre_db.session.query(db.Data,
-                                           func.count('data.book').label('count'),
-                                           db.Data.format.label('format')) \
-            .join(db.Books).filter(calibre_db.common_filters()) \
-            .group_by(db.Data.format).order_by(order).all()
-        no_format_count = (calibre_db.session.query(db.Books).outerjoin(db.Data)
-                           .filter(db.Data.format == None)
-                           .filter(calibre_db.common_filters())
-                           .count())
-        if no_format_count:
-            entries.append([db.Category(_("None"), "-1"), no_format_count])
+        order_no = 0 if current_user.get_view_property('formats', 'dir') == 'desc' else 1
+        counts = calibre_db.category_counts(category_index.CATEGORY_FORMAT)
+        entries = sorted(counts.entries, key=lambda x: x.format, reverse=not order_no)
+        if counts.none_count:
+            entries.append([db.Category(_("None"), "-1"), counts.none_count])
         return render_title_template('list.html', entries=entries, folder='web.books_list', charlist=list(),
                                      title=_("File formats list"), page="formatslist", data="formats", order=order_no)
     else:
@@ -1156,22 +1094,11 @@ def language_overview():
 @login_required_if_no_ano
 def category_list():
     if current_user.check_visibility(constants.SIDEBAR_CATEGORY):
-        if current_user.get_view_property('category', 'dir') == 'desc':
-            order = db.Tags.name.desc()
-            order_no = 0
-        else:
-            order = db.Tags.name.asc()
-            order_no = 1
-        entries = calibre_db.session.query(db.Tags, func.count('books_tags_link.book').label('count')) \
-            .join(db.books_tags_link).join(db.Books).order_by(order).filter(calibre_db.common_filters()) \
-            .group_by(db.Tags.id).all()
-        no_tag_count = (calibre_db.session.query(db.Books)
-                         .outerjoin(db.books_tags_link).outerjoin(db.Tags)
-                        .filter(db.Tags.name == None)
-                         .filter(calibre_db.common_filters())
-                         .count())
-        if no_tag_count:
-            entries.append([db.Category(_("None"), "-1"), no_tag_count])
+        order_no = 0 if current_user.get_view_property('category', 'dir') == 'desc' else 1
+        counts = calibre_db.category_counts(category_index.CATEGORY_TAG)
+        entries = list(counts.entries)
+        if counts.none_count:
+            entries.append([db.Category(_("None"), "-1"), counts.none_count])
         entries = sorted(entries, key=lambda x: x[0].name.lower(), reverse=not order_no)
         char_list = generate_char_list(entries)
         return render_title_template('list.html', entries=entries, folder='web.books_list', charlist=char_list,
@@ -1675,9 +1602,9 @@ def show_book(book_id):
         entry = entries[0]
         entry.read_status = read_book == ub.ReadBook.STATUS_FINISHED
         entry.is_archived = archived_book
-        for lang_index in range(0, len(entry.languages)):
-            entry.languages[lang_index].language_name = isoLanguages.get_language_name(get_locale(), entry.languages[
-                lang_index].lang_code)
+        locale = get_locale()
+        for lang in entry.languages:
+            lang.language_name = isoLanguages.get_language_name(locale, lang.lang_code)
         cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
         book_in_shelves = []
         shelves = ub.session.query(ub.BookShelf).filter(ub.BookShelf.book_id == book_id).all()
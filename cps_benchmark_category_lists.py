@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+import argparse
+import copy
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, path)
+
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+from sqlalchemy.sql.expression import func, text  # noqa: E402
+
+from cps import db  # noqa: E402
+from cps.category_index import CategoryIndex, CATEGORY_AUTHOR, category_entry  # noqa: E402
+
+
+def create_library(db_path, books, authors):
+    """Writes a synthetic metadata.db with the tables used by the author list"""
+    engine = create_engine("sqlite:///" + db_path)
+    db.Base.metadata.create_all(engine, tables=[db.Books.__table__, db.Authors.__table__,
+                                                db.books_authors_link])
+    engine.dispose()
+    rnd = random.Random(42)
+    conn = sqlite3.connect(db_path)
+    conn.executemany("INSERT INTO authors(id, name, sort, link) VALUES(?, ?, ?, '')",
+                     # every 50th author name contains "|" like names imported from calibre can
+                     ((i, "Author {0}|Co {0}".format(i) if i % 50 == 0 else "Author {}".format(i),
+                       "{}{}, Author".format(rnd.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ"), i))
+                      for i in range(1, authors + 1)))
+    conn.executemany("INSERT INTO books(id, title, sort, series_index, path) VALUES(?, ?, ?, '1.0', ?)",
+                     ((i, "Book {}".format(i), "Book {}".format(i), "path/{}".format(i))
+                      for i in range(1, books + 1)))
+    links = set()
+    for book_id in range(1, books + 1):
+        for __ in range(rnd.choice((1, 1, 1, 2, 3))):
+            links.add((book_id, rnd.randint(1, authors)))
+    conn.executemany("INSERT INTO books_authors_link(book, author) VALUES(?, ?)", links)
+    conn.commit()
+    conn.close()
+    return len(links)
+
+
+def orm_deepcopy(session):
+    # author list before: entities with count, deep copied to rewrite names without touching the session
+    entries = session.query(db.Authors, func.count('books_authors_link.book').label('count')) \
+        .join(db.books_authors_link).join(db.Books) \
+        .group_by(text('books_authors_link.author')).order_by(db.Authors.sort).all()
+    author_copy = copy.deepcopy(entries)
+    for entry in author_copy:
+        entry.Authors.name = entry.Authors.name.replace('|', ',')
+    return author_copy
+
+
+def column_rows(session):
+    rows = session.query(db.Authors.id, func.replace(db.Authors.name, '|', ',').label('name'), db.Authors.sort,
+                         func.count(db.books_authors_link.c.book).label('count')) \
+        .join(db.books_authors_link).join(db.Books) \
+        .group_by(db.books_authors_link.c.author).order_by(db.Authors.sort)
+    return [category_entry(row.id, row.name, row.count, row.sort) for row in rows]
+
+
+def category_index(index):
+    def lookup(session):
+        def visible_books(book_ids):
+            query = session.query(db.Books.id)
+            if book_ids is not None:
+                query = query.filter(db.Books.id.in_(book_ids))
+            return [row[0] for row in query]
+        return sorted(index.lookup(session, CATEGORY_AUTHOR, "all", visible_books).entries,
+                      key=lambda x: (x.item.sort or "").lower())
+    return lookup
+
+
+def measure(session_factory, function, repeat):
+    timings = []
+    peak = retained = 0
+    count = 0
+    for __ in range(repeat):
+        session = session_factory()
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = function(session)
+        timings.append(time.perf_counter() - start)
+        current, peak_run = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak = max(peak, peak_run)
+        retained = max(retained, current)
+        count = len(result)
+        del result
+        session.close()
+    timings.sort()
+    return {"entries": count, "best_ms": timings[0] * 1000.0, "median_ms": timings[len(timings) // 2] * 1000.0,
+            "peak_mb": peak / (1024.0 * 1024.0), "retained_mb": retained / (1024.0 * 1024.0)}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare memory and time of the author list page variants on a synthetic library."
+    )
+    parser.add_argument("--books", type=int, default=100000, help="Number of books (default: 100000).")
+    parser.add_argument("--authors", type=int, default=30000, help="Number of authors (default: 30000).")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per variant (default: 3).")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_path = os.path.join(temp_dir, "metadata.db")
+        links = create_library(db_path, args.books, args.authors)
+        print("Synthetic library: {} books, {} authors, {} author links".format(args.books, args.authors, links))
+        engine = create_engine("sqlite:///" + db_path)
+        session_factory = sessionmaker(bind=engine)
+        index = CategoryIndex()
+        variants = (("ORM entities + deepcopy", orm_deepcopy),
+                    ("column select rows", column_rows),
+                    ("category index (first run loads links)", category_index(index)))
+        print("{:<42} {:>8} {:>10} {:>10} {:>10} {:>12}".format(
+            "variant", "entries", "best ms", "median ms", "peak MB", "retained MB"))
+        for name, function in variants:
+            result = measure(session_factory, function, args.repeat)
+            print("{:<42} {:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>12.1f}".format(
+                name, result["entries"], result["best_ms"], result["median_ms"], result["peak_mb"],
+                result["retained_mb"]))
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
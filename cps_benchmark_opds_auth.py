@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#  This file is part of the Calibre-Web (https://github.com/janeczku/calibre-web)
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+import argparse
+import os
+import sys
+import time
+from collections import namedtuple
+
+
+path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, path)
+
+from werkzeug.security import generate_password_hash, check_password_hash  # noqa: E402
+
+from cps.credential_cache import CredentialCache  # noqa: E402
+
+
+User = namedtuple('User', ['id', 'name', 'password', 'role'])
+
+
+def uncached(user, username, password):
+    return check_password_hash(str(user.password), password)
+
+
+def cached(cache):
+    def verify(user, username, password):
+        # same order as verify_password, the first request of every reader hashes the password
+        if cache.check(username, password, user):
+            return True
+        if check_password_hash(str(user.password), password):
+            cache.add(username, password, user)
+            return True
+        return False
+    return verify
+
+
+def measure(function, users, requests):
+    start = time.perf_counter()
+    for index in range(requests):
+        user, password = users[index % len(users)]
+        if not function(user, user.name, password):
+            raise RuntimeError("Verification failed for {}".format(user.name))
+    elapsed = time.perf_counter() - start
+    return requests / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the authenticated OPDS requests per second the Basic auth check allows "
+                    "with and without the verified credential cache."
+    )
+    parser.add_argument("--readers", type=int, default=5, help="Users sending requests in turn (default: 5).")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per variant (default: 200).")
+    args = parser.parse_args()
+
+    users = list()
+    for index in range(args.readers):
+        password = "password{}".format(index)
+        users.append((User(index + 1, "reader{}".format(index), generate_password_hash(password), 1), password))
+    print("{} readers, {} requests, password hash method: {}".format(args.readers, args.requests,
+                                                                      users[0][0].password.split("$")[0]))
+    cache = CredentialCache()
+    for name, function in (("check_password_hash per request", uncached),
+                           ("verified credential cache", cached(cache))):
+        print("{:<34} {:>12.1f} requests/s".format(name, measure(function, users, args.requests)))
+    print("cache statistics: {}".format(cache.get_stats()))
+
+
+if __name__ == '__main__':
+    main()
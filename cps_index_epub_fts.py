@@ -11,6 +11,8 @@
 import argparse
 import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from types import SimpleNamespace
 from datetime import datetime
 
@@ -64,7 +66,7 @@ def _init_configuration(settings_path):
         print("Warning: {}".format(error))
 
 
-def _render_progress_panel(processed, total, indexed, removed):
+def _render_progress_panel(processed, total, indexed, removed, indexed_bytes=0, elapsed=0.0):
     width = 24
     done = 0
     if total:
@@ -72,16 +74,19 @@ def _render_progress_panel(processed, total, indexed, removed):
     done = max(0, min(width, done))
     bar = "#" * done + "-" * (width - done)
     percent = 0.0 if not total else (float(processed) / float(total)) * 100.0
+    books_per_second = float(indexed) / elapsed if elapsed > 0 else 0.0
+    mb_per_second = float(indexed_bytes) / (1024 * 1024) / elapsed if elapsed > 0 else 0.0
     print("+--------------------------------------+")
     print("| EPUB FTS Rebuild                     |")
     print("| [{}] {:>5.1f}%            |".format(bar, percent))
     print("| processed: {:>5}/{:<5}              |".format(processed, total))
     print("| indexed:   {:>5}  removed: {:>5}      |".format(indexed, removed))
+    print("| rate: {:>7.2f} books/s {:>7.2f} MB/s |".format(books_per_second, mb_per_second))
     print("| updated:   {} UTC |".format(datetime.utcnow().strftime("%H:%M:%S")))
     print("+--------------------------------------+")
 
 
-def build_index(force_rebuild=False, show_progress=False):
+def build_index(force_rebuild=False, show_progress=False, workers=1):
     lib_session = calibre_db.connect()
     if lib_session is None:
         raise RuntimeError("Unable to connect to calibre metadata database")
@@ -98,23 +103,50 @@ def build_index(force_rebuild=False, show_progress=False):
             pass
 
     index = get_epub_fts_index(ub.app_DB_path)
-    if force_rebuild:
-        index.clear()
+    started = time.monotonic()
 
-    def progress_callback(processed, total, indexed, removed):
+    def progress_callback(processed, total, indexed, removed, indexed_bytes):
         # keep output readable on large libraries; print every 10 books and final line
         if show_progress and (processed % 10 == 0 or processed == total):
-            _render_progress_panel(processed, total, indexed, removed)
+            _render_progress_panel(processed, total, indexed, removed, indexed_bytes, time.monotonic() - started)
 
+    # a forced rebuild is checkpointed in the index, rerunning an interrupted rebuild resumes it
     result = index.sync_from_rows(
         epub_rows,
         config.get_book_path(),
         force=force_rebuild,
         progress_callback=progress_callback if show_progress else None,
+        workers=workers,
     )
+    result["elapsed"] = time.monotonic() - started
     return result, len(epub_rows), index
 
 
+def benchmark_search(index, term, searches, threads, limit):
+    latencies = []
+
+    def run_searches():
+        timings = []
+        for __ in range(searches):
+            start = time.perf_counter()
+            index.search_details(term, limit=limit)
+            timings.append(time.perf_counter() - start)
+        return timings
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for timings in executor.map(lambda __: run_searches(), range(threads)):
+            latencies.extend(timings)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "searches": len(latencies),
+        "p50_ms": latencies[int(len(latencies) * 0.50)] * 1000.0,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000.0,
+        "searches_per_second": len(latencies) / elapsed if elapsed > 0 else 0.0,
+    }
+
+
 def _get_library_session():
     lib_session = calibre_db.connect()
     if lib_session is None:
@@ -158,7 +190,13 @@ def main():
     parser.add_argument(
         "--rebuild",
         action="store_true",
-        help="Clear and rebuild the full EPUB text index."
+        help="Reindex every EPUB file. An interrupted rebuild resumes where it stopped."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of processes extracting EPUB text (default: number of CPUs)."
     )
     parser.add_argument(
         "--stats-only",
@@ -176,6 +214,18 @@ def main():
         default=20,
         help="Maximum number of search results to print (default: 20)."
     )
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        metavar="searches",
+        help="Run the --search query this many times per thread and print p50/p99 latency."
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=8,
+        help="Number of concurrent searching threads for --benchmark (default: 8)."
+    )
     parser.add_argument(
         "--no-sync",
         action="store_true",
@@ -195,14 +245,15 @@ def main():
 
     index = get_epub_fts_index(ub.app_DB_path)
     did_sync = False
-    result = {"indexed": 0, "removed": 0, "seen": 0}
+    result = {"indexed": 0, "removed": 0, "seen": 0, "bytes": 0}
     epub_total = 0
     if not args.stats_only:
         should_sync = True
         if args.search and args.no_sync and not args.rebuild:
             should_sync = False
         if should_sync:
-            result, epub_total, index = build_index(force_rebuild=args.rebuild, show_progress=args.rebuild)
+            result, epub_total, index = build_index(force_rebuild=args.rebuild, show_progress=args.rebuild,
+                                                    workers=max(1, args.workers))
             did_sync = True
 
     stats = index.get_stats()
@@ -212,6 +263,9 @@ def main():
         print("Books indexed/updated: {}".format(result["indexed"]))
         print("Index rows removed: {}".format(result["removed"]))
         print("Books seen during sync: {}".format(result["seen"]))
+        if result.get("elapsed"):
+            print("Throughput: {:.2f} books/s, {:.2f} MB/s".format(
+                result["indexed"] / result["elapsed"], result["bytes"] / (1024 * 1024) / result["elapsed"]))
     print("Index database: {}".format(index.db_path))
     print("Indexed books: {}".format(stats["books_indexed"]))
     print("Indexed chunks: {}".format(stats["chunks_indexed"]))
@@ -223,12 +277,18 @@ def main():
 
     if args.search:
         if not args.no_sync and not did_sync:
-            sync_result, epub_total, __ = build_index(force_rebuild=False, show_progress=False)
+            sync_result, epub_total, __ = build_index(force_rebuild=False, show_progress=False,
+                                                      workers=max(1, args.workers))
             print("Synced before search: indexed={}, removed={}, seen={}".format(
                 sync_result["indexed"], sync_result["removed"], sync_result["seen"]
             ))
 
         limit = max(1, int(args.limit))
+        if args.benchmark:
+            bench = benchmark_search(index, args.search, max(1, args.benchmark), max(1, args.threads), limit)
+            print("Benchmark: {} searches in {} threads, {:.1f} searches/s".format(
+                bench["searches"], max(1, args.threads), bench["searches_per_second"]))
+            print("Search latency p50: {:.2f} ms, p99: {:.2f} ms".format(bench["p50_ms"], bench["p99_ms"]))
         details = index.search_details(args.search, limit=limit)
         book_info = _book_lookup_by_ids([row["book_id"] for row in details])
         print("Search query: {}".format(args.search))